@@ -16,6 +16,7 @@ python gen_dataset.py \
 """
 
 import argparse
+import itertools
 import json
 import os
 import os.path
@@ -29,13 +30,16 @@ repo_root = os.path.abspath(os.path.join(dirname, '../..'))
 sys.path.insert(0, repo_root)
 import util.indexer
 
-def create_dataset(corpus, psg_folder, output):
+def create_dataset(corpus, psg_folder, output, batch_size=10_000):
     """Creates a JSONL dataset file for generation of HDCT term weights.
 
     Args:
         corpus: TSV file containing source documents. File has one
             document per line and four columns: document ID, URL, title,
-            and text. The passage file name format is
+            and text. May also be a folder of TSV files with the same
+            format, or a Parquet file created by util/columnar.py, in
+            which case only the URL and title columns are read. The
+            passage file name format is
             `ms-qry-passages_NNN.tsv` where NNN is three digit integer
             starting with 000 that identifies the file order.
         psg_folder: Folder that contains passage text files. Passage
@@ -44,20 +48,29 @@ def create_dataset(corpus, psg_folder, output):
         output: Path to output file, which will be a JSONL file with
             one dictionary per line. Dictionary has keys id, url, and
             title.
+        batch_size: Number of passages processed at one time. The
+            documents for a batch are read with a single call to
+            util.indexer.get_rows().
     """
     corpus = os.path.abspath(corpus)
     psg_folder = os.path.abspath(psg_folder)
 
-    doc_idx = util.indexer.IndexedFile(corpus, 0)
+    doc_idx = util.indexer.open_index(corpus, 0)
     ptn = re.compile(r'D\d+')
     print('Writing output to', output)
-    with open(output, 'wt') as ofile:
-        for psg_id in tqdm(row_iter(psg_folder), 'Docs Processed'):
-            doc_id = re.match(ptn, psg_id)[0]
-            _, url, title, _ = doc_idx[doc_id].split('\t')
-            output_dict = {'id': psg_id, 'url': url, 'title': title}
-            output_str = json.dumps(output_dict) + '\n'
-            ofile.write(output_str)
+    psg_ids = row_iter(psg_folder)
+    with open(output, 'wt') as ofile, tqdm(desc='Docs Processed') as pbar:
+        while True:
+            psg_batch = list(itertools.islice(psg_ids, batch_size))
+            if not psg_batch:
+                break
+            doc_ids = [re.match(ptn, psg_id)[0] for psg_id in psg_batch]
+            docs = util.indexer.get_rows(doc_idx, doc_ids, ['url', 'title'])
+            for psg_id, (url, title) in zip(psg_batch, docs):
+                output_dict = {'id': psg_id, 'url': url, 'title': title}
+                output_str = json.dumps(output_dict) + '\n'
+                ofile.write(output_str)
+            pbar.update(len(psg_batch))
 
 
 def row_iter(psg_folder):
@@ -79,7 +92,8 @@ if __name__ == '__main__':
             'the file order.')
     parser = argparse.ArgumentParser(desc)
     parser.add_argument('--corpus', required=True,
-                        help='TSV file that contains the source documents.')
+                        help='TSV or Parquet file that contains the '
+                             'source documents.')
     parser.add_argument('--psg-folder', required=True,
                         help='Path to folder containing passage files.')
     parser.add_argument('OUTPUT', help='Name of output dataset file.')
@@ -0,0 +1,157 @@
+"""Compares per-term join methods with the vectorized NumPy kernels.
+
+Generates a synthetic sample of document pairs with Zipf-distributed
+terms, in the repeated-term format of DeepCT and HDCT output, joins
+them with the IndexJoiner join methods and with the vectorized
+kernels (IndexJoiner(..., vectorized=True)), checks that both produce
+the same weights, and prints the time taken by each. End-to-end times
+include parsing the input records and building the output records.
+Join step times use pre-parsed weights, and show the time spent
+combining weights on its own.
+
+Run from the repository root:
+python -m TRESPI.benchmark_join --num-docs 100000
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+import TRESPI.joiner
+import TRESPI.vectorized
+import TRESPI.weights
+
+
+def make_sample(num_docs, vocab_size, terms_per_doc, max_weight, overlap,
+                seed):
+    """Creates synthetic index records for two indexes.
+
+    Args:
+        num_docs: Number of documents.
+        vocab_size: Number of distinct terms.
+        terms_per_doc: Average number of terms in each document.
+        max_weight: Term weights are drawn uniformly from 1 to
+            max_weight.
+        overlap: Fraction of index 0 terms that also appear in the
+            index 1 version of each document.
+        seed: Random seed.
+
+    Returns: Two lists of index records with 'id' and 'contents' keys.
+    """
+    rng = np.random.default_rng(seed)
+    records0, records1 = [], []
+    for doc_num in range(num_docs):
+        terms0 = np.unique(rng.zipf(1.3, terms_per_doc) % vocab_size)
+        shared = terms0[rng.random(len(terms0)) < overlap]
+        extra = rng.zipf(1.3, terms_per_doc // 2) % vocab_size
+        terms1 = np.unique(np.concatenate([shared, extra]))
+        for terms, records in ((terms0, records0), (terms1, records1)):
+            weights = rng.integers(1, max_weight + 1, len(terms))
+            doc_weights = {'w{}'.format(term): int(weight)
+                           for term, weight in zip(terms, weights)}
+            records.append(TRESPI.weights.make_record(
+                'D{}'.format(doc_num), doc_weights))
+    return records0, records1
+
+
+def make_joiner(join_type, qry_discount, output_format, vectorized):
+    """Creates an IndexJoiner that can join records without any input
+    indexes."""
+    joiner = TRESPI.joiner.IndexJoiner.__new__(TRESPI.joiner.IndexJoiner)
+    joiner.join_args = {'qry_discount': qry_discount}
+    joiner.output_format = output_format
+    joiner.vectorized = vectorized
+    joiner._vocab = TRESPI.vectorized.Vocabulary()
+    joiner.join_docs_method = getattr(joiner, join_type)
+    return joiner
+
+
+def run_join(joiner, records0, records1, batch_size):
+    """Joins the sample in batches and returns the joined records."""
+    joined = []
+    for start in range(0, len(records0), batch_size):
+        joined.extend(joiner._join_batch(
+            [records0[start:start + batch_size],
+             records1[start:start + batch_size]]))
+    return joined
+
+
+def run_kernel(join_type, encoded_batches, qry_discount, vocab):
+    """Joins pre-encoded batches with the NumPy kernels only."""
+    return [TRESPI.vectorized.join_encoded(encoded0, encoded1, join_type,
+                                           qry_discount, vocab)
+            for encoded0, encoded1 in encoded_batches]
+
+
+def timed(func, *args):
+    """Returns the result of func(*args) and the time it took."""
+    start_time = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--num-docs', type=int, default=100_000)
+    parser.add_argument('--vocab-size', type=int, default=50_000)
+    parser.add_argument('--terms-per-doc', type=int, default=60)
+    parser.add_argument('--max-weight', type=int, default=20)
+    parser.add_argument('--overlap', type=float, default=0.5)
+    parser.add_argument('--batch-size', type=int, default=10_000)
+    parser.add_argument('--qry-discount', type=float, default=0.8)
+    parser.add_argument('--output-format', default='contents',
+                        choices=TRESPI.weights.OUTPUT_FORMATS)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    print('Generating {:,} synthetic document pairs.'.format(args.num_docs))
+    records0, records1 = make_sample(
+        args.num_docs, args.vocab_size, args.terms_per_doc, args.max_weight,
+        args.overlap, args.seed)
+
+    # Pre-parsed inputs for timing the join step on its own.
+    vectors0, vectors1 = [
+        [{'id': record['id'], 'vector': TRESPI.weights.get_weights(record)}
+         for record in records] for records in (records0, records1)]
+    vocab = TRESPI.vectorized.Vocabulary()
+    encoded_batches = [
+        (TRESPI.vectorized.encode_weights(
+            [vector['vector'] for vector in vectors0[start:start + size]],
+            vocab),
+         TRESPI.vectorized.encode_weights(
+            [vector['vector'] for vector in vectors1[start:start + size]],
+            vocab))
+        for start, size in ((start, args.batch_size) for start
+                            in range(0, args.num_docs, args.batch_size))]
+
+    print('Seconds to join {:,} documents, with {} output.'
+          .format(args.num_docs, args.output_format))
+    print('End-to-end times include parsing records and building the output.')
+    print('{:<36} {:>21} {:>21}'.format('', 'End-to-End', 'Join Step Only'))
+    print('{:<36} {:>10} {:>10} {:>10} {:>10}'.format(
+        'Join Type', 'Per-Term', 'Vectorized', 'Per-Term', 'Kernel'))
+    for join_type in TRESPI.vectorized.JOIN_KERNELS:
+        joiner = make_joiner(join_type, args.qry_discount,
+                             args.output_format, False)
+        expected, per_term_time = timed(run_join, joiner, records0, records1,
+                                        args.batch_size)
+        joiner = make_joiner(join_type, args.qry_discount,
+                             args.output_format, True)
+        joined, vectorized_time = timed(run_join, joiner, records0, records1,
+                                        args.batch_size)
+        assert all(TRESPI.weights.get_weights(expected_record)
+                   == TRESPI.weights.get_weights(joined_record)
+                   for expected_record, joined_record in zip(expected, joined))
+        joiner = make_joiner(join_type, args.qry_discount, 'vector', False)
+        _, per_term_join_time = timed(run_join, joiner, vectors0, vectors1,
+                                      args.batch_size)
+        _, kernel_time = timed(run_kernel, join_type, encoded_batches,
+                               args.qry_discount, vocab)
+        print('{:<36} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f}'.format(
+            join_type, per_term_time, vectorized_time, per_term_join_time,
+            kernel_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+"""Fusion functions that combine term weights from any number of indexes.
+
+A fusion function takes a list of {term: weight} dictionaries, one for
+each input index, and a list of per-index discounts, and returns the
+fused {term: weight} dictionary. Missing documents are passed as empty
+dictionaries. Every index weight is multiplied by its index's discount
+before it is combined, and fused weights are rounded to integers of at
+least 1, so that they can be written as repeated terms.
+
+Fusion functions are registered by name with the `fusion_function`
+decorator, and are selected with IndexJoiner.set_join_type():
+```
+jnr = joiner.IndexJoiner([hdct_path, doct5query_path, bm25_path],
+                         join_engine='sort_merge')
+jnr.set_join_type('max', {'discounts': [1.0, 0.8, 0.5]})
+```
+Additional join_args are passed to the fusion function as keyword
+arguments.
+"""
+
+import collections
+
+# Maps fusion function names to fusion functions.
+FUSION_FUNCTIONS = {}
+
+
+def fusion_function(name):
+    """Decorator that registers a fusion function under `name`."""
+    def register(func):
+        FUSION_FUNCTIONS[name] = func
+        return func
+    return register
+
+
+def _clamp(weight):
+    """Rounds a fused weight to an integer that is at least 1."""
+    return int(max(round(weight), 1))
+
+
+@fusion_function('sum')
+def fuse_sum(doc_weights, discounts):
+    """Sums the discounted weights from every index."""
+    fused = collections.defaultdict(float)
+    for weights, discount in zip(doc_weights, discounts):
+        for term, weight in weights.items():
+            fused[term] += discount * weight
+    return {term: _clamp(weight) for term, weight in fused.items()}
+
+
+@fusion_function('avg')
+def fuse_avg(doc_weights, discounts):
+    """Averages the discounted weights over the indexes with the term.
+
+    With two indexes and discounts of [1.0, F], this matches
+    IndexJoiner.join_docs_avg_weights_qry_discount with a qry_discount
+    of F.
+    """
+    totals = collections.defaultdict(float)
+    counts = collections.Counter()
+    for weights, discount in zip(doc_weights, discounts):
+        for term, weight in weights.items():
+            totals[term] += discount * weight
+            counts[term] += 1
+    return {term: _clamp(total / counts[term])
+            for term, total in totals.items()}
+
+
+@fusion_function('max')
+def fuse_max(doc_weights, discounts):
+    """Takes the maximum discounted weight from any index.
+
+    With two indexes and discounts of [1.0, F], this matches
+    IndexJoiner.join_docs_max_weights_qry_discount with a qry_discount
+    of F.
+    """
+    fused = {}
+    for weights, discount in zip(doc_weights, discounts):
+        for term, weight in weights.items():
+            weight = discount * weight
+            if term not in fused or weight > fused[term]:
+                fused[term] = weight
+    return {term: _clamp(weight) for term, weight in fused.items()}
+
+
+@fusion_function('rrf')
+def fuse_rrf(doc_weights, discounts, k=60, scale=1000):
+    """Reciprocal rank fusion of the terms in each index's document.
+
+    Terms are ranked within each index's version of the document by
+    descending weight, with tied weights sharing the best rank. Each
+    index contributes discount / (k + rank) to a term's score, and the
+    fused weight is scale * score. RRF ignores the size of the input
+    weights, so it can fuse indexes whose weights are on different
+    scales, such as HDCT weights and BM25 term frequencies.
+
+    Args:
+        doc_weights, discounts: See module docstring.
+        k: RRF rank constant. Optional. Defaults to 60.
+        scale: Multiplier that converts scores to integer weights.
+            With the defaults, the top term in one index gets a
+            weight of 16. Optional. Defaults to 1000.
+    """
+    scores = collections.defaultdict(float)
+    for weights, discount in zip(doc_weights, discounts):
+        rank, prev_weight = 0, None
+        ranked = sorted(weights.items(), key=lambda item: -item[1])
+        for position, (term, weight) in enumerate(ranked, 1):
+            if weight != prev_weight:
+                rank, prev_weight = position, weight
+            scores[term] += discount / (k + rank)
+    return {term: _clamp(scale * score) for term, score in scores.items()}
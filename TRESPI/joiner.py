@@ -16,14 +16,261 @@ Stacy Irwin, 22 July 2021
 import argparse
 import collections
 import datetime
+import hashlib
+import heapq
+import itertools
 import json
+import multiprocessing
+import operator
 import os
 import os.path
+import tempfile
+import time
 
 from tqdm import tqdm
 
+import TRESPI.fusion
+import TRESPI.vectorized
+import TRESPI.weights
+import util.codec
 import util.indexer
 
+JOIN_ENGINES = ('index', 'sort_merge')
+
+# Manifest of completed output files, saved in the output folder
+MANIFEST_NAME = 'join.manifest'
+
+# IndexJoiner object used by join_indexes() worker processes
+_worker_joiner = None
+
+
+def _init_join_worker(joiner):
+    """Stores the IndexJoiner in a join_indexes() worker process."""
+    global _worker_joiner
+    _worker_joiner = joiner
+
+
+def _join_file_worker(args):
+    """Joins one index 0 file in a join_indexes() worker process."""
+    return _worker_joiner._join_file(*args)
+
+
+def _write_json_atomic(path, data):
+    """Writes a JSON file by replacing it with a complete new copy."""
+    tmp_file_path = path + '.tmp'
+    with open(tmp_file_path, 'wt') as jfile:
+        json.dump(data, jfile, indent=1)
+        jfile.flush()
+        os.fsync(jfile.fileno())
+    os.replace(tmp_file_path, path)
+
+
+def _files_fingerprint(file_paths):
+    """Returns a hex string that identifies a list of input files.
+
+    The fingerprint is calculated from the name, size, and modified
+    time of every file.
+    """
+    checksum = hashlib.blake2b(digest_size=16)
+    for path in file_paths:
+        stat = os.stat(path)
+        checksum.update(repr((os.path.basename(path), stat.st_size,
+                              stat.st_mtime_ns)).encode('utf-8'))
+    return checksum.hexdigest()
+
+
+class _ShardWriter():
+    """Writes an output file atomically, with checkpoints for resuming.
+
+    Records are written to a temporary file named <path>.tmp, which is
+    renamed to <path> by finish(). commit() flushes the temporary file
+    to disk and saves a checkpoint to <path>.checkpoint, containing
+    the number of records written, the size of the temporary file, and
+    an input offset chosen by the caller. If a writer is created for a
+    path that has a checkpoint, the temporary file is truncated to its
+    size at the last checkpoint and writing continues from there, so
+    records written after the last checkpoint are discarded. The
+    caller resumes reading its input from `input_offset`.
+
+    Use the writer in a with statement, so that the temporary file is
+    closed, and kept for resuming, if the join is interrupted.
+    """
+
+    def __init__(self, path, start_offset=0, resume=True):
+        """Opens or resumes an output file.
+
+        Args:
+            path: Path of the completed output file.
+            start_offset: Input offset used if there is no checkpoint.
+                Optional. Defaults to 0.
+            resume: If False, any checkpoint is ignored and the file
+                is started from scratch. Optional. Defaults to True.
+        """
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        self.checkpoint_path = path + '.checkpoint'
+        self.checksum = hashlib.blake2b(digest_size=16)
+        self.input_offset = start_offset
+        self.records = 0
+        output_offset = 0
+        if (resume and os.path.isfile(self.checkpoint_path)
+                and os.path.isfile(self.tmp_path)):
+            with open(self.checkpoint_path) as cfile:
+                checkpoint = json.load(cfile)
+            self.input_offset = checkpoint['input_offset']
+            self.records = checkpoint['records']
+            output_offset = checkpoint['output_offset']
+            self.file = open(self.tmp_path, 'r+b')
+            self.file.truncate(output_offset)
+            for chunk in iter(lambda: self.file.read(1 << 20), b''):
+                self.checksum.update(chunk)
+        else:
+            self.file = open(self.tmp_path, 'wb')
+        self.resumed = output_offset > 0
+
+    def write(self, line):
+        """Writes one record, a bytes line ending in a newline."""
+        self.file.write(line)
+        self.checksum.update(line)
+        self.records += 1
+
+    def commit(self, input_offset):
+        """Saves a checkpoint after all records written so far."""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.input_offset = input_offset
+        _write_json_atomic(self.checkpoint_path,
+                           {'input_offset': input_offset,
+                            'output_offset': self.file.tell(),
+                            'records': self.records})
+
+    def finish(self):
+        """Completes the output file.
+
+        Returns: A dictionary with the number of records, the size in
+        bytes, and a blake2b checksum of the completed file.
+        """
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        num_bytes = self.file.tell()
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+        if os.path.isfile(self.checkpoint_path):
+            os.remove(self.checkpoint_path)
+        return {'records': self.records, 'bytes': num_bytes,
+                'checksum': self.checksum.hexdigest()}
+
+    def discard(self):
+        """Deletes the temporary file and checkpoint."""
+        self.file.close()
+        for path in [self.tmp_path, self.checkpoint_path]:
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def close(self):
+        """Closes an unfinished file, keeping it for a later resume."""
+        if not self.file.closed:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _write_run(run, tmp_path):
+    """Sorts a list of documents and writes them to a run file.
+
+    Args:
+        run: List of (doc_id, line) tuples. Both are bytes.
+        tmp_path: Folder in which the run file is created.
+
+    Returns: Path to the run file. Each line of the run file contains
+    the document ID and the original line, separated by a tab.
+    """
+    run.sort(key=operator.itemgetter(0))
+    fd, run_path = tempfile.mkstemp(suffix='.run', dir=tmp_path)
+    with open(fd, 'wb') as rfile:
+        for doc_id, line in run:
+            rfile.write(doc_id + b'\t' + line)
+    return run_path
+
+
+def _read_run(run_path):
+    """Iterates over the (doc_id, line) tuples in a run file."""
+    with open(run_path, 'rb') as rfile:
+        for rline in rfile:
+            doc_id, _, line = rline.partition(b'\t')
+            yield doc_id, line
+
+
+def _sorted_docs(file_paths, tmp_path, max_run_bytes):
+    """Iterates over all documents in JSONL files, sorted by ID.
+
+    Uses an external merge sort: documents are read in runs of at most
+    max_run_bytes, each run is sorted and written to a temporary file,
+    and the run files are merged. If all documents fit in one run, no
+    temporary files are written.
+
+    Args:
+        file_paths: List of JSONL file paths.
+        tmp_path: Folder in which run files are written.
+        max_run_bytes: Maximum size of a run held in memory.
+
+    Yields: (doc_id, line) tuples in doc_id order. Both are bytes.
+    """
+    get_id = util.codec.field_decoder('id')
+    run_paths = []
+    run = []
+    run_bytes = 0
+    for path in file_paths:
+        with open(path, 'rb') as jfile:
+            for line in jfile:
+                if not line.endswith(b'\n'):
+                    line += b'\n'
+                run.append((get_id(line).encode('utf-8'), line))
+                run_bytes += len(line)
+                if run_bytes >= max_run_bytes:
+                    run_paths.append(_write_run(run, tmp_path))
+                    run = []
+                    run_bytes = 0
+    if not run_paths:
+        run.sort(key=operator.itemgetter(0))
+        yield from run
+        return
+    if run:
+        run_paths.append(_write_run(run, tmp_path))
+    del run
+    yield from heapq.merge(*[_read_run(run_path) for run_path in run_paths],
+                           key=operator.itemgetter(0))
+
+
+def _merge_sorted_docs(sorted_streams):
+    """Merges sorted document streams into groups with the same ID.
+
+    Args:
+        sorted_streams: List of iterators that yield (doc_id, line)
+            tuples in doc_id order, one iterator per index.
+
+    Yields: A list with one entry per index, containing the document's
+    line from that index, or None if the document is not in the index.
+    If a document ID appears more than once in the same index, only the
+    first document is used.
+    """
+    def tag_stream(idx, stream):
+        for doc_id, line in stream:
+            yield doc_id, idx, line
+
+    merged = heapq.merge(*[tag_stream(idx, stream)
+                           for idx, stream in enumerate(sorted_streams)])
+    for _, group in itertools.groupby(merged, operator.itemgetter(0)):
+        lines = [None] * len(sorted_streams)
+        for _, idx, line in group:
+            if lines[idx] is None:
+                lines[idx] = line
+        yield lines
+
 class IndexJoiner():
     """Combines two document indexes to create a new index.
 
@@ -54,6 +301,9 @@ class IndexJoiner():
           * join_docs_sum_weights
           * join_docs_avg_weights_qry_discount
           * join_docs_max_weights_qry_discount
+        `join_type` can also be the name of a fusion function in
+        TRESPI.fusion, such as 'max' or 'rrf', which can fuse more
+        than two indexes with the 'sort_merge' join engine.
         * `join_args` is a dictionary containing the custom arguments
         needed for the join. The key is the name of the argument.
         For example, join_docs_avg_weights_qry_discount requires one
@@ -67,85 +317,117 @@ class IndexJoiner():
 
     When joining indexes, IndexJoiner iterates through every entry in
     index 0 and retrieves the corresponding record from index 1 using
-    the index datastructure contained in util.indexer.IndexedFile.
+    the index datastructure contained in util.indexer.IndexedCollection.
     The records for the two indexes need not be in the same order.
     Also, if one index is larger than the other, recommend that index
     be procssed as index 0.
 
+    Alternatively, pass join_engine='sort_merge' to the constructor.
+    The sort-merge engine sorts both indexes by document ID with an
+    external merge sort that uses a bounded amount of memory, then
+    reads the sorted indexes side by side in a single sequential pass
+    that writes joined documents and documents that appear in only
+    one index. It does not need the mismatched document IDs or the
+    *.bin-index files, so neither is created. The joined documents are
+    written to files named joined_NNN.json, in document ID order.
+
+    Both join engines write output files atomically and save
+    checkpoints, and record completed files in a join.manifest file
+    in the output folder. Running an interrupted join again resumes it
+    (see join_indexes()).
+
     Initializing an IndexJoiner object results in the creation of
     sevaral data files.
-    1. a *.pickled-index file is created for each input file. The
-    *.pickled-index files contain indexes to every document ID in all
+    1. a *.bin-index file is created for each input file, and a
+    collection.bin-index file is created in each input folder. The
+    *.bin-index files contain indexes to every document ID in all
     input files, allowing fast random access to document term weights
     given a document ID. These files will be created from scratch the
     first time IndexJoiner is initialzied on a given set of input files,
     but for subsequent runs, the indexes need only be read from disk,
-    which is much faster. The *.pickled-index files are generated by
-    the util.indexer.IndexedFile class.
+    which is much faster. The *.bin-index files are generated by
+    the util.indexer.IndexedFile and util.indexer.IndexedCollection
+    classes.
     2. When first initialized, IndexJoiner identifies all mismatched
     document IDs. Mismatched document IDs are ID values that appear in
-    only one of the input indexes, but not both. For large indexes, this
-    step is time consuming. The mismatched document IDs are written to
-    the file specified by the constructor's `join_data_file` argument.
-    If the file alredy exists, the mismatched document IDs are read from
-    the file instead of being recalculated, which saves considerable
-    time. Be careful not use an old join data file calculated from
-    different document indexes.
+    only one of the input indexes, but not both. The collection.bin-index
+    files contain sorted arrays of every document ID, so the mismatched
+    IDs are found with a single linear merge of the two arrays, without
+    reading the input files. The mismatched document IDs are written to
+    the file specified by the constructor's `join_data_file` argument,
+    along with a fingerprint of both input indexes. If the file already
+    exists and was created from the same input files, the mismatched
+    document IDs are read from the file. If the input files have changed,
+    the mismatched document IDs are recalculated automatically.
     """
 
     def __init__(self,
                  idx_paths,
-                 join_data_file='join_data.json'):
+                 join_data_file='join_data.json',
+                 index_workers=1,
+                 join_engine='index',
+                 output_format='contents',
+                 vectorized=False):
         """Initializes IndexJoiner object and pre-processes inputs.
 
         Args:
-            idx_paths: List containing two strings. Strings are paths
-                to folders containing the indexes to be joined.
+            idx_paths: List of paths to folders containing the indexes
+                to be joined. The 'index' join engine joins exactly two
+                indexes. The 'sort_merge' engine can fuse any number of
+                indexes in a single pass (see TRESPI.fusion).
             join_data_file: Name of file in which mismatched data will
                 be saved, or from which mismatched data will be read.
                 Optional. Defaults to 'join_data.json'.
+            index_workers: Number of processes used to build the
+                index for each input file, if the index does not
+                already exist. Optional. Defaults to 1.
+            join_engine: 'index' or 'sort_merge'. 'index' looks up
+                every index 0 document in index 1. 'sort_merge' sorts
+                both indexes and merges them, and skips the
+                mismatched document and file index preparation.
+                Optional. Defaults to 'index'.
+            output_format: 'contents' writes joined records with
+                repeated terms, 'vector' writes JsonVectorCollection
+                records with {term: weight} dictionaries (see
+                TRESPI.weights). Optional. Defaults to 'contents'.
+            vectorized: If True, batches of documents are joined with
+                the NumPy kernels in TRESPI.vectorized, for join types
+                that have a kernel. Optional. Defaults to False.
         """
-        assert len(idx_paths) == 2
+        assert len(idx_paths) >= 2
+        if join_engine not in JOIN_ENGINES:
+            raise ValueError('Join engine must be one of {}.'
+                             .format(', '.join(JOIN_ENGINES)))
+        if join_engine == 'index' and len(idx_paths) != 2:
+            raise ValueError("The 'index' join engine joins two indexes. "
+                             "Use join_engine='sort_merge' to fuse more.")
+        if output_format not in TRESPI.weights.OUTPUT_FORMATS:
+            raise ValueError('Output format must be one of {}.'
+                             .format(', '.join(TRESPI.weights.OUTPUT_FORMATS)))
+        self.join_engine = join_engine
+        self.output_format = output_format
+        self.vectorized = vectorized
+        self._vocab = TRESPI.vectorized.Vocabulary()
         print('Preparing to join document indexes.')
-        print('Files for index 0 stored in:', idx_paths[0])
-        print('Files for index 1 stored in:' , idx_paths[1])
+        for idx, idx_path in enumerate(idx_paths):
+            print('Files for index {} stored in:'.format(idx), idx_path)
         print('Start Time:', datetime.datetime.now(), '\n')
 
         # Get paths to all json files for both indices
         self.idx_paths = idx_paths
+        self.index_workers = index_workers
         self.idx_files = [
             [os.path.join(idx_path, fname) for fname in os.listdir(idx_path)
              if fname[-5:] == '.json']
             for idx_path in idx_paths]
         for idx_file_lst in self.idx_files:
             idx_file_lst.sort()       
-
-        # Open join_data file if it exists
-        print('Processing mismatched documents, i.e., checking for')
-        print('    documents that exist in only one index.')
         self.data_file_name = join_data_file
-        if os.path.isfile(join_data_file):
-            print('Reading mismatched documents data from ', join_data_file)
-            with open(join_data_file) as dfile:
-                self.join_data = json.load(dfile)
-        else:
-            self.join_data = {}
-            self.join_data['idx0_only_ids'] = self._get_mismatched_docs(0)
-            self.join_data['idx1_only_ids'] = self._get_mismatched_docs(1)
-            with open(join_data_file, 'wt') as jdfile:
-                json.dump(self.join_data, jdfile)
-        print('Number of documents that exist only in index 0:',
-              len(self.join_data['idx0_only_ids']))
-        print('Number of documents that exist only in index 1:',
-              len(self.join_data['idx1_only_ids']))
-        print()
-        
-        # Create or open file indexes
-        print('Initializing File Indexes')
-        self.file_indexes = self._get_file_indexes()
-        print()
+        if join_engine == 'index':
+            self._prepare_index_join()
 
         # Attributes for specific join types
+        self.join_type = None
         self.join_args = None
         self.join_docs_method = None
 
@@ -159,6 +441,9 @@ class IndexJoiner():
             for att in dir(self):
                 if att[:9] == 'join_docs' and att != 'join_docs_method':
                     print('  *', att)
+            print('The available fusion functions are:')
+            for fusion_name in TRESPI.fusion.FUSION_FUNCTIONS:
+                print('  *', fusion_name)
             print(
                 """Example:
     idx_jnr = joiner.IndexJoiner([idx0_path, idx1_path])
@@ -166,6 +451,40 @@ class IndexJoiner():
                             {'qry_discount': 0.8})""")
             print("See join methods's docstring for required join_args.")
 
+    def _prepare_index_join(self):
+        """Opens file indexes and identifies mismatched documents."""
+        join_data_file = self.data_file_name
+
+        # Create or open file indexes
+        print('Initializing File Indexes')
+        self.indexes = self._get_indexes()
+        print()
+
+        # Open join_data file if it was made from the same indexes
+        print('Processing mismatched documents, i.e., checking for')
+        print('    documents that exist in only one index.')
+        fingerprints = [index.fingerprint() for index in self.indexes]
+        self.join_data = None
+        if os.path.isfile(join_data_file):
+            print('Reading mismatched documents data from ', join_data_file)
+            with open(join_data_file) as dfile:
+                self.join_data = json.load(dfile)
+            if self.join_data.get('fingerprints') != fingerprints:
+                print('The input indexes have changed since',
+                      join_data_file, 'was created. Recalculating.')
+                self.join_data = None
+        if self.join_data is None:
+            self.join_data = {'fingerprints': fingerprints}
+            (self.join_data['idx0_only_ids'],
+             self.join_data['idx1_only_ids']) = self._get_mismatched_docs()
+            with open(join_data_file, 'wt') as jdfile:
+                json.dump(self.join_data, jdfile)
+        print('Number of documents that exist only in index 0:',
+              len(self.join_data['idx0_only_ids']))
+        print('Number of documents that exist only in index 1:',
+              len(self.join_data['idx1_only_ids']))
+        print()
+
     def set_join_type(self, join_type, join_args):
         """Specifies the type of join and join arguments.
 
@@ -174,55 +493,402 @@ class IndexJoiner():
 
         Args:
             join_type: Name of the IndexJoiner method that will be used
-                to join the two input indexes. Must start with
-                'join_docs'.
+                to join the two input indexes, which must start with
+                'join_docs', or the name of a fusion function in
+                TRESPI.fusion.FUSION_FUNCTIONS, which can join any
+                number of indexes.
             join_args: Python dictionary containing additional arguments
                 that are required for the join. Format:
-                `{'arg_name': arg_value}
+                `{'arg_name': arg_value}`. For fusion functions, the
+                optional 'discounts' argument is a list with a weight
+                multiplier for each index, which defaults to 1.0 for
+                every index. Other arguments are passed to the fusion
+                function.
         """
         print('Setting join type to', join_type)
         print(join_args)
-        if join_type[:9] == 'join_docs' and hasattr(self, join_type.lower()):
+        join_args = join_args if join_args is not None else {}
+        if join_type in TRESPI.fusion.FUSION_FUNCTIONS:
+            discounts = join_args.get('discounts',
+                                      [1.0] * len(self.idx_paths))
+            if len(discounts) != len(self.idx_paths):
+                raise ValueError('Provide one discount for each index.')
+            self.join_docs_method = self.fuse_docs
+            self.join_args = dict(join_args, discounts=discounts)
+            self._fusion = TRESPI.fusion.FUSION_FUNCTIONS[join_type]
+        elif (join_type[:9] == 'join_docs' and hasattr(self, join_type.lower())
+                and len(self.idx_paths) == 2):
             self.join_docs_method = getattr(self, join_type)
             self.join_args = join_args
         else:
-            raise ValueError('Incorrect join type.') 
+            raise ValueError('Incorrect join type.')
+        self.join_type = join_type
         print('The next step is running join_indexes(output_path) method.')
 
-    def join_indexes(self, output_path):
+    def join_indexes(self, output_path, batch_size=10_000, workers=1,
+                     docs_per_file=100_000, max_run_bytes=256_000_000,
+                     tmp_path=None, resume=True):
         """Joins the two input indexes.
 
         Do not call this method until after a join type has been
         specified with IndexJoiner.set_join_type().
 
-        An separate output file will be created for every index file in
-        index 0.
+        With the 'index' join engine, a separate output file will be
+        created for every index file in index 0. With the 'sort_merge'
+        join engine, see IndexJoiner.join_indexes_sort_merge().
+
+        Joins can be resumed after they are interrupted. Each output
+        file is written to a temporary file that is renamed when the
+        file is complete, and a checkpoint is saved after every batch.
+        Completed files are recorded, with their record counts and
+        checksums, in a manifest named join.manifest in the output
+        folder. When the join is run again with the same inputs and
+        join settings, completed files are skipped and the file that
+        was in progress continues from its last checkpoint.
 
         Args:
             output_path: The file location where the joined index files
                 will be written.
+            batch_size: Number of index 0 documents that are read and
+                joined at one time. The matching index 1 documents for the whole
+                batch are read with IndexedFile.get_many(), which reads
+                them in file order instead of one random seek per
+                document. Optional, defaults to 10,000.
+            workers: Number of processes that join index 0 files in
+                parallel. Each output file is written by a single
+                process, which opens its own copy of index 1.
+                Optional, defaults to 1.
+            docs_per_file, max_run_bytes, tmp_path: Only used by the
+                'sort_merge' join engine. See join_indexes_sort_merge().
+            resume: If True, a previous join into output_path with the
+                same settings is resumed. If False, all output files
+                are written from scratch. Optional, defaults to True.
         """
+        if self.join_engine == 'sort_merge':
+            self.join_indexes_sort_merge(output_path, docs_per_file,
+                                         max_run_bytes, tmp_path, batch_size,
+                                         resume)
+            return
+        manifest = self._open_manifest(output_path, {}, resume)
+        if manifest['complete']:
+            print('The join in', output_path, 'is already complete.')
+            return
         print('Joining Indexes using {}'.format(self.join_docs_method))
         print('Join arguments:', self.join_args)
         print('Iterating through documents in Index 0.')
         print('Start Time:', datetime.datetime.now())
+        tasks = []
         for idx, ifile in enumerate(self.idx_files[0]):
             ifilename = os.path.split(ifile)[1]
-            file_len = len(self.file_indexes[0][idx])
-            with    open(ifile) as idxfile, \
-                    open(os.path.join(output_path, ifilename), 'wt') as ofile:
-                for line in tqdm(idxfile, ifilename, file_len):
-                    doc1_data = json.loads(line)
-                    doc1_id = doc1_data['id']
-                    doc2_txt = self.get_doc(1, doc1_id)
-                    try: 
-                        doc2_data = json.loads(doc2_txt)
-                    except json.JSONDecodeError:
-                        doc2_data = None
-                    joined_doc_data = self.join_docs_method(doc1_data,
-                                                            doc2_data)
-                    ofile.write(json.dumps(joined_doc_data) + '\n')
-        self._add_missing_docs(output_path)
+            if ifilename in manifest['shards']:
+                print('Skipping completed file', ifilename)
+                continue
+            tasks.append((idx, output_path, batch_size, workers == 1, resume))
+        if workers > 1 and tasks:
+            print('Joining {} files with {} processes'
+                  .format(len(tasks), workers))
+            total_docs = sum(self.indexes[0].shard_len(task[0])
+                             for task in tasks)
+            with multiprocessing.Pool(workers, _init_join_worker,
+                                      (self,)) as pool, \
+                    tqdm(desc='Docs Joined', total=total_docs) as pbar:
+                for ifilename, num_docs, elapsed, shard_info in \
+                        pool.imap_unordered(_join_file_worker, tasks):
+                    self._record_shard(output_path, manifest, ifilename,
+                                       shard_info)
+                    pbar.update(num_docs)
+                    pbar.write('Joined {}: {:,} docs in {:.1f} seconds'
+                               .format(ifilename, num_docs, elapsed))
+        else:
+            for task in tasks:
+                ifilename, _, _, shard_info = self._join_file(*task)
+                self._record_shard(output_path, manifest, ifilename,
+                                   shard_info)
+        if 'docs_mismatched.json' not in manifest['shards']:
+            self._record_shard(output_path, manifest, 'docs_mismatched.json',
+                               self._add_missing_docs(output_path,
+                                                      batch_size))
+        manifest['complete'] = True
+        self._save_manifest(output_path, manifest)
+        print('Index join complete.')
+        print('Stop Time:', datetime.datetime.now())
+
+    def _open_manifest(self, output_path, settings, resume):
+        """Reads or creates the manifest of completed output files.
+
+        Args:
+            output_path: Folder that contains the joined index files.
+            settings: Dictionary of engine-specific settings that must
+                match for a join to be resumed.
+            resume: If False, a new, empty manifest is created.
+
+        Returns: The manifest dictionary. Raises ValueError if resume is
+        True and the existing manifest was created from different
+        inputs or join settings.
+        """
+        settings = dict(settings,
+                        join_engine=self.join_engine,
+                        join_type=self.join_type,
+                        join_args=self.join_args,
+                        output_format=self.output_format,
+                        inputs=_files_fingerprint(
+                            itertools.chain(*self.idx_files)))
+        # Round trip through JSON so that tuples compare equal to lists.
+        settings = json.loads(json.dumps(settings))
+        manifest_path = os.path.join(output_path, MANIFEST_NAME)
+        if resume and os.path.isfile(manifest_path):
+            with open(manifest_path) as mfile:
+                manifest = json.load(mfile)
+            if manifest['settings'] != settings:
+                raise ValueError(
+                    '{} was created with different inputs or join settings. '
+                    'Use a new output folder, or pass resume=False to '
+                    'start over.'.format(manifest_path))
+            # Output files that were deleted are joined again.
+            for shard_name in list(manifest['shards']):
+                if not os.path.isfile(os.path.join(output_path, shard_name)):
+                    del manifest['shards'][shard_name]
+                    manifest['complete'] = False
+            print('Resuming join. {} output files are complete.'
+                  .format(len(manifest['shards'])))
+            return manifest
+        manifest = {'settings': settings, 'shards': {}, 'complete': False}
+        self._save_manifest(output_path, manifest)
+        return manifest
+
+    def _save_manifest(self, output_path, manifest):
+        """Saves the manifest of completed output files."""
+        _write_json_atomic(os.path.join(output_path, MANIFEST_NAME), manifest)
+
+    def _record_shard(self, output_path, manifest, shard_name, shard_info):
+        """Adds a completed output file to the manifest."""
+        manifest['shards'][shard_name] = shard_info
+        self._save_manifest(output_path, manifest)
+
+    def _join_file(self, idx, output_path, batch_size, show_progress=True,
+                   resume=True):
+        """Joins the documents in one index 0 file with index 1.
+
+        The joined file is written with a _ShardWriter, which saves a
+        checkpoint after every batch. If the file has a checkpoint from
+        an interrupted join, joining continues from the checkpoint.
+
+        Args:
+            idx: Position of the file in the list of index 0 files.
+            output_path: Folder in which the joined file is written.
+            batch_size: See join_indexes().
+            show_progress: If True, displays a progress bar.
+            resume: If False, any checkpoint is ignored.
+
+        Returns: A tuple containing the file name, the number of
+        documents joined, the elapsed time in seconds, and the
+        _ShardWriter.finish() information for the joined file.
+        """
+        start_time = time.time()
+        if self.indexes is None:  # Reopen indexes in worker processes
+            self.indexes = self._get_indexes()
+        ifile = self.idx_files[0][idx]
+        ifilename = os.path.split(ifile)[1]
+        file_len = self.indexes[0].shard_len(idx)
+        num_docs = 0
+        with    open(ifile, 'rb') as idxfile, \
+                _ShardWriter(os.path.join(output_path, ifilename),
+                             resume=resume) as ofile, \
+                tqdm(desc=ifilename, total=file_len, initial=ofile.records,
+                     disable=not show_progress) as pbar:
+            idxfile.seek(ofile.input_offset)
+            while True:
+                lines = list(itertools.islice(idxfile, batch_size))
+                if not lines:
+                    break
+                doc1_batch = [util.codec.loads(line) for line in lines]
+                doc2_txts = self.get_docs(
+                    1, [doc1_data['id'] for doc1_data in doc1_batch])
+                doc2_batch = []
+                for doc2_txt in doc2_txts:
+                    try:
+                        doc2_batch.append(util.codec.loads(doc2_txt))
+                    except util.codec.DecodeError:
+                        doc2_batch.append(None)
+                for joined_doc_data in self._join_batch([doc1_batch,
+                                                         doc2_batch]):
+                    ofile.write(util.codec.dumps_line(joined_doc_data))
+                ofile.commit(idxfile.tell())
+                num_docs += len(lines)
+                pbar.update(len(lines))
+            shard_info = ofile.finish()
+        return ifilename, num_docs, time.time() - start_time, shard_info
+
+    def _join_batch(self, batches):
+        """Joins a batch of documents with the current join method.
+
+        If the IndexJoiner was created with vectorized=True and the
+        join method has a kernel in TRESPI.vectorized, the whole batch
+        is joined with NumPy. Otherwise the join method is called for
+        each document.
+
+        Args:
+            batches: List with one list of index records for each
+                index. The lists have equal lengths, and the records at
+                the same position are for the same document, with None
+                for missing records.
+
+        Returns: A list of joined index records.
+        """
+        join_type = self.join_docs_method.__name__
+        # Summed 'contents' strings are simply concatenated, which is
+        # faster than any kernel.
+        use_kernel = (self.vectorized
+                      and join_type in TRESPI.vectorized.JOIN_KERNELS
+                      and not (join_type == 'join_docs_sum_weights'
+                               and self.output_format == 'contents'))
+        if not use_kernel:
+            return [self.join_docs_method(*docs_data)
+                    for docs_data in zip(*batches)]
+        doc0_batch, doc1_batch = batches
+        vocab = self._vocab
+        joined = TRESPI.vectorized.join_encoded(
+            TRESPI.vectorized.encode_records(doc0_batch, vocab),
+            TRESPI.vectorized.encode_records(doc1_batch, vocab),
+            join_type, (self.join_args or {}).get('qry_discount', 1.0), vocab)
+        doc_ids = [self._get_doc_id(doc0_data, doc1_data)
+                   for doc0_data, doc1_data in zip(doc0_batch, doc1_batch)]
+        if self.output_format == 'contents':
+            # Expand the arrays directly, without per-document dicts.
+            contents = TRESPI.vectorized.decode_contents(
+                joined, len(doc_ids), vocab)
+            return [{'id': doc_id, 'contents': doc_contents}
+                    for doc_id, doc_contents in zip(doc_ids, contents)]
+        joined_weights = TRESPI.vectorized.decode_weights(
+            joined, len(doc_ids), vocab)
+        return [self._make_record(doc_id, doc_weights)
+                for doc_id, doc_weights in zip(doc_ids, joined_weights)]
+
+    def __getstate__(self):
+        """Excludes open file indexes when sent to worker processes."""
+        state = self.__dict__.copy()
+        if 'indexes' in state:
+            state['indexes'] = None
+        return state
+
+    def join_indexes_sort_merge(self, output_path, docs_per_file=100_000,
+                                max_run_bytes=256_000_000, tmp_path=None,
+                                batch_size=10_000, resume=True):
+        """Joins the two input indexes with a streaming sort-merge join.
+
+        Both indexes are sorted by document ID with an external merge
+        sort, then merged in a single sequential pass. Documents that
+        appear in both indexes are joined, and documents that appear in
+        only one index are passed to the join method with None in place
+        of the missing document. Memory use is bounded by max_run_bytes
+        per index, regardless of the size of the indexes.
+
+        Do not call this method until after a join type has been
+        specified with IndexJoiner.set_join_type().
+
+        An interrupted join is resumed as described in join_indexes().
+        The indexes are sorted again, but completed output files are
+        skipped, and the merged documents before the last checkpoint
+        are counted without being joined or written.
+
+        Args:
+            output_path: The file location where the joined index files
+                will be written. Files are named joined_NNN.json.
+            docs_per_file: Number of documents in each output file.
+                Optional, defaults to 100,000.
+            max_run_bytes: Maximum number of bytes of documents from
+                each index that are sorted in memory at one time.
+                Optional, defaults to 256,000,000.
+            tmp_path: Folder in which temporary sorted run files are
+                written. Optional, defaults to output_path.
+            batch_size: Number of merged documents that are joined at
+                one time. Optional, defaults to 10,000.
+            resume: See join_indexes(). Optional, defaults to True.
+        """
+        manifest = self._open_manifest(
+            output_path, {'docs_per_file': docs_per_file}, resume)
+        if manifest['complete']:
+            print('The join in', output_path, 'is already complete.')
+            return
+        print('Joining Indexes using sort-merge join and {}'
+              .format(self.join_docs_method))
+        print('Join arguments:', self.join_args)
+        print('Start Time:', datetime.datetime.now())
+
+        def shard_name(file_num):
+            return 'joined_{:03}.json'.format(file_num)
+
+        def count_docs(lines):
+            present = [idx for idx, line in enumerate(lines)
+                       if line is not None]
+            if len(present) == len(lines):
+                counts['joined'] += 1
+            elif len(present) == 1:
+                counts[present[0]] += 1
+            else:
+                counts['partial'] += 1
+
+        # Output files are written in order, so resume after the last
+        # consecutive completed file.
+        file_num = 0
+        while shard_name(file_num) in manifest['shards']:
+            file_num += 1
+        counts = collections.Counter()
+        ofile = _ShardWriter(os.path.join(output_path, shard_name(file_num)),
+                             file_num * docs_per_file, resume)
+        with tempfile.TemporaryDirectory(
+                dir=tmp_path if tmp_path is not None else output_path
+                ) as run_path:
+            sorted_streams = [_sorted_docs(file_paths, run_path, max_run_bytes)
+                              for file_paths in self.idx_files]
+            # A single iterator, so that tqdm's progress bar is not
+            # restarted and closed for every batch.
+            merged_docs = iter(tqdm(_merge_sorted_docs(sorted_streams),
+                                    'Docs Joined'))
+            doc_num = ofile.input_offset
+            if doc_num:
+                print('Skipping {:,} documents that were already joined.'
+                      .format(doc_num))
+            for lines in itertools.islice(merged_docs, doc_num):
+                count_docs(lines)
+            try:
+                while True:
+                    batch = list(itertools.islice(merged_docs, batch_size))
+                    if not batch:
+                        break
+                    batches = [[] for _ in self.idx_files]
+                    for lines in batch:
+                        count_docs(lines)
+                        for docs, line in zip(batches, lines):
+                            docs.append(util.codec.loads(line)
+                                        if line is not None else None)
+                    for joined_doc_data in self._join_batch(batches):
+                        if doc_num == (file_num + 1) * docs_per_file:
+                            self._record_shard(output_path, manifest,
+                                               shard_name(file_num),
+                                               ofile.finish())
+                            file_num += 1
+                            ofile = _ShardWriter(
+                                os.path.join(output_path,
+                                             shard_name(file_num)),
+                                doc_num, resume=False)
+                        ofile.write(util.codec.dumps_line(joined_doc_data))
+                        doc_num += 1
+                    ofile.commit(doc_num)
+                if ofile.records:
+                    self._record_shard(output_path, manifest,
+                                       shard_name(file_num), ofile.finish())
+                else:
+                    ofile.discard()
+            finally:
+                ofile.close()
+        manifest['complete'] = True
+        self._save_manifest(output_path, manifest)
+        print('Documents in all indexes:', counts['joined'])
+        for idx in range(len(self.idx_files)):
+            print('Documents only in index {}:'.format(idx), counts[idx])
+        if len(self.idx_files) > 2:
+            print('Documents in some indexes:', counts['partial'])
         print('Index join complete.')
         print('Stop Time:', datetime.datetime.now())
 
@@ -239,73 +905,78 @@ class IndexJoiner():
         does not exist in the specified index.
         """
         self._check_idx(idx)
-        for doc_idx in self.file_indexes[idx]:
-            try:
-                doc = doc_idx[doc_id]
-            except KeyError:
-                continue
-            else:
-                return doc
-        return ''
+        try:
+            return self.indexes[idx][doc_id]
+        except KeyError:
+            return ''
 
-    def _get_mismatched_docs(self, idx):
-        """Get list of documents that appear in only one input index.
+    def get_docs(self, idx, doc_ids):
+        """Retrieves several documents with batched reads.
 
         Args:
-            idx: Integer, either 0 or 1. If 0, returns list of document
-                IDs that appear in index 0 but not in index 1. If 1,
-                returns list of document IDs that appear in index 1, but
-                not in index 0.
+            idx: Specifies from which index the documents should be
+                retrieved. Either 0 or 1.
+            doc_ids: List of document ID strings.
+
+        Returns: A list with one line of JSON text per document ID, in
+        the same order as doc_ids. The list contains an empty string
+        for every document that does not exist in the specified index.
         """
         self._check_idx(idx)
-        other_idx = (idx + 1) % 2
-        print('Identifying doc_ids in index',
-                '{} that are not in index {}'.format(idx, other_idx))
-        ids = self._get_ids(idx)
-        ids_other = self._get_ids(other_idx)
-        return list(ids.difference(ids_other))
+        return [doc if doc is not None else ''
+                for doc in self.indexes[idx].get_many(doc_ids,
+                                                      missing='none')]
 
-    def _get_file_indexes(self):
-        """Creates an IndexedFile objects for each input file.
+    def _get_mismatched_docs(self):
+        """Gets lists of documents that appear in only one input index.
 
-        Returns:
-        A nested list structured as so:
-        [
-            [idx0_file0, idx0_file1, ..., idx0_file_m]
-            [idx1_file0, idx1_file1, ..., idx1_file_n]
-        ]
-        m and n are the number of files in input index 0 and input index
-        1 respectively.
-        """
-        return [[util.indexer.IndexedFile(fpath, 'id', line_idx=True)
-                 for fpath in flist]
-                for flist in self.idx_files]
+        The collection index of each input index contains a sorted
+        array of all document IDs, so the two arrays are compared with
+        a single linear merge, without reading the input files.
 
-    def _get_ids(self, idx):
-        """Gets a list of all document ID values for a given index.
+        Returns: A tuple of two lists. The first list contains the
+        document IDs that appear in index 0 but not in index 1, and the
+        second contains the document IDs that appear in index 1 but not
+        in index 0.
+        """
+        print('Comparing document IDs in index 0 and index 1')
+        only_ids = ([], [])
+        keys0, keys1 = [index.sorted_keys() for index in self.indexes]
+        key1 = next(keys1, None)
+        for key0 in tqdm(keys0, total=len(self.indexes[0])):
+            while key1 is not None and key1 < key0:
+                only_ids[1].append(key1)
+                key1 = next(keys1, None)
+            if key1 == key0:
+                key1 = next(keys1, None)
+            else:
+                only_ids[0].append(key0)
+        if key1 is not None:
+            only_ids[1].append(key1)
+            only_ids[1].extend(keys1)
+        return tuple([doc_id.decode('utf-8') for doc_id in ids]
+                     for ids in only_ids)
 
-        Args:
-            idx: 0 or 1
+    def _get_indexes(self):
+        """Creates an IndexedCollection object for each input index.
 
-        Returns all document IDs in the input index specified by the idx
-        argument.
+        Returns:
+        A list with one util.indexer.IndexedCollection per input index.
+        Each collection contains all JSON files in the index's folder,
+        so any document can be retrieved with a single lookup,
+        regardless of the file it is stored in.
         """
-        self._check_idx(idx)
-        print('Reading IDs from index', idx)
-        id_set = set()
-        for file in self.idx_files[idx]:
-            with open(file) as jfile:
-                for line in tqdm(jfile, file):
-                    data = json.loads(line)
-                    id_set.add(data['id'])
-        return id_set
+        return [util.indexer.IndexedCollection(idx_path, 'id',
+                                               suffix='.json',
+                                               workers=self.index_workers)
+                for idx_path in self.idx_paths]
 
     def _check_idx(self, idx):
         """ Raises error if index value is not 0 or 1.
         """
         assert idx in list(range(len(self.idx_paths)))
 
-    def _add_missing_docs(self, output_path):
+    def _add_missing_docs(self, output_path, batch_size=10_000):
         """Adds mismatched documents to joined index.
 
         Index entries for mismatched documents will be saved in a file
@@ -314,76 +985,95 @@ class IndexJoiner():
         Args:
             ouput_path: filesystem locatin where combined index entries
                 will be saved.
+            batch_size: Number of documents read from index 1 with each
+                get_docs() call, so memory use does not depend on the
+                number of mismatched documents.
+
+        Returns: The _ShardWriter.finish() information for the file.
         """
         print('Iterating through documents in index 1 that are not in index 0.')
-        with open(os.path.join(output_path, 'docs_mismatched.json'), 'wt') as ofile:
-            for doc_id in tqdm(self.join_data['idx1_only_ids']):
-                doc_txt = self.get_doc(1, doc_id)
-                try:
-                    doc_data = json.loads(doc_txt)
-                except json.JSONDecodeError:
-                    continue
-                processed_doc_data = self.join_docs_method(None, doc_data)
-                ofile.write(json.dumps(processed_doc_data) + '\n')
+        idx1_only_ids = self.join_data['idx1_only_ids']
+        with _ShardWriter(os.path.join(output_path, 'docs_mismatched.json'),
+                          resume=False) as ofile, \
+                tqdm(total=len(idx1_only_ids)) as pbar:
+            for start in range(0, len(idx1_only_ids), batch_size):
+                doc_txts = self.get_docs(
+                    1, idx1_only_ids[start:start + batch_size])
+                for doc_txt in doc_txts:
+                    try:
+                        doc_data = util.codec.loads(doc_txt)
+                    except util.codec.DecodeError:
+                        continue
+                    processed_doc_data = self.join_docs_method(None,
+                                                               doc_data)
+                    ofile.write(util.codec.dumps_line(processed_doc_data))
+                pbar.update(len(doc_txts))
+            return ofile.finish()
 
     def _get_weights(self, doc_data):
         """Extracts term weights from index entry.
 
         Args:
-            doc_data: A dictionary with two keys, 'id', and 'contents'.
-                'id' contains the document ID and 'contents' contains
-                a text string with term separated by spaces. Each term
-                is repeated w times, where w is the term's weight.
+            doc_data: An index record with an 'id' key and either a
+                'contents' or a 'vector' key (see TRESPI.weights), or
+                None if the document is missing from an index.
 
         Returns:
-            A Python dictionary with two keys: 'id' and 'weights'. The
-            'id' value is the document ID and the 'weights' value is
-            another Python dictionary with a key for every term and
-            term weights for the values.
+            A Python dictionary with a key for every term and term
+            weights for the values. The dictionary is empty if
+            doc_data is None.
         """
-        return {'id': doc_data['id'],
-                'weights': collections.Counter(doc_data['contents'].split())}
+        if doc_data is None:
+            return {}
+        return TRESPI.weights.get_weights(doc_data)
 
-    def _compare_terms(self, doc0_weights, doc1_weights):
-        """Compares the terms in two different index records.
+    def _get_doc_id(self, *docs_data):
+        """Returns the document ID shared by several index records.
 
-        Args:
-            doc0_weights, doc1_weights: Python dictionary containing
-            term weights (see docstring for ._get_weights() for more
-            info).
+        Any record except one may be None. Raises an AssertionError if
+        the document IDs don't match.
         """
-        assert doc0_weights['id'] == doc1_weights['id']
-        doc0_terms = frozenset(doc0_weights['weights'].keys())
-        doc1_terms = frozenset(doc1_weights['weights'].keys())
-        doc0_only_terms = doc0_terms - doc1_terms
-        doc1_only_terms = doc1_terms - doc0_terms
-        common_terms = doc0_terms & doc1_terms
-        return {'id': doc0_weights['id'],
-                'doc0_terms': doc0_terms,
-                'doc1_terms': doc1_terms,
-                'doc0_only_terms': doc0_only_terms,
-                'doc1_only_terms': doc1_only_terms,
-                'common_terms': common_terms}
-
-    def _expand_weights(self, doc_weights):
+        doc_ids = {doc_data['id'] for doc_data in docs_data
+                   if doc_data is not None}
+        assert len(doc_ids) == 1
+        return doc_ids.pop()
+
+    def _make_record(self, doc_id, doc_weights):
         """Converts document weights to an index record.
 
         Args:
-            doc_weights: Python dictionary containing
-            term weights (see docstring for ._get_weights() for more
-            info).
+            doc_id: The document ID.
+            doc_weights: Python dictionary of {term: weight}.
 
         Returns:
-            A document index record, consisting of a Python dictionary
-            with 'id' and 'contents' keys. The contents consists of a
-            single string with each separated by spaces and repeated
-            according to it's weight.
+            A document index record in the format selected by the
+            constructor's `output_format` argument.
         """
-        terms_array = [[term] * weight
-                       for term, weight in doc_weights['weights'].items()]
-        terms_list = [term for term_list in terms_array for term in term_list]
-        contents = ' '.join(terms_list)
-        return {'id': doc_weights['id'], 'contents': contents}
+        return TRESPI.weights.make_record(doc_id, doc_weights,
+                                          self.output_format)
+
+    def fuse_docs(self, *docs_data):
+        """Join method that fuses any number of indexes.
+
+        Selected by passing the name of a fusion function in
+        TRESPI.fusion.FUSION_FUNCTIONS to set_join_type().
+
+        Args:
+            docs_data: One index record for each index, all for the same
+                document, with None for missing records. Raises an
+                AssertionError if the document IDs don't match.
+
+        Returns:
+            An index record with the weights returned by the fusion
+            function.
+        """
+        doc_id = self._get_doc_id(*docs_data)
+        fusion_args = dict(self.join_args)
+        discounts = fusion_args.pop('discounts')
+        doc_weights = [self._get_weights(doc_data) for doc_data in docs_data]
+        return self._make_record(doc_id,
+                                 self._fusion(doc_weights, discounts,
+                                              **fusion_args))
 
     def join_docs_sum_weights(self, doc0_data, doc1_data):
         """Join method that sums weights from both input indexes.
@@ -392,8 +1082,8 @@ class IndexJoiner():
 
         Args:
             doc0_data, doc1_data: Index records for a single doucment,
-            both of which have 'id' and 'contents' keys. Raises an
-            AssertionError if the document IDs don't match.
+            both of which have 'id' and 'contents' or 'vector' keys.
+            Raises an AssertionError if the document IDs don't match.
 
         Returns:
             An index record, with terms combined as such:
@@ -402,11 +1092,17 @@ class IndexJoiner():
               * Term appears in both input indexes: The sum of the two
               term weights.
         """
-        if doc1_data is None:
-            doc1_data = {'id': doc0_data['id'], 'contents': ''}
-        assert doc0_data['id'] == doc1_data['id']
-        return {'id': doc0_data['id'],
-                'contents': doc0_data['contents'] + ' ' + doc1_data['contents']}
+        doc_id = self._get_doc_id(doc0_data, doc1_data)
+        docs = [doc for doc in (doc0_data, doc1_data) if doc is not None]
+        if (self.output_format == 'contents'
+                and all('contents' in doc for doc in docs)):
+            # Repeated terms add up, so the strings can be concatenated.
+            return {'id': doc_id,
+                    'contents': ' '.join(doc['contents'] for doc in docs)}
+        joined_weights = collections.Counter()
+        for doc in docs:
+            joined_weights.update(self._get_weights(doc))
+        return self._make_record(doc_id, joined_weights)
 
     def join_docs_avg_weights_qry_discount(self, doc0_data, doc1_data):
         """Join method that averages weights from both indexes.
@@ -424,8 +1120,8 @@ class IndexJoiner():
 
         Args:
             doc0_data, doc1_data: Index records for a single doucment,
-            both of which have 'id' and 'contents' keys. Raises an
-            AssertionError if the document IDs don't match.
+            both of which have 'id' and 'contents' or 'vector' keys.
+            Raises an AssertionError if the document IDs don't match.
 
         Returns:
             An index record, with terms combined as such:
@@ -434,31 +1130,21 @@ class IndexJoiner():
               * Term appears in both input indexes: The sum of the two
               term weights.
         """
-        # Check for missing document
-        if doc0_data is None:
-            doc0_data = {'id': doc1_data['id'], 'contents': ''}
-        if doc1_data is None:
-            doc1_data = {'id': doc0_data['id'], 'contents': ''}
-        assert doc0_data['id'] == doc1_data['id']
-
-        # Calculate and compare term weights
+        doc_id = self._get_doc_id(doc0_data, doc1_data)
         doc0_weights = self._get_weights(doc0_data)
         doc1_weights = self._get_weights(doc1_data)
-        term_data = self._compare_terms(doc0_weights, doc1_weights)
 
-        # Calculate new term weights
-        joined_weights = {'id': doc0_data['id'], 'weights': {}}
+        # Terms only in index 0 keep their weights.
+        joined_weights = dict(doc0_weights)
         qry_discount = self.join_args['qry_discount']
-        for term in term_data['common_terms']:
-            weight = round((doc0_weights['weights'][term] +
-                           qry_discount * doc1_weights['weights'][term]) / 2)
-            joined_weights['weights'][term] = int(max(weight, 1))
-        for term in term_data['doc0_only_terms']:
-            joined_weights['weights'][term] = doc0_weights['weights'][term]
-        for term in term_data['doc1_only_terms']:
-            weight = round(qry_discount * doc1_weights['weights'][term])
-            joined_weights['weights'][term] = int(max(weight, 1))
-        return self._expand_weights(joined_weights)
+        for term, weight1 in doc1_weights.items():
+            weight0 = doc0_weights.get(term)
+            if weight0 is None:
+                weight = round(qry_discount * weight1)
+            else:
+                weight = round((weight0 + qry_discount * weight1) / 2)
+            joined_weights[term] = int(max(weight, 1))
+        return self._make_record(doc_id, joined_weights)
 
     def join_docs_max_weights_qry_discount(self, doc0_data, doc1_data):
         """Join method that takes the maximum weight.
@@ -476,8 +1162,8 @@ class IndexJoiner():
 
         Args:
             doc0_data, doc1_data: Index records for a single doucment,
-            both of which have 'id' and 'contents' keys. Raises an
-            AssertionError if the document IDs don't match.
+            both of which have 'id' and 'contents' or 'vector' keys.
+            Raises an AssertionError if the document IDs don't match.
 
         Returns:
             An index record, with terms combined as such:
@@ -486,31 +1172,18 @@ class IndexJoiner():
                 * Term appears in both input indexes: The sum of the two
                 term weights.
         """
-        # Check for missing input
-        if doc0_data is None:
-            doc0_data = {'id': doc1_data['id'], 'contents': ''}
-        if doc1_data is None:
-            doc1_data = {'id': doc0_data['id'], 'contents': ''}
-        assert doc0_data['id'] == doc1_data['id']
-
-        # Calculate and compare term weights
+        doc_id = self._get_doc_id(doc0_data, doc1_data)
         doc0_weights = self._get_weights(doc0_data)
         doc1_weights = self._get_weights(doc1_data)
-        term_data = self._compare_terms(doc0_weights, doc1_weights)
 
-        # Calculate new term weights.
-        joined_weights = {'id': doc0_data['id'], 'weights': {}}
+        # Terms only in index 0 keep their weights.
+        joined_weights = dict(doc0_weights)
         qry_discount = self.join_args['qry_discount']
-        for term in term_data['common_terms']:
-            weight = round(max(doc0_weights['weights'][term], 
-                           qry_discount * doc1_weights['weights'][term]))
-            joined_weights['weights'][term] = int(max(weight, 1))
-        for term in term_data['doc0_only_terms']:
-            joined_weights['weights'][term] = doc0_weights['weights'][term]
-        for term in term_data['doc1_only_terms']:
-            weight = round(qry_discount * doc1_weights['weights'][term])
-            joined_weights['weights'][term] = int(max(weight, 1))
-        return self._expand_weights(joined_weights)
-
-       
-
+        for term, weight1 in doc1_weights.items():
+            weight0 = doc0_weights.get(term)
+            if weight0 is None:
+                weight = round(qry_discount * weight1)
+            else:
+                weight = round(max(weight0, qry_discount * weight1))
+            joined_weights[term] = int(max(weight, 1))
+        return self._make_record(doc_id, joined_weights)
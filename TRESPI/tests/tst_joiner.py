@@ -0,0 +1,192 @@
+import collections
+import filecmp
+import json
+import os
+import os.path
+import random
+import sys
+
+import pytest
+
+# Run test from the repository folder
+sys.path.insert(0, os.path.abspath('.'))
+import TRESPI.joiner as joiner
+
+JOIN_TYPES = ['join_docs_sum_weights',
+              'join_docs_avg_weights_qry_discount',
+              'join_docs_max_weights_qry_discount']
+
+
+def _write_index(idx_path, docs, num_files=3):
+    """Writes {doc_id: {term: weight}} as DeepCT style JSONL files."""
+    os.makedirs(idx_path)
+    doc_ids = list(docs)
+    for file_num in range(num_files):
+        with open(os.path.join(idx_path, f'docs{file_num:02}.json'),
+                  'wt') as jfile:
+            for doc_id in doc_ids[file_num::num_files]:
+                contents = ' '.join(' '.join([term] * weight)
+                                    for term, weight in docs[doc_id].items())
+                jfile.write(json.dumps({'id': doc_id,
+                                        'contents': contents}) + '\n')
+
+
+def _random_indexes(tmp_path, num_indexes=2, num_docs=120):
+    """Writes indexes with overlapping, shuffled document IDs."""
+    rng = random.Random(7)
+    idx_paths = []
+    for idx in range(num_indexes):
+        doc_ids = [f'D{num}' for num in range(num_docs)
+                   if rng.random() < 0.85]
+        rng.shuffle(doc_ids)
+        docs = {doc_id: {f'w{rng.randrange(30)}': rng.randint(1, 9)
+                         for _ in range(6)}
+                for doc_id in doc_ids}
+        idx_paths.append(str(tmp_path / f'idx{idx}'))
+        _write_index(idx_paths[-1], docs)
+    return idx_paths
+
+
+def _read_output(output_path):
+    """Reads joined records into {doc_id: {term: weight}}."""
+    results = {}
+    for fname in sorted(os.listdir(output_path)):
+        if not fname.endswith('.json'):
+            continue
+        with open(os.path.join(output_path, fname)) as jfile:
+            for line in jfile:
+                record = json.loads(line)
+                assert record['id'] not in results
+                results[record['id']] = dict(
+                    collections.Counter(record['contents'].split()))
+    return results
+
+
+def _join(tmp_path, idx_paths, name, join_type, join_args, **kwargs):
+    """Joins the indexes into tmp_path/name and returns the folder."""
+    output_path = str(tmp_path / name)
+    os.makedirs(output_path, exist_ok=True)
+    join_kwargs = {key: kwargs.pop(key) for key in ['batch_size', 'workers']
+                   if key in kwargs}
+    jnr = joiner.IndexJoiner(idx_paths, str(tmp_path / 'join_data.json'),
+                             **kwargs)
+    jnr.set_join_type(join_type, join_args)
+    jnr.join_indexes(output_path, docs_per_file=40, **join_kwargs)
+    return output_path
+
+
+@pytest.mark.parametrize('join_type', JOIN_TYPES)
+def test_engines_match(tmp_path, join_type):
+    idx_paths = _random_indexes(tmp_path)
+    join_args = {'qry_discount': 0.7}
+    expected = _read_output(_join(tmp_path, idx_paths, 'ref', join_type,
+                                  join_args))
+    assert len(expected) == len(
+        set(_read_output(idx_paths[0])) | set(_read_output(idx_paths[1])))
+    for engine in joiner.JOIN_ENGINES:
+        for vectorized in [False, True]:
+            for workers in [1, 2]:
+                name = f'{engine}_{vectorized}_{workers}'
+                output_path = _join(tmp_path, idx_paths, name, join_type,
+                                    join_args, batch_size=17,
+                                    workers=workers, join_engine=engine,
+                                    vectorized=vectorized)
+                assert _read_output(output_path) == expected, name
+
+
+def test_max_weights(tmp_path):
+    idx_paths = [str(tmp_path / 'idx0'), str(tmp_path / 'idx1')]
+    _write_index(idx_paths[0], {'D1': {'a': 4, 'b': 1}, 'D2': {'a': 2}}, 1)
+    _write_index(idx_paths[1], {'D1': {'a': 5, 'b': 5, 'c': 1},
+                                'D3': {'c': 6}}, 1)
+    for engine in joiner.JOIN_ENGINES:
+        output_path = _join(tmp_path, idx_paths, engine,
+                            'join_docs_max_weights_qry_discount',
+                            {'qry_discount': 0.5}, join_engine=engine)
+        assert _read_output(output_path) == {
+            'D1': {'a': 4, 'b': 2, 'c': 1}, 'D2': {'a': 2}, 'D3': {'c': 3}}
+
+
+@pytest.mark.parametrize('engine', joiner.JOIN_ENGINES)
+def test_resume(tmp_path, engine):
+    idx_paths = _random_indexes(tmp_path)
+    join_type, join_args = JOIN_TYPES[2], {'qry_discount': 0.7}
+    ref_path = _join(tmp_path, idx_paths, 'ref', join_type, join_args,
+                     batch_size=10, join_engine=engine)
+
+    output_path = str(tmp_path / 'resumed')
+    os.makedirs(output_path)
+    jnr = joiner.IndexJoiner(idx_paths, str(tmp_path / 'join_data.json'),
+                             join_engine=engine)
+    jnr.set_join_type(join_type, join_args)
+    join_batch = jnr._join_batch
+    calls = []
+
+    def interrupted_join_batch(batches):
+        calls.append(len(batches))
+        if len(calls) == 6:  # Interrupt partway through a file
+            raise KeyboardInterrupt
+        return join_batch(batches)
+    jnr._join_batch = interrupted_join_batch
+    with pytest.raises(KeyboardInterrupt):
+        jnr.join_indexes(output_path, batch_size=10, docs_per_file=40)
+    assert any(fname.endswith('.checkpoint')
+               for fname in os.listdir(output_path))
+    for fname in os.listdir(output_path):  # Writes after the checkpoint
+        if fname.endswith('.json.tmp'):
+            with open(os.path.join(output_path, fname), 'at') as tfile:
+                tfile.write('{"id": "partial"\n')
+
+    jnr._join_batch = join_batch
+    jnr.join_indexes(output_path, batch_size=10, docs_per_file=40)
+    ref_files = sorted(fname for fname in os.listdir(ref_path)
+                       if fname.endswith('.json'))
+    assert ref_files == sorted(fname for fname in os.listdir(output_path)
+                               if fname.endswith('.json'))
+    for fname in ref_files:
+        assert filecmp.cmp(os.path.join(ref_path, fname),
+                           os.path.join(output_path, fname), shallow=False)
+    with open(os.path.join(output_path, joiner.MANIFEST_NAME)) as mfile:
+        assert json.load(mfile)['complete']
+
+
+def _fusion_indexes(tmp_path):
+    idx_paths = [str(tmp_path / f'idx{idx}') for idx in range(3)]
+    _write_index(idx_paths[0], {'D1': {'x': 3, 'y': 1}}, 1)
+    _write_index(idx_paths[1], {'D1': {'x': 1, 'y': 2}}, 1)
+    _write_index(idx_paths[2], {'D1': {'z': 5}, 'D2': {'q': 2}}, 1)
+    return idx_paths
+
+
+def test_fusion_n_way(tmp_path):
+    idx_paths = _fusion_indexes(tmp_path)
+    expected = {
+        'sum': {'D1': {'x': 3, 'y': 2, 'z': 10}, 'D2': {'q': 4}},
+        'avg': {'D1': {'x': 2, 'y': 1, 'z': 10}, 'D2': {'q': 4}},
+        'max': {'D1': {'x': 3, 'y': 1, 'z': 10}, 'D2': {'q': 4}}}
+    for fusion_name, fused in expected.items():
+        for vectorized in [False, True]:
+            output_path = _join(tmp_path, idx_paths,
+                                f'{fusion_name}_{vectorized}', fusion_name,
+                                {'discounts': [1.0, 0.4, 2.0]},
+                                join_engine='sort_merge',
+                                vectorized=vectorized)
+            assert _read_output(output_path) == fused, fusion_name
+
+
+def test_fusion_rrf(tmp_path):
+    idx_paths = _fusion_indexes(tmp_path)
+    output_path = _join(tmp_path, idx_paths, 'rrf', 'rrf', {},
+                        join_engine='sort_merge')
+    # x is ranked 1 in index 0 and 2 in index 1, y the other way round
+    both = round(1000 * (1 / 61 + 1 / 62))
+    assert _read_output(output_path) == {
+        'D1': {'x': both, 'y': both, 'z': round(1000 / 61)},
+        'D2': {'q': round(1000 / 61)}}
+    output_path = _join(tmp_path, idx_paths, 'rrf_k', 'rrf',
+                        {'k': 1, 'scale': 10, 'discounts': [1.0, 1.0, 0.5]},
+                        join_engine='sort_merge')
+    assert _read_output(output_path) == {
+        'D1': {'x': round(10 * (1 / 2 + 1 / 3)),
+               'y': round(10 * (1 / 3 + 1 / 2)), 'z': round(5 / 2)},
+        'D2': {'q': round(5 / 2)}}
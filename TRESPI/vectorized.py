@@ -0,0 +1,261 @@
+"""Vectorized NumPy kernels for joining term weights.
+
+The join methods in TRESPI.joiner.IndexJoiner combine term weights one
+term at a time in Python. The kernels in this module join a whole
+batch of documents at once. Terms are mapped to integer IDs with a
+shared Vocabulary, and the batch is encoded as parallel doc_nums,
+term_ids and weights arrays. Repeated-term 'contents' strings are
+encoded directly, without building a dictionary for each document.
+Combining each document number and term ID into a composite key,
+`doc_num * len(vocab) + term_id`, lets a single call to numpy.unique
+find the sorted union of terms for every pair of documents in the
+batch, and the discounted averages, maximums and clamping are computed
+with array operations.
+
+numpy.rint rounds halves to the nearest even number, exactly as
+Python's round() does, so the kernels return the same weights as the
+IndexJoiner join methods.
+
+Typical Usage Example:
+import TRESPI.vectorized as vectorized
+vocab = vectorized.Vocabulary()
+joined = vectorized.join_batch(doc0_weights, doc1_weights,
+                               'join_docs_max_weights_qry_discount',
+                               qry_discount=0.8, vocab=vocab)
+"""
+
+import itertools
+
+import numpy as np
+
+import TRESPI.weights
+
+# Maps IndexJoiner join method names to kernels.
+JOIN_KERNELS = {}
+
+
+def _kernel(join_type):
+    """Decorator that registers a kernel for an IndexJoiner join method."""
+    def register(func):
+        JOIN_KERNELS[join_type] = func
+        return func
+    return register
+
+
+@_kernel('join_docs_sum_weights')
+def _sum_weights(weights0, weights1, in0, in1, qry_discount):
+    return weights0 + weights1
+
+
+@_kernel('join_docs_avg_weights_qry_discount')
+def _avg_weights(weights0, weights1, in0, in1, qry_discount):
+    weights1 = qry_discount * weights1
+    joined = np.where(in0, (weights0 + weights1) / 2, weights1)
+    return np.where(in1, np.maximum(np.rint(joined), 1), weights0)
+
+
+@_kernel('join_docs_max_weights_qry_discount')
+def _max_weights(weights0, weights1, in0, in1, qry_discount):
+    weights1 = qry_discount * weights1
+    joined = np.where(in0, np.maximum(weights0, weights1), weights1)
+    return np.where(in1, np.maximum(np.rint(joined), 1), weights0)
+
+
+class Vocabulary:
+    """Maps terms to consecutive integer term IDs.
+
+    Terms are added the first time they are encoded, so the same
+    Vocabulary can be shared by every batch in a join.
+    """
+
+    def __init__(self):
+        self.term_ids = {}
+        self.terms = []
+
+    def __len__(self):
+        return len(self.terms)
+
+    def encode(self, terms):
+        """Returns an int64 array of term IDs, adding new terms as needed.
+
+        Args:
+            terms: A list of terms.
+        """
+        term_ids = self.term_ids
+        for term in set(terms).difference(term_ids):
+            term_ids[term] = len(self.terms)
+            self.terms.append(term)
+        return np.fromiter(map(term_ids.__getitem__, terms), np.int64,
+                           len(terms))
+
+    def decode(self, term_ids):
+        """Returns a list of the terms for a list of term IDs."""
+        return list(map(self.terms.__getitem__, term_ids))
+
+
+def encode_contents(contents, vocab):
+    """Encodes a batch of repeated-term strings as parallel arrays.
+
+    Args:
+        contents: List of 'contents' strings (see TRESPI.weights), one
+            for each document in the batch. Use an empty string for a
+            missing document.
+        vocab: Vocabulary used to map terms to IDs.
+
+    Returns: A doc_nums, term_ids, weights tuple.
+    """
+    return encode_weights([TRESPI.weights.parse_contents(doc_contents)
+                           for doc_contents in contents], vocab)
+
+
+def encode_weights(batch, vocab):
+    """Encodes a batch of {term: weight} dicts as parallel arrays.
+
+    Args:
+        batch: List of {term: weight} dicts, one for each document in
+            the batch. Use an empty dict for a missing document.
+        vocab: Vocabulary used to map terms to IDs.
+
+    Returns: A tuple of doc_nums, term_ids and weights arrays, with one
+    element for every term in every document.
+    """
+    doc_nums = np.repeat(np.arange(len(batch), dtype=np.int64),
+                         [len(doc_weights) for doc_weights in batch])
+    term_ids = vocab.encode(list(itertools.chain.from_iterable(batch)))
+    weights = np.array(list(itertools.chain.from_iterable(
+        doc_weights.values() for doc_weights in batch)))
+    if not len(weights):
+        weights = weights.astype(np.int64)
+    return doc_nums, term_ids, weights
+
+
+def encode_records(records, vocab):
+    """Encodes a batch of index records as parallel arrays.
+
+    Args:
+        records: List of index records (see TRESPI.weights), with None
+            for missing documents. If every record has a 'contents'
+            key, the strings are encoded with encode_contents().
+        vocab: Vocabulary used to map terms to IDs.
+
+    Returns: A doc_nums, term_ids, weights tuple.
+    """
+    if all(record is None or 'contents' in record for record in records):
+        return encode_contents(
+            [record['contents'] if record is not None else ''
+             for record in records], vocab)
+    return encode_weights(
+        [TRESPI.weights.get_weights(record) if record is not None else {}
+         for record in records], vocab)
+
+
+def _bounds(doc_nums, num_docs):
+    """Returns the start of each document's elements, plus the end."""
+    return np.searchsorted(doc_nums, np.arange(num_docs + 1)).tolist()
+
+
+def decode_contents(encoded, num_docs, vocab):
+    """Converts encoded arrays back to repeated-term strings.
+
+    Args:
+        encoded: A doc_nums, term_ids, weights tuple, sorted by
+            document number. Weights must be integers.
+        num_docs: Number of documents in the batch.
+        vocab: The Vocabulary used to encode the terms.
+
+    Returns: A list of 'contents' strings, one for each document.
+    """
+    joined_weights = decode_weights(encoded, num_docs, vocab)
+    return [TRESPI.weights.expand_contents(doc_weights)
+            for doc_weights in joined_weights]
+
+
+def decode_weights(encoded, num_docs, vocab):
+    """Converts encoded arrays back to {term: weight} dicts.
+
+    Args:
+        encoded: A doc_nums, term_ids, weights tuple, sorted by
+            document number.
+        num_docs: Number of documents in the batch.
+        vocab: The Vocabulary used to encode the terms.
+
+    Returns: A list of {term: weight} dicts, one for each document.
+    """
+    doc_nums, term_ids, weights = encoded
+    terms = vocab.decode(term_ids.tolist())
+    weights = weights.tolist()
+    bounds = _bounds(doc_nums, num_docs)
+    return [dict(zip(terms[start:end], weights[start:end]))
+            for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def join_encoded(encoded0, encoded1, join_type, qry_discount, vocab):
+    """Joins two encoded batches of documents.
+
+    Args:
+        encoded0, encoded1: doc_nums, term_ids, weights tuples from
+            encode_contents() or encode_weights() for the index 0 and
+            index 1 versions of the same batch of documents.
+        join_type: Name of the IndexJoiner join method to replicate.
+            Must be a key of JOIN_KERNELS.
+        qry_discount: Multiplier for index 1 weights. Ignored by
+            join_docs_sum_weights.
+        vocab: The Vocabulary used to encode both batches.
+
+    Returns: A doc_nums, term_ids, weights tuple sorted by document
+    number and term ID. Weights are integers if all input weights are
+    integers.
+    """
+    kernel = JOIN_KERNELS[join_type]
+    doc_nums0, term_ids0, weights0 = encoded0
+    doc_nums1, term_ids1, weights1 = encoded1
+    stride = max(len(vocab), 1)
+    keys, inverse = np.unique(
+        np.concatenate([doc_nums0 * stride + term_ids0,
+                        doc_nums1 * stride + term_ids1]),
+        return_inverse=True)
+    inverse0, inverse1 = inverse[:len(term_ids0)], inverse[len(term_ids0):]
+
+    # Scatter both sides onto the union of terms.
+    union_weights0 = np.zeros(len(keys))
+    union_weights1 = np.zeros(len(keys))
+    in0 = np.zeros(len(keys), dtype=bool)
+    in1 = np.zeros(len(keys), dtype=bool)
+    union_weights0[inverse0] = weights0
+    union_weights1[inverse1] = weights1
+    in0[inverse0] = True
+    in1[inverse1] = True
+    joined = kernel(union_weights0, union_weights1, in0, in1, qry_discount)
+    if (np.issubdtype(weights0.dtype, np.integer)
+            and np.issubdtype(weights1.dtype, np.integer)):
+        joined = joined.astype(np.int64)
+    doc_nums, term_ids = np.divmod(keys, stride)
+    return doc_nums, term_ids, joined
+
+
+def join_batch(batch0, batch1, join_type, qry_discount=1.0, vocab=None):
+    """Joins the term weights of a batch of documents.
+
+    Args:
+        batch0, batch1: Equal length lists of {term: weight}
+            dictionaries. batch0[i] and batch1[i] are the weights of
+            the same document in index 0 and index 1. Use an empty
+            dictionary for a document that is missing from an index.
+        join_type: Name of the IndexJoiner join method to replicate.
+            Must be a key of JOIN_KERNELS.
+        qry_discount: Multiplier for index 1 weights. Ignored by
+            join_docs_sum_weights. Optional. Defaults to 1.0.
+        vocab: Vocabulary used to map terms to IDs. Pass the same
+            Vocabulary for every batch to avoid re-encoding terms.
+            Optional. Defaults to a new Vocabulary.
+
+    Returns: A list of {term: weight} dictionaries, one for every
+    document in the batch, with terms in term ID order.
+    """
+    assert len(batch0) == len(batch1)
+    if vocab is None:
+        vocab = Vocabulary()
+    joined = join_encoded(encode_weights(batch0, vocab),
+                          encode_weights(batch1, vocab),
+                          join_type, qry_discount, vocab)
+    return decode_weights(joined, len(batch0), vocab)
@@ -0,0 +1,74 @@
+"""Sparse term weight representation for document index records.
+
+DeepCT and HDCT encode term weights by repeating each term. A term
+with a weight of 3 appears three times in the record's 'contents':
+```
+{"id": "D2322065", "contents": "water water water grow"}
+```
+This module converts records to sparse `{term: weight}` dictionaries,
+so weights can be combined without building and splitting long
+strings, and converts the dictionaries back to records. Records can
+be written in the repeated-token format above, or in the format of
+Anserini's JsonVectorCollection, which stores the weights directly:
+```
+{"id": "D2322065", "vector": {"water": 3, "grow": 1}}
+```
+Both formats can be read.
+
+Typical Usage Example:
+import TRESPI.weights as weights
+doc_weights = weights.get_weights(doc_data)
+record = weights.make_record(doc_data['id'], doc_weights, 'vector')
+"""
+
+import collections
+
+OUTPUT_FORMATS = ('contents', 'vector')
+
+
+def parse_contents(contents):
+    """Converts a repeated-token string to a {term: weight} dict."""
+    return collections.Counter(contents.split())
+
+
+def expand_contents(doc_weights):
+    """Converts a {term: weight} dict to a repeated-token string."""
+    # Multiplying strings is much faster than repeating list items.
+    return ''.join([(term + ' ') * weight
+                    for term, weight in doc_weights.items()])[:-1]
+
+
+def get_weights(doc_data):
+    """Gets the term weights from an index record.
+
+    Args:
+        doc_data: A dictionary with an 'id' key and either a 'contents'
+            key (repeated-token format) or a 'vector' key
+            (JsonVectorCollection format).
+
+    Returns: A dictionary with a key for every term and term weights
+    for the values.
+    """
+    if 'vector' in doc_data:
+        return doc_data['vector']
+    return parse_contents(doc_data['contents'])
+
+
+def make_record(doc_id, doc_weights, output_format='contents'):
+    """Converts term weights to an index record.
+
+    Args:
+        doc_id: The document ID.
+        doc_weights: Dictionary of {term: weight}. Weights must be
+            integers if output_format is 'contents'.
+        output_format: 'contents' for the repeated-token format, or
+            'vector' for the JsonVectorCollection format.
+
+    Returns: A dictionary with 'id' and 'contents' or 'vector' keys.
+    """
+    if output_format == 'vector':
+        return {'id': doc_id, 'vector': dict(doc_weights)}
+    if output_format == 'contents':
+        return {'id': doc_id, 'contents': expand_contents(doc_weights)}
+    raise ValueError('Output format must be one of {}.'
+                     .format(', '.join(OUTPUT_FORMATS)))
@@ -0,0 +1,135 @@
+"""Measures documents per second for doc_to_psg.py.
+
+Splits the documents in an MS MARCO documents file into passages with
+the original passage assembly, which sums the word counts of the
+current passage's sentences for every sentence, and with
+doc_to_psg.split_docs, which keeps a running word count, using each of
+the word counters in doc_to_psg.WORD_COUNTERS, with and without
+sentence boundaries cached by util.splitter.SentenceIndex. Checks that
+the original and the running count give the same passages. Then times
+doc_to_psg.split, which also writes the output files, with different
+numbers of worker processes.
+
+Run from the doc_split folder:
+python benchmark_doc_to_psg.py ../../test_data/msmarco-docs1000.tsv
+"""
+
+import argparse
+import contextlib
+import io
+import itertools
+import os
+import os.path
+import tempfile
+import time
+
+import nltk.tokenize
+
+import doc_to_psg
+import util.splitter
+
+
+def split_docs_original(docs, psg_len):
+    """Splits documents with the original passage assembly."""
+    results = []
+    for doc_id, title, text in docs:
+        check_text = title + text
+        if check_text.isspace() or not check_text:
+            results.append((doc_id, None))
+            continue
+        sentences = nltk.tokenize.sent_tokenize(title + ' ' + text)
+        sent_lengths = [len(nltk.tokenize.word_tokenize(sentence))
+                        for sentence in sentences]
+        passages = []
+        passage = []
+        start_idx = 0
+        for idx, sentence in enumerate(sentences):
+            end_idx = start_idx + len(passage)
+            curr_len = sum(sent_lengths[start_idx:end_idx])
+            if curr_len < psg_len:
+                passage.append(sentence)
+            else:
+                passages.append(' '.join(passage))
+                passage = [sentence]
+                start_idx = idx
+        passages.append(' '.join(passage))
+        results.append((doc_id, passages))
+    return results
+
+
+def timed(func, *args):
+    """Returns the function's result and the elapsed seconds."""
+    start_time = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('path', help='Path to TSV file with MS Marco documents')
+    parser.add_argument('--max-docs', type=int, default=1000)
+    parser.add_argument('--psg-length', type=int, default=200)
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=[1, 2, 4],
+                        help='Numbers of worker processes to time.')
+    args = parser.parse_args()
+
+    docs = list(itertools.islice(util.splitter.read_docs(args.path),
+                                 args.max_docs))
+    num_docs = len(docs)
+    expected, original_time = timed(split_docs_original, docs,
+                                     args.psg_length)
+    print('{:,} documents. Documents per second, one process.'
+          .format(num_docs))
+    print('{:<30} {:>10} {:>8}'.format('Passage assembly', 'Docs/sec',
+                                       'Speedup'))
+    print('{:<30} {:>10,.0f} {:>7.1f}x'.format(
+        'original (nltk)', num_docs / original_time, 1))
+    for word_counter in doc_to_psg.WORD_COUNTERS:
+        passages, split_time = timed(doc_to_psg.split_docs, docs,
+                                     args.psg_length, word_counter)
+        if word_counter == 'nltk':
+            assert passages == expected
+        print('{:<30} {:>10,.0f} {:>7.1f}x'.format(
+            'running count (' + word_counter + ')', num_docs / split_time,
+            original_time / split_time))
+    doc_spans = [util.splitter.sentence_spans(title + ' ' + text)
+                 for _, title, text in docs]
+    for word_counter in doc_to_psg.WORD_COUNTERS:
+        passages, split_time = timed(doc_to_psg.split_docs, docs,
+                                     args.psg_length, word_counter, doc_spans)
+        if word_counter == 'nltk':
+            assert passages == expected
+        print('{:<30} {:>10,.0f} {:>7.1f}x'.format(
+            'cached sentences (' + word_counter + ')', num_docs / split_time,
+            original_time / split_time))
+
+    print('\ndoc_to_psg.split() documents per second, including output.')
+    print('{:<8} {:>12} {:>12} {:>12}'.format(
+        'Workers', *doc_to_psg.WORD_COUNTERS))
+    with tempfile.TemporaryDirectory() as tmp_path:
+        doc_path = os.path.join(tmp_path, 'docs.tsv')
+        with open(doc_path, 'wt') as dfile:
+            dfile.writelines(['{}\t\t{}\t{}\n'.format(*doc) for doc in docs])
+        cwd = os.getcwd()
+        os.chdir(tmp_path)  # split() writes its log file to the cwd
+        try:
+            for workers in args.workers:
+                rates = []
+                for word_counter in doc_to_psg.WORD_COUNTERS:
+                    with contextlib.redirect_stdout(io.StringIO()), \
+                            contextlib.redirect_stderr(io.StringIO()):
+                        _, split_time = timed(
+                            doc_to_psg.split, doc_path,
+                            os.path.join(tmp_path, 'passages'),
+                            args.psg_length, 100_000, num_docs, word_counter,
+                            workers)
+                    rates.append(num_docs / split_time)
+                print('{:<8} {:>12,.0f} {:>12,.0f} {:>12,.0f}'
+                      .format(workers, *rates))
+        finally:
+            os.chdir(cwd)
+
+
+if __name__ == '__main__':
+    main()
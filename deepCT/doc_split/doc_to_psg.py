@@ -24,11 +24,20 @@ python doc_to_psg.py \
 Other available arguments:
     --num-docs NNN: positive integer, used for testing. Only processed
                     the first NNN documents.
+    --word-counter NAME: How words are counted, one of 'nltk' (the
+                    default), 'regex' or 'whitespace'. See
+                    WORD_COUNTERS.
+    --workers N:    Number of processes that split documents. Defaults
+                    to 1.
+    --sentence-cache: Saves the sentence boundaries of every document
+                    in a sidecar file, see util/splitter.py, or reads
+                    them from the sidecar file if it already exists.
 
 Source Data:
 The source file must be a TSV file, with the document ID in the first
 column, URL in the second column, title in the third, and document text
-in the fourth column.
+in the fourth column. It may also be a Parquet file created by
+util/columnar.py, in which case the URL column is not read.
 
 Ouput Data:
 The output files have one passage per line, with a passage ID and the
@@ -40,7 +49,24 @@ Splitting Technique:
 doc_to_psg tries to split documents at sentence boundaries. It uses
 nltk's sentence tokenizer to identify sentence boundaries, and adds
 sentences to a passage as long as the total word count is less than
-the value passed in --psg-length.
+the value passed in --psg-length. The word count of the current passage
+is kept as a running total, so each sentence's words are counted once.
+
+Counting words with nltk's word tokenizer is slow. The 'regex' word
+counter counts the same kind of tokens, runs of word characters and
+single punctuation characters, with a regular expression, and the
+'whitespace' word counter counts space-separated words. Either is much
+faster, but passages may end at different sentences than with 'nltk'.
+
+Splitting documents into sentences with nltk takes most of the time.
+With --sentence-cache, the sentence boundaries are saved in a sidecar
+file next to the document file, which docT5query's DocDataset can also
+read, so the documents are only split into sentences once.
+
+Parallel Splitting:
+With --workers greater than 1, documents are sent to a pool of worker
+processes in chunks of CHUNK_DOCS documents. The chunks are returned in
+order, so the output files are identical to a single process run.
 
 Empty Documents:
 If both the title and text of a document contain only whitespace, the
@@ -53,11 +79,21 @@ the files that are skipped due to being empty.
 """
 
 import argparse
+import itertools
+import multiprocessing
+import os.path
+import re
+import sys
 
 import nltk 
 import nltk.tokenize
 from tqdm import tqdm
 
+dirname = os.path.dirname(os.path.abspath(__file__))
+repo_root = os.path.abspath(os.path.join(dirname, '../..'))
+sys.path.insert(0, repo_root)
+import util.splitter
+
 
 # Command line arguments
 desc = """Converts msmarco-docs.tsv data to passages file that can
@@ -71,14 +107,75 @@ parser.add_argument('--num-docs', type=int, default=None,
                     help=num_docs_help)
 parser.add_argument('--docs-per-output-file', type=int, default=100_000,
                     help='Number of lines in each output file.')
-parser.add_argument('path', help='Path to TSV file with MS Marco documents')
+parser.add_argument('--word-counter', default='nltk',
+                    choices=['nltk', 'regex', 'whitespace'],
+                    help='How words in each sentence are counted.')
+parser.add_argument('--workers', type=int, default=1,
+                    help='Number of processes that split documents.')
+parser.add_argument('--sentence-cache', action='store_true',
+                    help='Save or read sentence boundaries in a sidecar '
+                         'file.')
+parser.add_argument('path', help='Path to TSV or Parquet file with MS Marco '
+                                 'documents')
+
+
+# Number of documents sent to a worker process at a time
+CHUNK_DOCS = 100
 
+_WORD_PTN = re.compile(r'\w+|[^\w\s]')
 
-def split(doc_path, output_path, psg_len, output_num_docs, doc_total=None):
+WORD_COUNTERS = {
+    'nltk': lambda sentence: len(nltk.tokenize.word_tokenize(sentence)),
+    'regex': lambda sentence: len(_WORD_PTN.findall(sentence)),
+    'whitespace': lambda sentence: len(sentence.split()),
+}
+
+
+def split_docs(docs, psg_len, word_counter='nltk', doc_spans=None):
+    """Splits a chunk of documents into passages.
+
+    See util.splitter.word_passages().
+
+    Args:
+        docs: List of (doc_id, title, text) tuples.
+        psg_len: The target length of each passage, in words.
+        word_counter: Name of the word counter in WORD_COUNTERS.
+        doc_spans: List with the sentence spans of each document, from
+            a util.splitter.SentenceIndex. Optional. If None, the
+            documents are split into sentences with nltk.
+
+    Returns: A list of (doc_id, passages) tuples, where passages is a
+    list of passage strings, or None if the document is empty.
+    """
+    count_words = WORD_COUNTERS[word_counter]
+    results = []
+    for doc_num, (doc_id, title, text) in enumerate(docs):
+        # Verify that document is not empty
+        check_text = title + text
+        if check_text.isspace() or not check_text:
+            results.append((doc_id, None))
+            continue
+        doc_text = title + ' ' + text
+        if doc_spans is None:
+            sentences = nltk.tokenize.sent_tokenize(doc_text)
+        else:
+            sentences = [doc_text[start:end]
+                         for start, end in doc_spans[doc_num]]
+        results.append((doc_id, util.splitter.word_passages(
+            sentences, psg_len, count_words)))
+    return results
+
+def _split_docs_star(args):
+    """Calls split_docs() with a tuple of arguments in a worker process."""
+    return split_docs(*args)
+
+def split(doc_path, output_path, psg_len, output_num_docs, doc_total=None,
+          word_counter='nltk', workers=1, sentence_cache=False):
     """Splits a MSMARCO TSV file into separate passages.
 
     Args:
-        doc_path: str, full path to MSMARCO document file.
+        doc_path: str, full path to MSMARCO document file, TSV or
+            Parquet.
         output_path: The name of the folder where the output documents
             will be written.
         psg_len: The target length of each passage.
@@ -86,53 +183,58 @@ def split(doc_path, output_path, psg_len, output_num_docs, doc_total=None):
         doc_total: Number of documents in input file. Optional. Used
         so progress bar will provide an accurate estimate of time
         remaining. Get number of lines with `wc -l input_file`.
+        word_counter: Name of the word counter in WORD_COUNTERS.
+            Optional. Defaults to 'nltk'.
+        workers: Number of processes that split documents. Optional.
+            Defaults to 1.
+        sentence_cache: If True, the sentence boundaries are read from a
+            util.splitter.SentenceIndex, which is built first if it
+            does not exist. Optional. Defaults to False.
     """
-    with open(doc_path, 'rt') as dfile, open('log_file', 'wt') as lfile:
-        output_file_num = 0
-        ofile = None
-        for idx, line in tqdm(enumerate(dfile), 'Docs Processed', doc_total):
-            # Start writing output to a new file
-            if idx % output_num_docs == 0:
-                full_output_path = ('{}_{:03d}.tsv'
-                                    .format(output_path, output_file_num))
-                if ofile is not None:
-                    ofile.close()
-                ofile = open(full_output_path, 'wt')
-                print('Writing to file:', full_output_path)
-                output_file_num += 1
-            doc_id, url, title, text = line.split('\t')
-            text = text[:-1] if text[-1] == '\n' else text
-
-            # Verify that document is not empty
-            check_text = title+text
-            if check_text.isspace() or not check_text:
-                msg = 'Skipping doc {} due to no data!'.format(doc_id)
-                print(msg)
-                lfile.write(msg + '\n')
-                continue
-
-            # Assemble Passages
-            sentences = nltk.tokenize.sent_tokenize(title + ' ' + text)
-            sent_lengths = [len(nltk.tokenize.word_tokenize(sentence))
-                            for sentence in sentences]
-
-            passage = []
-            psg_num = 0
-            start_idx = 0
-            for idx, sentence in enumerate(sentences):
-                end_idx = start_idx + len(passage)
-                curr_len = sum(sent_lengths[start_idx:end_idx])
-                if curr_len < psg_len:
-                    passage.append(sentence)
-                else:
-                    ofile.write("{}_{}\t{}\n".format(doc_id, psg_num, ' '.join(passage)))
-                    passage = []
-                    passage.append(sentence)
-                    start_idx = idx
-                    psg_num += 1
-            ofile.write("{}_{}\t{}\n".format(doc_id, psg_num, ' '.join(passage)))
-    ofile.close()
-    lfile.close()
+    docs = util.splitter.read_docs(doc_path)
+    chunks = iter(lambda: list(itertools.islice(docs, CHUNK_DOCS)), [])
+    if sentence_cache:
+        sentence_idx = util.splitter.SentenceIndex(doc_path, workers)
+        doc_nums = itertools.count()
+        chunks = ((chunk, psg_len, word_counter,
+                   [sentence_idx.spans(next(doc_nums)) for _ in chunk])
+                  for chunk in chunks)
+    else:
+        chunks = ((chunk, psg_len, word_counter) for chunk in chunks)
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    results = (pool.imap(_split_docs_star, chunks) if pool is not None
+               else map(_split_docs_star, chunks))
+    doc_passages = itertools.chain.from_iterable(results)
+    ofile = None
+    try:
+        with open('log_file', 'wt') as lfile:
+            output_file_num = 0
+            for idx, (doc_id, passages) in tqdm(enumerate(doc_passages),
+                                                'Docs Processed', doc_total):
+                # Start writing output to a new file
+                if idx % output_num_docs == 0:
+                    full_output_path = ('{}_{:03d}.tsv'
+                                        .format(output_path, output_file_num))
+                    if ofile is not None:
+                        ofile.close()
+                    ofile = open(full_output_path, 'wt')
+                    print('Writing to file:', full_output_path)
+                    output_file_num += 1
+
+                if passages is None:
+                    msg = 'Skipping doc {} due to no data!'.format(doc_id)
+                    print(msg)
+                    lfile.write(msg + '\n')
+                    continue
+                ofile.write(''.join(['{}_{}\t{}\n'.format(doc_id, psg_num,
+                                                          passage)
+                                     for psg_num, passage
+                                     in enumerate(passages)]))
+    finally:
+        if ofile is not None:
+            ofile.close()
+        if pool is not None:
+            pool.terminate()
 
 
 if __name__ == '__main__':
@@ -142,4 +244,7 @@ if __name__ == '__main__':
           args.output_file,
           args.psg_length,
           args.docs_per_output_file,
-          args.num_docs)
+          args.num_docs,
+          args.word_counter,
+          args.workers,
+          args.sentence_cache)
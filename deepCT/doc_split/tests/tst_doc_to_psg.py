@@ -0,0 +1,56 @@
+import os
+import os.path
+import random
+import sys
+
+import pytest
+
+# Run test from the doc_split folder
+sys.path.insert(0, os.path.abspath('.'))
+import benchmark_doc_to_psg
+import doc_to_psg  # Adds the repository folder to sys.path
+import util.splitter
+import util.testing as testing
+from util.testing import simple_nltk  # Applied to every test
+
+
+def _read_output(folder):
+    """Reads every output file, keyed by file name."""
+    return {fname: open(os.path.join(folder, fname)).read()
+            for fname in sorted(os.listdir(folder))
+            if fname.endswith('.tsv')}
+
+
+def test_split_docs():
+    rng = random.Random(4)
+    docs = [(f'D{idx}', 'Title',
+             testing.random_text(rng, rng.randint(0, 30), max_words=25))
+            for idx in range(200)]
+    for psg_len in [10, 50, 200]:
+        expected = benchmark_doc_to_psg.split_docs_original(docs, psg_len)
+        assert doc_to_psg.split_docs(docs, psg_len) == expected
+        doc_spans = [util.splitter.sentence_spans(title + ' ' + text)
+                     for _, title, text in docs]
+        assert doc_to_psg.split_docs(docs, psg_len, 'nltk',
+                                     doc_spans) == expected
+
+
+@pytest.mark.parametrize('sentence_cache', [False, True])
+def test_split_workers(tmp_path, monkeypatch, sentence_cache):
+    monkeypatch.chdir(tmp_path)  # split() writes its log file to the cwd
+    doc_path = str(tmp_path / 'docs.tsv')
+    # Empty documents are skipped
+    testing.write_docs(doc_path, 450, max_sentences=30, max_words=25,
+                       empty_every=17)
+    outputs = []
+    for workers in [1, 3]:
+        folder = tmp_path / f'out{workers}'
+        folder.mkdir()
+        doc_to_psg.split(doc_path, str(folder / 'passages'), 50, 200,
+                         workers=workers, sentence_cache=sentence_cache)
+        outputs.append(_read_output(folder))
+    assert list(outputs[0]) == ['passages_000.tsv', 'passages_001.tsv',
+                                'passages_002.tsv']
+    assert outputs[0] == outputs[1]
+    with open('log_file') as lfile:
+        assert 'Skipping doc D0 ' in lfile.read()
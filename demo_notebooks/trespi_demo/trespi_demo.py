@@ -16,15 +16,15 @@ class TrespiDemo():
     def __init__(self, index_path, docs_path, k1, b):
         self.searcher = pyserini.search.SimpleSearcher(index_path)
         self.searcher.set_bm25(k1, b)
-        self.docs = util.indexer.IndexedFile(docs_path, 0)
+        self.docs = util.indexer.open_index(docs_path, 0)
 
     def run_query(self, query, num_results=100):
         hits = self.searcher.search(query, num_results)
         query_results = []
-        for idx, hit in enumerate(hits):
+        docs = util.indexer.get_rows(self.docs, [hit.docid for hit in hits],
+                                     ['url', 'title', 'text'])
+        for idx, (hit, (url, title, contents)) in enumerate(zip(hits, docs)):
             pos = idx + 1
-            doc = self.docs[hit.docid]
-            _, url, title, contents = doc.split('\t')
             result = {'pos': pos,
                       'doc_id': hit.docid,
                       'RR': 1/pos,
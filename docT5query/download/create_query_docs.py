@@ -1,19 +1,21 @@
 """Creates msmarco documents based on docT5query queries.
 
-This module relies on a sequence of three different iterators and
-several helper functions.
-
-Iterators:
-* _read_queries_from_files(): This function iterates over all 330
-  docT5query data files to extract the queries that correspond to a
-  given passage. It returns a list of queries. Note there are usually
-  multiple passages per document.
-* _get_docids(): Iterates over the docT5query dataset's passage to
-  doc_id mapping file. It returns the msmarco docuemnt ID that
-  corresponds to a passage.
-* _get_doc_queries(): Using the output of the two preceding iterators,
-  provides a tuple consisting of a document ID and a list of all queries
-  that correspond to the document.
+The docT5query data files are processed in shards, one for each file
+sequence number (see _query_file_path()), by a pool of worker
+processes.
+
+Shard Functions:
+* _read_shard_passages(): Reads the data files and the passage to
+  doc_id mapping file for one shard in large blocks, and returns the
+  msmarco document ID and the list of queries of each passage. Note
+  there are usually multiple passages per document.
+* _group_doc_queries(): Combines the queries of consecutive passages
+  of the same document into a tuple consisting of a document ID and a
+  list of all queries that correspond to the document.
+* _process_shard(): Runs in a worker process and writes the documents
+  of one shard to a temporary file. The first and last documents of a
+  shard may have passages in the neighboring shards, so they are
+  returned to the parent process.
 
 Primary Function:
 create_query_docs(): Creates a TSV document with four columns:
@@ -22,16 +24,27 @@ create_query_docs(): Creates a TSV document with four columns:
 * document title
 * document queries, concatenated into a single string with queries
   separated by spaces.
+The shard files are concatenated in order, so the documents are in the
+same order as in the docT5query dataset.
 
 Helper Functions:
-* _close_files(): Closes all data files.
 * _clean_queries(): Strips surrounding whitespace and ensures each query
   ends with a '?'.
+* _format_docs(): Looks up a batch of msmarco documents with
+  util.indexer.get_rows() and creates the output lines.
 """
 
 import argparse
+import collections
+from contextlib import ExitStack
+import itertools
+import multiprocessing
+import operator
+import os
 import os.path
+import shutil
 import sys
+import tempfile
 
 from tqdm import tqdm
 
@@ -51,7 +64,9 @@ parser.add_argument('--queries-per-psg', type=int, default=10,
 parser.add_argument('--doc-ids-path',
                     help='Path to msmarco_doc_passage_ids.txt file.')                    
 parser.add_argument('--msmarco-docs-path',
-                    help='Path to msmarco document file (msmarco-docs.tsv).')
+                    help='Path to msmarco document file (msmarco-docs.tsv), '
+                         'to a folder of document files, or to a Parquet '
+                         'file created by util/columnar.py.')
 parser.add_argument('--output-path', help='Path to output file.')
 parser.add_argument('--files-per-sample', type=int, default=33,
                     help='Number of docT5query files per sample.')
@@ -60,52 +75,27 @@ parser.add_argument('--max-docs', type=int, default=None,
                     help=help_msg)
 parser.add_argument('--append-text', type=bool, default=False,
                     help='Appends original document text if True.')
+parser.add_argument('--workers', type=int, default=None,
+                    help='Number of worker processes. Defaults to the '
+                         'number of CPUs.')
 
-# Helper Functions
-def _close_files(files):
-    """Takes a list of file objects and closes each file"""
-    for f in files:
-        if not f.closed:
-            f.close()
+# Number of bytes read at a time when counting lines
+BLOCK_BYTES = 1 << 24
+# Number of lines read from each data file at a time
+BLOCK_LINES = 100_000
+# Number of msmarco documents read with each get_many() call
+DOCS_PER_LOOKUP = 1000
 
+# Helper Functions
 def _clean_queries(queries):
     """Strips whitespace and ensures each query ends with a '?'."""
-    queries = [query.strip() for query in queries]
-    queries = [query + '?' if query[-1] not in ['.', '!', '?'] else query
-            for query in queries]
-    return queries
-
-
-# Iterators
-def _read_queries_from_files(queries_folder,
-                            queries_per_psg,
-                            files_per_sample):
-    """An iterator that reads queries from docT5query files.
+    return [query if query[-1] in '.!?' else query + '?'
+            for query in map(str.strip, queries)]
 
-    Args:
-        queries_per_psg: Number of queries to obtain for each
-            passage.
 
-    Returns: A list of queries, with the length of each list being equal
-    to `queries_per_psg`. Each list corresponds to a different passage
-    within an msmarco document. Example return value for
-    queries_per_psg = 3:
-    ```
-    ['when find radius of star r',
-    'which radiation is produced during a solar radiation experiment?'
-    'which age are kids learning how to be independent?']
-    ```
-    The queries are returned in the order in which they occur in the
-    source data files.
-    
-    There are usually several passages within an msmarco document, so it
-    is necessary to call this iterator multiple times to get all queries
-    for a single document.
-
-    This is the only part of the module that accesses the docT5query
-    data files. The structure of these files is confusing, so it is
-    described in the following section to make future code maintenance
-    easier.
+# Data file access
+def _query_file_path(queries_folder, qnum, file_num):
+    """Gets the path of a docT5query data file.
 
     Data File Description:
     ----------------------
@@ -133,77 +123,179 @@ def _read_queries_from_files(queries_folder,
 
     The two sequences are in the same order, so if we want to aggregate
     queries for the same passage, we need to iterate over the sequences
-    in parallel.
+    in parallel. The files with the same file sequence number FFF
+    contain the queries for the same passages, so each file sequence
+    number is processed as a separate shard.
     """
-    try:
-        for file_num in range(files_per_sample):
-            # Each file has one query per passage. Open one file for
-            #   each query that will be returned.
-            query_file_names = [
-                f'predicted_queries_doc_sample{qnum:03}'
-                f'.txt{file_num:03}-1004000'
-                for qnum in range(queries_per_psg)]
-            query_files = [open(os.path.join(queries_folder, qf_name))
-                        for qf_name in query_file_names]
-            while True:
-                # Read a query from each open file
-                psg_queries = [qfile.readline() for qfile in query_files]
-                if not psg_queries[0]:  # readline returns '' at EOF
-                    break
-                yield psg_queries
-    # Close files if iterator is closed early
-    except GeneratorExit:
-        _close_files(query_files)
-    _close_files(query_files)
+    return os.path.join(queries_folder,
+                        f'predicted_queries_doc_sample{qnum:03}'
+                        f'.txt{file_num:03}-1004000')
 
-def _get_docids(doc_ids_path):
-    """Iterates over the docT5query passage to doc_id mapping file.
+def _count_lines(path):
+    """Counts the lines in a file by reading it in large blocks."""
+    num_lines = 0
+    with open(path, 'rb') as tfile:
+        for block in iter(lambda: tfile.read(BLOCK_BYTES), b''):
+            num_lines += block.count(b'\n')
+    return num_lines
 
-    Returns a doc_id string.
-    """
-    with open(doc_ids_path) as idfile:
-        for line in idfile:
-            yield line.strip()
+def _line_byte_positions(path, line_nums):
+    """Finds the byte positions at which lines of a file start.
 
-def _get_doc_queries(queries_folder,
-                     doc_ids_path,
-                     queries_per_psg,
-                     files_per_sample,
-                     max_docs=0):
-    """Returns a doc_id and a list of all queries for the document.
+    Args:
+        path: Path to the file.
+        line_nums: Sorted list of line numbers, starting at 0.
+
+    Returns: A list with the byte position of each line number.
+    """
+    positions = []
+    line_num = 0
+    block_pos = 0
+    targets = iter(line_nums)
+    target = next(targets, None)
+    with open(path, 'rb') as tfile:
+        while target is not None:
+            if target == 0:
+                positions.append(0)
+                target = next(targets, None)
+                continue
+            block = tfile.read(BLOCK_BYTES)
+            if not block:
+                raise ValueError(f'{path} has fewer than {target} lines.')
+            newline_pos = -1
+            block_lines = block.count(b'\n')
+            while target is not None and line_num + block_lines >= target:
+                # Find the newline that ends line target - 1
+                for _ in range(target - line_num):
+                    newline_pos = block.index(b'\n', newline_pos + 1)
+                block_lines -= target - line_num
+                line_num = target
+                positions.append(block_pos + newline_pos + 1)
+                target = next(targets, None)
+            line_num += block_lines
+            block_pos += len(block)
+    return positions
+
+def _read_shard_passages(queries_folder, queries_per_psg, file_num,
+                         doc_ids_path, doc_ids_pos, num_passages):
+    """Iterates over the passages in one file sequence number.
+
+    The data files and the passage ID file are read in blocks of
+    BLOCK_LINES lines. Each block of queries is cleaned with
+    _clean_queries(), and the query columns are zipped together for
+    each block. The files are read in text mode, which is already
+    buffered. Reading them in binary blocks and splitting the lines
+    with bytes.split() was measured no faster, as most of the time is
+    spent in _clean_queries().
 
     Args:
         queries_per_psg: Number of queries to obtain for each
             passage.
-        max_docs: Number of documents to process. The iterator will
-            be exhausted after this number of documents. If 0, all
-            documents are processed.
+        file_num: The file sequence number, FFF in the data file names.
+        doc_ids_path: Path to msmarco_doc_passage_ids.txt.
+        doc_ids_pos: Byte position in doc_ids_path of the document ID
+            of the first passage in the shard.
+        num_passages: Number of passages in the shard.
+
+    Yields: (doc_id, psg_queries) tuples, where psg_queries is a tuple
+    of queries_per_psg cleaned queries.
+    """
+    with ExitStack() as stack:
+        query_files = [
+            stack.enter_context(open(
+                _query_file_path(queries_folder, qnum, file_num)))
+            for qnum in range(queries_per_psg)]
+        idfile = stack.enter_context(open(doc_ids_path))
+        idfile.seek(doc_ids_pos)
+        while num_passages > 0:
+            block_len = min(BLOCK_LINES, num_passages)
+            doc_ids = [line.strip()
+                       for line in itertools.islice(idfile, block_len)]
+            query_blocks = [
+                _clean_queries(itertools.islice(qfile, block_len))
+                for qfile in query_files]
+            yield from zip(doc_ids, zip(*query_blocks))
+            num_passages -= block_len
+
+def _group_doc_queries(passages):
+    """Groups consecutive passages of the same document.
 
     Returns:
-        (doc_id, [qry_1, qry_2, qry_3, ... qry_m])
+        An iterator of (doc_id, [qry_1, qry_2, qry_3, ... qry_m]) tuples.
         m = queries_per_psg * {number of passages in document}
         Documents contain varying numbers of passages, so the list of
         queries will have varying lengths.
     """
-    curr_docid = ''
-    doc_num = 0  # For tracking number of documents processed
-    for doc_id, query_list in zip(_get_docids(doc_ids_path),
-                                  _read_queries_from_files(queries_folder,
-                                                           queries_per_psg,
-                                                           files_per_sample)):
-        if doc_id != curr_docid:
-            if curr_docid:
-                yield (curr_docid, [qry for qlist in queries for qry in qlist])
-                doc_num += 1
-                # Stop if max_docs is reached
-                if max_docs and doc_num >= max_docs:
-                    return
-            queries = [query_list]
-            curr_docid = doc_id
-        else:
-            queries.append(query_list)
-    # Make sure the final document is returned.
-    yield (curr_docid, [qry for qlist in queries for qry in qlist])
+    for doc_id, doc_passages in itertools.groupby(passages,
+                                                  operator.itemgetter(0)):
+        yield doc_id, [qry for _, psg_queries in doc_passages
+                       for qry in psg_queries]
+
+def _format_docs(doc_idx, doc_queries, append_text):
+    """Creates output lines for a list of (doc_id, queries) tuples.
+
+    The queries must already be cleaned with _clean_queries().
+    The msmarco documents are read with a single get_rows() call, which
+    reads only the URL and title unless append_text is True.
+    """
+    columns = ['url', 'title', 'text'] if append_text else ['url', 'title']
+    records = util.indexer.get_rows(
+        doc_idx, [doc_id for doc_id, _ in doc_queries], columns)
+    lines = []
+    for (doc_id, qset), record in zip(doc_queries, records):
+        url, title = record[:2]
+        query_txt = ' '.join(qset)
+        if append_text:
+            query_txt = query_txt + ' ' + record[2]
+        lines.append('\t'.join([doc_id, url, title, query_txt]) + '\n')
+    return lines
+
+
+# Shard worker processes
+_worker_doc_idx = None
+
+def _init_shard_worker(msmarco_docs_path):
+    """Opens the msmarco documents index in a worker process."""
+    global _worker_doc_idx
+    _worker_doc_idx = util.indexer.open_index(msmarco_docs_path, 0,
+                                              use_mmap=True)
+
+def _process_shard(task):
+    """Creates query documents for one file sequence number.
+
+    Documents at the start and end of the shard may have passages in
+    the neighboring shards, so their queries are returned to the
+    parent process instead of being written. The documents in between
+    are written to shard_path.
+
+    Returns: A tuple with the (doc_id, queries) tuple of the first
+    document, the (doc_id, queries) tuple of the last document, or None
+    if the shard contains a single document, and the number of
+    documents written to shard_path.
+    """
+    (queries_folder, queries_per_psg, file_num, doc_ids_path, doc_ids_pos,
+     num_passages, append_text, shard_path) = task
+    groups = _group_doc_queries(_read_shard_passages(
+        queries_folder, queries_per_psg, file_num, doc_ids_path,
+        doc_ids_pos, num_passages))
+    first_doc = next(groups, None)
+    last_doc = None
+    num_docs = 0
+    pending = []
+    with open(shard_path, 'wt') as ofile:
+        for doc in groups:
+            if last_doc is not None:
+                pending.append(last_doc)
+            if len(pending) >= DOCS_PER_LOOKUP:
+                ofile.write(''.join(_format_docs(_worker_doc_idx, pending,
+                                                 append_text)))
+                num_docs += len(pending)
+                pending = []
+            last_doc = doc
+        ofile.write(''.join(_format_docs(_worker_doc_idx, pending,
+                                         append_text)))
+        num_docs += len(pending)
+    return first_doc, last_doc, num_docs
 
 
 # Primary Function
@@ -214,53 +306,125 @@ def create_query_docs(queries_folder,
                       queries_per_psg=10,
                       files_per_sample=33,
                       max_docs=None,
-                      append_text=False):
+                      append_text=False,
+                      workers=None):
     """Creates a TSV file containing queries from docT5query.
 
     The results are written to the file specified by OUTPUT_PATH
 
+    Each file sequence number (see _query_file_path) is processed as a
+    separate shard by a pool of worker processes. The shards are written
+    to temporary files that are concatenated in order, and documents
+    whose passages span two shards are combined by the parent process.
+
     Args:
         queries_per_psg: Number of queries to obtain for each
             passage.
         max_docs: Number of documents to process. The iterator will
             be exhausted after this number of documents. If None, all
             documents are processed.
+        workers: Number of worker processes. If None, one process per
+            CPU is used.
 
     Returns: None
     """
-    doc_idx = util.indexer.IndexedFile(msmarco_docs_path, 0)
+    doc_idx = util.indexer.open_index(msmarco_docs_path, 0, use_mmap=True)
     total_docs = len(doc_idx)
     if max_docs is not None:
         docs_to_process = min(total_docs, max_docs)
     else:
         docs_to_process = total_docs
     print(max_docs, total_docs, docs_to_process)
-    print('Writing output to', output_path)
-    with open(output_path, 'wt') as ofile:
-        for doc_id, qset in tqdm(_get_doc_queries(queries_folder,
-                                                  doc_ids_path,
-                                                  queries_per_psg,
-                                                  files_per_sample,
-                                                  max_docs),
-                                'Docs Processed', docs_to_process):
-            _, url, title, doc_text = doc_idx[doc_id].split('\t')
-            query_txt = ' '.join(_clean_queries(qset))
-            if append_text:
-                query_txt = query_txt + ' ' + doc_text[:-1]
-            output = '\t'.join([doc_id, url, title, query_txt]) + '\n'
-                
-            ofile.write(output)
+    workers = workers if workers is not None else os.cpu_count()
+
+    pool = multiprocessing.Pool(workers, _init_shard_worker,
+                                (msmarco_docs_path,))
+    shard_folder = None
+    try:
+        # Locate the first passage of every shard in the passage ID file
+        shard_lens = pool.map(_count_lines,
+                              [_query_file_path(queries_folder, 0, file_num)
+                               for file_num in range(files_per_sample)])
+        shard_starts = list(itertools.accumulate([0] + shard_lens[:-1]))
+        doc_ids_positions = _line_byte_positions(doc_ids_path, shard_starts)
+
+        print('Writing output to', output_path)
+        shard_folder = tempfile.mkdtemp(
+            dir=os.path.dirname(os.path.abspath(output_path)))
+        tasks = [(queries_folder, queries_per_psg, file_num, doc_ids_path,
+                  doc_ids_positions[file_num], shard_lens[file_num],
+                  append_text,
+                  os.path.join(shard_folder, f'shard{file_num:03}.tsv'))
+                 for file_num in range(files_per_sample)]
+        # With max_docs, only one shard per worker is submitted ahead of
+        # the shard being written, so few unneeded shards are processed
+        ahead = len(tasks) if max_docs is None else workers
+        submitted = collections.deque(
+            (task, pool.apply_async(_process_shard, (task,)))
+            for task in tasks[:ahead])
+        next_task = len(submitted)
+        num_docs = 0
+        carry = None  # Document that may continue into the next shard
+        with open(output_path, 'wt') as ofile, \
+                tqdm(desc='Docs Processed', total=docs_to_process) as pbar:
+
+            def write_docs(doc_queries):
+                """Writes documents in the parent, up to max_docs."""
+                nonlocal num_docs
+                if max_docs is not None:
+                    doc_queries = doc_queries[:max_docs - num_docs]
+                ofile.write(''.join(_format_docs(doc_idx, doc_queries,
+                                                 append_text)))
+                num_docs += len(doc_queries)
+                pbar.update(len(doc_queries))
+
+            while submitted:
+                task, result = submitted.popleft()
+                first_doc, last_doc, shard_docs = result.get()
+                if next_task < len(tasks):
+                    submitted.append((tasks[next_task], pool.apply_async(
+                        _process_shard, (tasks[next_task],))))
+                    next_task += 1
+                shard_path = task[-1]
+                if first_doc is not None:
+                    if carry is not None and carry[0] == first_doc[0]:
+                        carry = (carry[0], carry[1] + first_doc[1])
+                    else:
+                        if carry is not None:
+                            write_docs([carry])
+                        carry = first_doc
+                if last_doc is not None:
+                    write_docs([carry])
+                    with open(shard_path) as sfile:
+                        if max_docs is not None:
+                            shard_docs = min(shard_docs, max_docs - num_docs)
+                        ofile.writelines(itertools.islice(sfile, shard_docs))
+                    num_docs += shard_docs
+                    pbar.update(shard_docs)
+                    carry = last_doc
+                os.remove(shard_path)
+                if max_docs is not None and num_docs >= max_docs:
+                    carry = None
+                    break
+            if carry is not None:
+                write_docs([carry])
+    finally:
+        # Stop any shards still in progress before removing their files
+        pool.terminate()
+        pool.join()
+        if shard_folder is not None:
+            shutil.rmtree(shard_folder, ignore_errors=True)
 
 
 if __name__ == "__main__":
     args = parser.parse_args()
-
-create_query_docs(args.queries_folder,
-                  args.doc_ids_path,
-                  args.msmarco_docs_path,
-                  args.output_path,
-                  args.queries_per_psg,
-                  args.files_per_sample,
-                  args.max_docs,
-                  args.append_text)
+    create_query_docs(args.queries_folder,
+                      args.doc_ids_path,
+                      args.msmarco_docs_path,
+                      args.output_path,
+                      args.queries_per_psg,
+                      args.files_per_sample,
+                      args.max_docs,
+                      args.append_text,
+                      args.workers)
 
@@ -0,0 +1,99 @@
+"""Inference backends for generating queries with doc2query-T5 on CPUs.
+
+A backend prepares the T5 model for inference and provides the context
+manager that query generation runs in. Backends are registered by name
+with the `backend` decorator and selected with genq.py's --backend
+argument:
+* eager: The fp32 model, with gradients disabled by torch.no_grad.
+    This is how genq.py originally ran the model.
+* inference_mode: The fp32 model, run in torch.inference_mode, which
+    also skips autograd's version counting and view tracking.
+* int8: Dynamic int8 quantization of the model's linear layers, run in
+    torch.inference_mode. Weights are stored as int8 and activations
+    are quantized on the fly, which is usually much faster on CPUs
+    with AVX2 or AVX-512 VNNI, at the cost of slightly different
+    queries. CPU only.
+
+Huggingface's generate() runs the T5 encoder once per passage and
+copies the encoder output for each of the num_return_sequences samples,
+so encoder outputs are already reused by every backend.
+"""
+
+import torch
+import transformers
+
+# Maps backend names to functions that prepare a model.
+BACKENDS = {}
+
+
+def backend(name):
+    """Decorator that registers a backend function under `name`.
+
+    A backend function takes a model in eval mode and returns a tuple
+    with the prepared model and a function that returns the context
+    manager that generation runs in.
+    """
+    def register(func):
+        BACKENDS[name] = func
+        return func
+    return register
+
+
+@backend('eager')
+def eager(model):
+    """Runs the fp32 model with gradients disabled."""
+    return model, torch.no_grad
+
+
+@backend('inference_mode')
+def inference_mode(model):
+    """Runs the fp32 model in torch.inference_mode."""
+    return model, torch.inference_mode
+
+
+@backend('int8')
+def int8(model):
+    """Quantizes the linear layers to int8 and runs in inference mode."""
+    if next(model.parameters()).device.type != 'cpu':
+        raise ValueError('The int8 backend only runs on CPUs.')
+    model = torch.quantization.quantize_dynamic(
+        model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model, torch.inference_mode
+
+
+def set_threads(num_threads=None, interop_threads=None):
+    """Sets the number of threads used by PyTorch on CPUs.
+
+    Args:
+        num_threads: int, threads used within an operation, such as a
+            matrix multiplication. Usually best set to the number of
+            physical cores. Default of None keeps PyTorch's setting.
+        interop_threads: int, threads used to run independent
+            operations in parallel. Must be set before the model is
+            run. Default of None keeps PyTorch's setting.
+    """
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    if interop_threads is not None:
+        torch.set_num_interop_threads(interop_threads)
+
+
+def load_model(model_name, backend_name, device):
+    """Loads a T5 model and prepares it with a backend.
+
+    Args:
+        model_name: String, Huggingface name of the model.
+        backend_name: String, name of a backend in BACKENDS.
+        device: torch.device the model runs on.
+
+    Returns:
+        A tuple with the prepared model and the function that returns
+        the context manager that generation runs in.
+    """
+    if backend_name not in BACKENDS:
+        raise ValueError('Backend must be one of {}.'
+                         .format(', '.join(BACKENDS)))
+    model = transformers.T5ForConditionalGeneration.from_pretrained(model_name)
+    model.to(device)
+    model.eval()
+    return BACKENDS[backend_name](model)
@@ -0,0 +1,97 @@
+"""Compares the throughput of the doc2query-T5 inference backends.
+
+Splits the first documents of an MS MARCO documents TSV file into a
+fixed sample of passages, generates queries for the sample with each
+backend in backends.py, and prints queries per second and the peak
+resident memory of each backend. Every backend runs in a new process,
+so that peak memory is measured separately for each one.
+
+Run from the repository root:
+python -m docT5query.generate.benchmark_backends \
+    --num-passages 64 --num-threads 4 test_data/msmarco-docs1000.tsv
+"""
+
+import argparse
+import itertools
+import multiprocessing
+import resource
+import time
+
+import torch
+
+import docT5query.generate.backends as backends
+import docT5query.generate.doc_dataset as ds
+import docT5query.generate.genq as genq
+
+
+def load_sample(args):
+    """Returns a list of collated batches of passages."""
+    dataset = ds.DocDataset(args.path, min_len=args.psg_min,
+                            tgt_len=args.psg_tgt, max_len=args.psg_max)
+    passages = list(itertools.islice(dataset, args.num_passages))
+    dataset.close()
+    return [ds.collate_passages(passages[start:start + args.batch_size])
+            for start in range(0, len(passages), args.batch_size)]
+
+
+def run_backend(args, backend_name):
+    """Generates queries for the sample with one backend.
+
+    Returns: A tuple with the number of queries generated, the elapsed
+    seconds, and the process's peak resident memory in MB.
+    """
+    backends.set_threads(args.num_threads, args.interop_threads)
+    batches = load_sample(args)
+    model, inference_context = backends.load_model(
+        genq.MODEL_NAME, backend_name, torch.device('cpu'))
+    torch.manual_seed(0)
+    num_queries = 0
+    start_time = time.perf_counter()
+    for _, _, input_ids, mask in batches:
+        with inference_context():
+            outputs = model.generate(
+                input_ids=input_ids,
+                attention_mask=mask,
+                max_length=args.qry_len,
+                do_sample=True,
+                top_k=10,
+                num_return_sequences=args.num_queries)
+        num_queries += len(outputs)
+    elapsed = time.perf_counter() - start_time
+    # ru_maxrss is in kilobytes on Linux
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return num_queries, elapsed, peak_mb
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('path', help='Path to TSV file with MS Marco documents')
+    parser.add_argument('--num-passages', type=int, default=64)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--num-queries', type=int, default=3)
+    parser.add_argument('--qry-len', type=int, default=64)
+    parser.add_argument('--psg-min', type=int, default=128)
+    parser.add_argument('--psg-tgt', type=int, default=256)
+    parser.add_argument('--psg-max', type=int, default=512)
+    parser.add_argument('--num-threads', type=int)
+    parser.add_argument('--interop-threads', type=int)
+    parser.add_argument('--backends', nargs='+',
+                        default=list(backends.BACKENDS),
+                        choices=list(backends.BACKENDS))
+    args = parser.parse_args()
+
+    print(f'{args.num_passages} passages, {args.num_queries} queries per '
+          f'passage, batch size {args.batch_size}')
+    print('{:<16} {:>10} {:>12} {:>14}'.format(
+        'Backend', 'Seconds', 'Queries/sec', 'Peak RSS (MB)'))
+    context = multiprocessing.get_context('spawn')
+    for backend_name in args.backends:
+        with context.Pool(1) as pool:
+            num_queries, elapsed, peak_mb = pool.apply(
+                run_backend, (args, backend_name))
+        print('{:<16} {:>10.1f} {:>12.2f} {:>14,.0f}'.format(
+            backend_name, elapsed, num_queries / elapsed, peak_mb))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""Compares per-sentence and batched tokenization in DocDataset.
+
+Splits the documents in an MS MARCO documents TSV file into T5
+passages twice: once with a tokenizer call for every sentence, as
+DocDataset.split_doc_text did originally, and once with
+DocDataset.split_docs_text, which tokenizes the sentences of a whole
+batch of documents with a single tokenizer call. Checks that both give
+the same passages, and prints sentences per second for each. Sentence
+splitting with nltk is timed separately, because both approaches must
+do it.
+
+Run from the repository root:
+python -m docT5query.generate.benchmark_tokenizer \
+    test_data/msmarco-docs1000.tsv
+"""
+
+import argparse
+import itertools
+import time
+
+import nltk.tokenize
+
+import docT5query.generate.doc_dataset as ds
+
+
+def read_doc_texts(doc_path, max_docs):
+    """Reads 'title text' strings from an MS MARCO documents file."""
+    doc_texts = []
+    with open(doc_path, encoding='utf-8') as dfile:
+        for line in itertools.islice(dfile, max_docs):
+            split_line = line.rstrip('\n').split('\t')
+            doc_texts.append(split_line[2] + ' ' + split_line[3])
+    return doc_texts
+
+
+def split_per_sentence(dataset, doc_texts):
+    """Splits documents with one tokenizer call per sentence."""
+    return [dataset.assemble_passages(
+                [dataset.tokenizer(sentence)['input_ids']
+                 for sentence in nltk.tokenize.sent_tokenize(doc_text)])
+            for doc_text in doc_texts]
+
+
+def split_batched(dataset, doc_texts, batch_size):
+    """Splits documents with one tokenizer call per batch."""
+    docs_passages = []
+    for start in range(0, len(doc_texts), batch_size):
+        docs_passages.extend(
+            dataset.split_docs_text(doc_texts[start:start + batch_size]))
+    return docs_passages
+
+
+def timed(func, *args):
+    """Returns the function's result and the elapsed seconds."""
+    start_time = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('path', help='Path to TSV file with MS Marco documents')
+    parser.add_argument('--max-docs', type=int, default=1000)
+    parser.add_argument('--doc-batch-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    doc_texts = read_doc_texts(args.path, args.max_docs)
+    sentences, split_time = timed(
+        lambda: [nltk.tokenize.sent_tokenize(doc_text)
+                 for doc_text in doc_texts])
+    num_sentences = sum(map(len, sentences))
+    print('{:,} documents, {:,} sentences. Sentence splitting: {:,.0f} '
+          'sentences per second.'.format(len(doc_texts), num_sentences,
+                                         num_sentences / split_time))
+    print('Sentences per second, including sentence splitting.')
+    print('{:<10} {:>14} {:>14} {:>8}'.format(
+        'Tokenizer', 'Per-Sentence', 'Batched', 'Speedup'))
+    for fast_tokenizer in [True, False]:
+        dataset = ds.DocDataset(args.path, fast_tokenizer=fast_tokenizer)
+        expected, per_sentence_time = timed(split_per_sentence, dataset,
+                                            doc_texts)
+        passages, batched_time = timed(split_batched, dataset, doc_texts,
+                                       args.doc_batch_size)
+        assert passages == expected
+        print('{:<10} {:>14,.0f} {:>14,.0f} {:>7.1f}x'.format(
+            'fast' if fast_tokenizer else 'slow',
+            num_sentences / per_sentence_time, num_sentences / batched_time,
+            per_sentence_time / batched_time))
+
+
+if __name__ == '__main__':
+    main()
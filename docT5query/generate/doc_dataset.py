@@ -1,5 +1,6 @@
 """Functions for generating queries with doc2query-T5
 """
+import itertools
 import os.path
 import sys
 
@@ -12,6 +13,7 @@ dirname = os.path.dirname(os.path.abspath(__file__))
 repo_root = os.path.abspath(os.path.join(dirname, '../..'))
 sys.path.insert(0, repo_root)
 import util.indexer
+import util.splitter
 
 MODEL_NAME = 'castorini/doc2query-t5-base-msmarco'
 BASE_MODEL_NAME = 't5-base'
@@ -20,6 +22,72 @@ BASE_MODEL_NAME = 't5-base'
 # Dataset should return docid, pos, passage
 
 
+def collate_passages(batch, pad_len=None):
+    """Combines passages from DocDataset into a padded batch.
+
+    Pass this function to the DataLoader's collate_fn argument. Each
+    batch is padded only to the length of its longest passage, rather
+    than to the maximum passage length, so the T5 encoder does not
+    process padding tokens that every passage in the batch would
+    ignore.
+
+    Args:
+        batch: List of (docid, position, input_ids, attention_mask)
+            tuples from DocDataset.
+        pad_len: int, pad every batch to this length instead of the
+            length of the longest passage. Optional. Defaults to None.
+
+    Returns:
+        A tuple with a list of docids, a tensor of passage positions,
+        and the padded input_ids and attention_mask tensors, which
+        have shape (len(batch), padded length).
+    """
+    doc_ids, positions, input_ids, _ = zip(*batch)
+    if pad_len is None:
+        pad_len = max(len(passage_ids) for passage_ids in input_ids)
+    padded_ids = torch.zeros((len(batch), pad_len), dtype=torch.long)
+    attention_mask = torch.zeros((len(batch), pad_len), dtype=torch.long)
+    for row, passage_ids in enumerate(input_ids):
+        padded_ids[row, :len(passage_ids)] = passage_ids
+        attention_mask[row, :len(passage_ids)] = 1
+    return list(doc_ids), torch.tensor(positions), padded_ids, attention_mask
+
+
+class LengthBucketedDataset(torch.utils.data.IterableDataset):
+    """Groups passages of similar length into the same batches.
+
+    Reads a window of passages from a DocDataset and yields them sorted
+    by length, so that a DataLoader with the same batch size creates
+    batches of passages with similar lengths. Combined with
+    collate_passages, this reduces the padding in each batch.
+    Passages are yielded in a different order, but every passage is
+    still yielded exactly once with its docid and position.
+    """
+    def __init__(self, dataset, batch_size, window_batches=64):
+        """Initializes dataset object.
+                Args:
+                    dataset: DocDataset that yields the passages.
+                    batch_size: int, the DataLoader's batch size.
+                    window_batches: int, number of batches of passages
+                            that are sorted together. Larger windows
+                            give batches with more similar lengths.
+        """
+        super().__init__()
+        self.dataset = dataset
+        self.window = batch_size * window_batches
+
+    def __iter__(self):
+        # DocDataset.__iter__ restarts its generator, so islice must be
+        # given a generator that calls it only once
+        passages = (passage for passage in self.dataset)
+        while True:
+            window = list(itertools.islice(passages, self.window))
+            if not window:
+                return
+            window.sort(key=lambda passage: len(passage[2]))
+            yield from window
+
+
 class DocDataset(torch.utils.data.IterableDataset):
     """Pytorch dataset -- can be fed to Pytorch models.
     """
@@ -31,11 +99,27 @@ class DocDataset(torch.utils.data.IterableDataset):
                  min_len=128,
                  max_passages=None,
                  max_docs_in=None,
-                 fast_tokenizer=True):
+                 fast_tokenizer=True,
+                 doc_range=None,
+                 sentence_cache=False,
+                 sentence_workers=1,
+                 build_sentence_cache=True):
         """Initializes dataset object.
+
+        Passages are yielded without padding, as (docid, position,
+        input_ids, attention_mask) tuples. Use collate_passages as the
+        DataLoader's collate_fn to pad them into batches.
+
+        The dataset can be loaded by a DataLoader with num_workers > 0.
+        Each worker process reads, sentence splits and tokenizes its own
+        contiguous range of documents (see worker_lines).
+
                 Args:
                     doc_path: String, path to msmarco tsv file with
-                            documents
+                            documents, or to a Parquet file created
+                            by util/columnar.py. Only the doc_id,
+                            title and text columns of a Parquet file
+                            are read.
                     max_len: int, the maximum allowed sequence length.
                             Sentences will be split if needed to stay
                             below this limit.
@@ -47,16 +131,40 @@ class DocDataset(torch.utils.data.IterableDataset):
                             above this limit.
                     max_passages: int, dataset will stop sending data
                             after the number of specified passages are
-                            generated. Default of None means all data in
-                            file will be processed.
+                            generated. With DataLoader workers, the
+                            limit is split across the workers (see
+                            worker_max_passages). Default of None means
+                            all data in file will be processed.
                     max_docs: int, dataset will stop sending data
                             after the number of specified documents
                             are generated. Default of None means all
                             data in file will be processed.
+                    doc_range: (start, end) tuple of document line
+                            numbers, end excluded. Only these documents
+                            are processed. Can be changed between
+                            iterations. Default of None means all
+                            documents.
+                    sentence_cache: bool, if True, the sentence
+                            boundaries of the documents are read from
+                            a util.splitter.SentenceIndex sidecar file,
+                            which is built first if it does not exist.
+                            The same sidecar file is used by
+                            deepCT/doc_split/doc_to_psg.py. Default of
+                            False splits documents into sentences as
+                            they are read.
+                    sentence_workers: int, number of processes that
+                            build the sidecar file. Default is 1.
+                    build_sentence_cache: bool, if False, the sidecar
+                            file must already exist and match the
+                            documents file, or a ValueError is raised.
+                            Use this when several machines read the same
+                            documents file, so that each one does not
+                            build the sidecar file again. Default is
+                            True.
         """
-        super(DocDataset).__init__()
+        super().__init__()
         self.doc_path = doc_path
-        self.doc_idx = util.indexer.IndexedFile(doc_path, 0, line_idx=True)
+        self.doc_idx = util.indexer.open_index(doc_path, 0, line_idx=True)
         self.max_len = max_len
         self.tgt_len = tgt_len
         self.min_len = min_len
@@ -65,55 +173,146 @@ class DocDataset(torch.utils.data.IterableDataset):
             self.tokenizer = transformers.T5TokenizerFast.from_pretrained(
             BASE_MODEL_NAME)
         else:
-            self.tokenizer_model = transformers.T5Tokenizer.from_pretrained(
+            self.tokenizer = transformers.T5Tokenizer.from_pretrained(
                 MODEL_NAME)
         self.max_passages = max_passages
         self.passage_generator = None
         self.max_docs = max_docs_in
+        self.doc_range = doc_range
         self.doc_batch_size = 1000 if doc_batch_size is None else doc_batch_size
+        self.sentence_idx = None
+        if sentence_cache:
+            self.sentence_idx = util.splitter.SentenceIndex(
+                doc_path, sentence_workers, build_sentence_cache)
+
+    def __getstate__(self):
+        """Excludes the open line index when sent to worker processes."""
+        state = self.__dict__.copy()
+        state['doc_idx'] = None
+        state['passage_generator'] = None
+        return state
+
+    def num_docs(self):
+        """Gets the number of documents, limited to max_docs."""
+        if self.doc_idx is None:  # Reopen line index in worker processes
+            self.doc_idx = util.indexer.open_index(self.doc_path, 0,
+                                                   line_idx=True)
+        if self.doc_path.endswith('.parquet'):
+            num_lines = len(self.doc_idx)
+        else:
+            num_lines = len(self.doc_idx.lines)
+        if self.max_docs is not None:
+            num_lines = min(num_lines, self.max_docs)
+        return num_lines
+
+    def worker_lines(self):
+        """Gets the range of document lines for the current process.
+
+        The range is limited to doc_range, if it is set. When the
+        dataset is loaded by a DataLoader with num_workers > 0, the
+        range is split into one contiguous range of lines per worker,
+        so that every passage is yielded by exactly one worker.
+
+        Returns:
+            A (start line, end line) tuple. The end line is excluded.
+        """
+        num_lines = self.num_docs()
+        start_line, end_line = 0, num_lines
+        if self.doc_range is not None:
+            start_line = min(self.doc_range[0], num_lines)
+            end_line = min(self.doc_range[1], num_lines)
+        worker_info = torch.utils.data.get_worker_info()
+        if worker_info is None:
+            return start_line, end_line
+        num_lines = end_line - start_line
+        return (start_line
+                + num_lines * worker_info.id // worker_info.num_workers,
+                start_line
+                + num_lines * (worker_info.id + 1) // worker_info.num_workers)
+
+    def worker_max_passages(self):
+        """Gets the passage limit for the current process.
+
+        When the dataset is loaded by a DataLoader with num_workers > 0,
+        max_passages is split between the workers the same way as the
+        document lines, so that together they yield at most
+        max_passages passages. A worker whose documents have fewer
+        passages than its share does not pass the rest to the others.
+
+        Returns:
+            The maximum number of passages, or None for no limit.
+        """
+        worker_info = torch.utils.data.get_worker_info()
+        if self.max_passages is None or worker_info is None:
+            return self.max_passages
+        return (self.max_passages * (worker_info.id + 1)
+                // worker_info.num_workers
+                - self.max_passages * worker_info.id
+                // worker_info.num_workers)
+
+    def read_docs(self, start_line, end_line):
+        """Reads a range of documents.
+
+        Documents in a TSV file are read with a single read, starting at
+        the byte position stored in the line index. Only the doc_id,
+        title and text columns of a Parquet file are read.
+
+        Returns:
+            A list of (docid, title, text) tuples.
+        """
+        if self.doc_path.endswith('.parquet'):
+            return list(self.doc_idx.iter_rows(['doc_id', 'title', 'text'],
+                                               start=start_line,
+                                               stop=end_line))
+        with open(self.doc_path, 'rb') as dfile:
+            start_byte_pos = self.doc_idx.lines[start_line][0]
+            dfile.seek(start_byte_pos)
+            if end_line < len(self.doc_idx.lines):
+                end_byte_pos = self.doc_idx.lines[end_line][0]
+                data = dfile.read(end_byte_pos - start_byte_pos)
+            else:
+                data = dfile.read()
+        docs = []
+        for line in data.decode('utf-8').split('\n'):
+            if line == '':
+                continue
+            split_line = line.split('\t')
+            docs.append((split_line[0], split_line[2], split_line[3]))
+        return docs
 
     def init_passage_generator(self):
+        """Yields passages from this process's range of documents.
+
+        Documents are read doc_batch_size lines at a time with
+        read_docs(). With multiple DataLoader workers, each worker
+        yields at most its share of max_passages.
+        """
         num_passages = 0
-        doc_counter = 0
-        num_lines = len(self.doc_idx)
-        line_pos = min(self.doc_batch_size, num_lines-1)
-        start_byte_pos = 0
-        self.dfile = open(self.doc_path, 'rb')
-        while line_pos < num_lines:
-            print(f'Reading next {line_pos + 1} documents')
-            end_byte_pos = self.doc_idx.lines[line_pos][0]
-            if line_pos < num_lines-1:
-                data = self.dfile.read(end_byte_pos - start_byte_pos)
-                line_pos = min(line_pos + self.doc_batch_size, num_lines-1)
-            else:
-                data = self.dfile.read()
-                line_pos = num_lines
-            start_byte_pos = end_byte_pos
-            text =  data.decode('utf-8')
-            lines = text.split('\n')
-
-            for line in lines:
-                if line == '':
-                    return
-                if self.max_docs is not None and doc_counter >= self.max_docs:
-                    return
-                doc_counter += 1
-                split_line = line.split('\t')
-                doc = {'docid': split_line[0],
-                        'url': split_line[1],
-                        'title': split_line[2],
-                        'text': split_line[3]}
-                passages = self.split_doc_text(doc['title'] + ' ' + doc['text'])
+        max_passages = self.worker_max_passages()
+        start_line, end_line = self.worker_lines()
+        for batch_start in range(start_line, end_line, self.doc_batch_size):
+            batch_end = min(batch_start + self.doc_batch_size, end_line)
+            print(f'Reading documents {batch_start + 1} to {batch_end}')
+            docs = self.read_docs(batch_start, batch_end)
+            doc_texts = [title + ' ' + text for _, title, text in docs]
+            doc_sentences = None
+            if self.sentence_idx is not None:
+                doc_sentences = [
+                    self.sentence_idx.sentences(doc_num, doc_text)
+                    for doc_num, doc_text in enumerate(doc_texts,
+                                                       batch_start)]
+            # Tokenize every sentence in the batch with one call
+            docs_passages = self.split_docs_text(doc_texts, doc_sentences)
+            for (docid, _, _), passages in zip(docs, docs_passages):
                 for passage in passages:
-                    if (self.max_passages is not None and
-                            num_passages >= self.max_passages):
+                    if (max_passages is not None and
+                            num_passages >= max_passages):
                         return
                     num_passages += 1
-                    yield (doc['docid'], passage['position'],
+                    yield (docid, passage['position'],
                             torch.tensor(passage['input_ids']),
                             torch.tensor(passage['attention_mask']))
 
-
     def __iter__(self):
         self.passage_generator = self.init_passage_generator()
         return self
@@ -122,14 +321,64 @@ class DocDataset(torch.utils.data.IterableDataset):
         return next(self.passage_generator)
 
     def close(self):
-        self.dfile.close()
+        if self.passage_generator is not None:
+            self.passage_generator.close()
 
     def split_doc_text(self, doc_text):
         """Splits document at sentence boundaries and tokenizes for T5.
-        
+
         Args:
             doc: String, the document to be split
-                
+
+        Returns:
+            A list of passage dictionaries. See assemble_passages.
+        """
+        return self.split_docs_text([doc_text])[0]
+
+    def split_docs_text(self, doc_texts, doc_sentences=None):
+        """Splits a batch of documents into passages for T5.
+
+        The sentences of all documents are tokenized with a single
+        tokenizer call, rather than one call per sentence. The fast
+        tokenizer tokenizes the whole batch in Rust, so the Python to
+        Rust call overhead is paid once per batch.
+
+        Args:
+            doc_texts: List of strings, the documents to be split.
+            doc_sentences: List with a list of sentences for each
+                document, e.g., from a util.splitter.SentenceIndex.
+                Optional. If None, the documents are split into
+                sentences with nltk.
+
+        Returns:
+            A list with one list of passage dictionaries per document.
+            See assemble_passages.
+        """
+        if doc_sentences is None:
+            doc_sentences = [nltk.tokenize.sent_tokenize(doc_text)
+                             for doc_text in doc_texts]
+        all_sentences = list(itertools.chain.from_iterable(doc_sentences))
+        if not all_sentences:
+            return [[] for _ in doc_texts]
+        tokenized_sentences = self.tokenizer(all_sentences)['input_ids']
+        docs_passages = []
+        start = 0
+        for sentences in doc_sentences:
+            end = start + len(sentences)
+            docs_passages.append(
+                self.assemble_passages(tokenized_sentences[start:end]))
+            start = end
+        return docs_passages
+
+    def assemble_passages(self, tokenized_sentences):
+        """Combines a document's tokenized sentences into passages.
+
+        See util.splitter.token_passages().
+
+        Args:
+            tokenized_sentences: List with a list of T5 input IDs for
+                each sentence in the document.
+
         Returns:
             A list of dictionaries, with one dictionary per passage.
             The keys are:
@@ -137,52 +386,11 @@ class DocDataset(torch.utils.data.IterableDataset):
                 input_ids: token ID values generated by T5 tokenizer
                 attention_mask: List of ones that are the same length as
                     the input_ids.
+            Passages are not padded. See collate_passages.
         """
-        # Create list of (sentence position, sentence length, list of T5 input
-        #     IDs, passage_id)
-        tokenized_sentences = [self.tokenizer(sentence)['input_ids']
-                            for sentence
-                            in nltk.tokenize.sent_tokenize(doc_text)]
-        sentence_data = [(pos, len(sentence), sentence)
-                    for pos, sentence in enumerate(tokenized_sentences)]
-        
-        passage = []    
-        passages = []
-        for sentence in sentence_data:
-            curr_len = len(passage) + sentence[1]
-            if curr_len <= self.tgt_len:    # Too short - add another sentence
-                passage.extend(sentence[2]) 
-            elif curr_len <= self.max_len:  # Just right, start another passage
-                passage.extend(sentence[2])
-                passages.append(passage)   
-                passage = []
-            else:                           # Oh-oh, above max length
-                if len(passage) > self.min_len:  # Reached min length
-                    passages.append(passage)     #   Start next passage
-                    passage = sentence[2]
-                else:            # Did not reach min len, break up sentence.
-                    sentence_break = self.max_len - len(passage)
-                    passage.extend(sentence[2][:sentence_break])
-                    passages.append(passage)
-                    passage = sentence[2][sentence_break:]
-                while len(passage) > self.max_len:  # Longer than max_len
-                    passages.append(passage[:self.max_len])
-                    passage = passage[self.max_len:]
-        if len(passage) > 0:  # Don't forget to append final passage.
-            passages.append(passage)
-
-        # Pad all passages and masks to self.max_len
-        padded_passages = []
-        for pos, passage in enumerate(passages):
-            passage_len = len(passage)
-            padding_len = self.max_len - passage_len
-            padding = [0] * padding_len
-            passage.extend(padding)
-            attention_mask = [1] * passage_len
-            attention_mask.extend(padding)
-            padded_record = {'position': pos,
-                             'input_ids': passage,
-                             'attention_mask': attention_mask}
-            padded_passages.append(padded_record)
-
-        return padded_passages
+        passages = util.splitter.token_passages(
+            tokenized_sentences, self.tgt_len, self.max_len, self.min_len)
+        return [{'position': pos,
+                 'input_ids': passage,
+                 'attention_mask': [1] * len(passage)}
+                for pos, passage in enumerate(passages)]
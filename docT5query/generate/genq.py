@@ -38,16 +38,38 @@ args = types.SimpleNamespace(
     qry_len=64,
     max_docs_in=None,
     doc_read_batch_size=None,
-    fast_tokenizer=True)
+    fast_tokenizer=True,
+    bucket_window=0,
+    fixed_padding=False,
+    num_workers=0,
+    prefetch_factor=2,
+    shard_size=None,
+    shard_index=0,
+    num_shards=1,
+    resume=False,
+    backend='eager',
+    num_threads=None,
+    interop_threads=None,
+    decode_queue_size=4,
+    cache_file=None,
+    sentence_cache=False,
+    sentence_workers=1)
 
 genq.generate_queries(args)
 ```
 """
 
 import argparse
+import collections
+import functools
 import itertools
+import json
+import os
 import os.path
+import queue
 import sys
+import threading
+import time
 
 import torch
 import torch.utils.data
@@ -56,11 +78,19 @@ import transformers
 # Import modules relative to top-level repo folder
 REPO_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '../..'))
 sys.path.append(REPO_PATH)
+import docT5query.generate.backends as backends
 import docT5query.generate.doc_dataset as ds
+import docT5query.generate.query_cache as query_cache
 import util.log
 
 MODEL_NAME = 'castorini/doc2query-t5-base-msmarco'
 
+# Size of the output file buffer, in bytes
+WRITE_BUFFER_SIZE = 1 << 20
+
+# Sampling settings passed to model.generate()
+SAMPLING_ARGS = {'do_sample': True, 'top_k': 10}
+
 # Set up command-line arguments.
          
 
@@ -75,6 +105,169 @@ def expand_list(data, reps):
     return flat_list
 
 
+class QueryWriter(threading.Thread):
+    """Decodes generated queries and writes them in a background thread.
+
+    The generation loop hands each batch of output token IDs to the
+    writer with put() and moves on to the next batch, while the writer
+    decodes the batch with the tokenizer's batch_decode and writes the
+    queries. The queue between them is bounded, so generation waits if
+    the writer falls behind by more than max_pending batches. Batches
+    are written in the order they are put. If a query_cache.QueryCache
+    is given, decoded queries are also stored in the cache.
+    """
+    def __init__(self, tokenizer, ofile, max_pending=4, cache=None):
+        """Initializes the writer. Call start() before put().
+
+        Args:
+            tokenizer: Tokenizer used to decode the output token IDs.
+            ofile: Text file that the queries are written to.
+            max_pending: int, maximum number of batches waiting to be
+                decoded.
+            cache: QueryCache that decoded queries are stored in.
+                Optional. Defaults to None.
+        """
+        super().__init__(daemon=True)
+        self.tokenizer = tokenizer
+        self.ofile = ofile
+        self.cache = cache
+        self.queue = queue.Queue(max_pending)
+        self.error = None
+        self.decode_time = 0.0
+        self.write_time = 0.0
+
+    def put(self, doc_ids, positions, outputs, cache_keys=None):
+        """Queues a batch of generated queries to be decoded and written.
+
+        Args:
+            doc_ids, positions: Lists with the document ID and passage
+                position of each output sequence.
+            outputs: Tensor of output token IDs, on the CPU, or a list
+                of query strings that are written without decoding.
+            cache_keys: List with the cache key of each passage. The
+                output sequences for each passage are consecutive.
+                Optional. Defaults to None, which does not cache the
+                queries.
+        """
+        if self.error is not None:
+            raise self.error
+        self.queue.put((doc_ids, positions, outputs, cache_keys))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is not None:
+                continue  # Keep emptying the queue so put() does not block
+            try:
+                doc_ids, positions, outputs, cache_keys = item
+                decode_start = time.perf_counter()
+                queries = outputs
+                if not isinstance(outputs, list):
+                    queries = self.tokenizer.batch_decode(
+                        outputs, skip_special_tokens=True)
+                if cache_keys:
+                    num_queries = len(queries) // len(cache_keys)
+                    self.cache.put_many({
+                        key: queries[idx * num_queries:
+                                     (idx + 1) * num_queries]
+                        for idx, key in enumerate(cache_keys)})
+                write_start = time.perf_counter()
+                self.ofile.write(''.join(
+                    [f'{doc_id}\t{position}\t{qry_txt}\n'
+                     for doc_id, position, qry_txt
+                     in zip(doc_ids, positions, queries)]))
+                self.decode_time += write_start - decode_start
+                self.write_time += time.perf_counter() - write_start
+            except BaseException as error:
+                self.error = error
+
+    def close(self):
+        """Waits for every queued batch to be written."""
+        self.queue.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+
+
+def shard_ranges(num_docs, shard_size, shard_index, num_shards):
+    """Lists the output shards that are processed by this machine.
+
+    Documents are split into shards of shard_size consecutive documents,
+    and shard number N is processed by the machine whose shard_index is
+    N % num_shards, so machines split the corpus deterministically.
+
+    Args:
+        num_docs: int, number of documents in the input file.
+        shard_size: int, number of documents in each shard. If None,
+            the documents are split evenly across the num_shards
+            machines.
+        shard_index: int, this machine's index, from 0 to num_shards - 1.
+        num_shards: int, number of machines.
+
+    Returns:
+        A list of (shard number, start line, end line) tuples. The end
+        line is excluded.
+    """
+    if shard_size is None:
+        shard_size = max(-(-num_docs // num_shards), 1)
+    return [(shard_num, start, min(start + shard_size, num_docs))
+            for shard_num, start in enumerate(range(0, num_docs, shard_size))
+            if shard_num % num_shards == shard_index]
+
+
+def shard_file_name(args, shard_num):
+    """Gets the path of an output shard file.
+
+    Without --shard-size or --num-shards, all queries are written to
+    --output-file. Otherwise the shard number is added to its name.
+    """
+    if args.shard_size is None and args.num_shards == 1:
+        return args.output_file
+    root, ext = os.path.splitext(args.output_file)
+    return f'{root}_{shard_num:05}{ext}'
+
+
+def read_manifest(args):
+    """Reads or creates the manifest of completed output shards.
+
+    The manifest is a JSON file saved next to the output file. It
+    records the document range and number of passages and queries of
+    every completed shard, and the arguments that determine the shards'
+    contents. Each machine has its own manifest.
+
+    Returns:
+        A tuple with the manifest path and the manifest dictionary.
+        Raises ValueError if --resume is used and the existing manifest
+        was created with different arguments.
+    """
+    root, _ = os.path.splitext(args.output_file)
+    manifest_path = root + '.manifest'
+    if args.num_shards > 1:
+        manifest_path = (root + f'.{args.shard_index}-of-{args.num_shards}'
+                         '.manifest')
+    settings = {arg: getattr(args, arg) for arg in
+                ['path', 'shard_size', 'shard_index', 'num_shards',
+                 'psg_min', 'psg_tgt', 'psg_max', 'num_queries', 'qry_len',
+                 'max_docs_in', 'max_psg_in']}
+    if args.resume and os.path.isfile(manifest_path):
+        with open(manifest_path) as mfile:
+            manifest = json.load(mfile)
+        if manifest['settings'] != settings:
+            raise ValueError(f'{manifest_path} was created with different '
+                             'arguments. Run without --resume to start over.')
+        return manifest_path, manifest
+    return manifest_path, {'settings': settings, 'shards': {}}
+
+
+def save_manifest(manifest_path, manifest):
+    """Saves the manifest by replacing it with a complete new copy."""
+    with open(manifest_path + '.tmp', 'wt') as mfile:
+        json.dump(manifest, mfile, indent=1)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
 def generate_queries(args):
     # Setup logging and display startup messages
     logger = util.log.get('Query_generation_doc2queryT5')
@@ -91,11 +284,27 @@ def generate_queries(args):
                                 max_len=args.psg_max,
                                 max_passages=args.max_psg_in,
                                 max_docs_in=args.max_docs_in,
-                                fast_tokenizer=args.fast_tokenizer)
+                                fast_tokenizer=args.fast_tokenizer,
+                                sentence_cache=args.sentence_cache,
+                                sentence_workers=args.sentence_workers,
+                                # Machines share one prebuilt sidecar file
+                                build_sentence_cache=args.num_shards == 1)
     logger.info('Created document dataset')
+    passages = doc_dataset
+    if args.bucket_window:
+        passages = ds.LengthBucketedDataset(doc_dataset, args.t5_batch_size,
+                                            args.bucket_window)
+    pad_len = args.psg_max if args.fixed_padding else None
+    # Worker processes split and tokenize documents while the model runs
+    loader_args = {}
+    if args.num_workers > 0:
+        loader_args = {'num_workers': args.num_workers,
+                       'prefetch_factor': args.prefetch_factor}
     doc_loader = torch.utils.data.DataLoader(
-        doc_dataset,
-        batch_size=args.t5_batch_size
+        passages,
+        batch_size=args.t5_batch_size,
+        collate_fn=functools.partial(ds.collate_passages, pad_len=pad_len),
+        **loader_args
     )
     logger.info('Created document loader')
 
@@ -104,48 +313,204 @@ def generate_queries(args):
     logger.info(f'Initialized tokenizer for {MODEL_NAME}')
 
     # Create model and send to GPU
+    backends.set_threads(args.num_threads, args.interop_threads)
     device_name = 'cuda' if torch.cuda.is_available() else 'cpu'
     device = torch.device(device_name)
-    logger.info(f'Initializing model and sending to {device_name}')
-    model = transformers.T5ForConditionalGeneration.from_pretrained(MODEL_NAME)
-    model.to(device)
-    model.eval()
-    logger.info('Model initialized')
-
-    # Query Generation Loop
-    ofile = open(args.output_file, 'wt')
+    logger.info(f'Initializing model with {args.backend} backend and '
+                f'sending to {device_name}')
+    model, inference_context = backends.load_model(MODEL_NAME, args.backend,
+                                                   device)
+    logger.info(f'Model initialized, using {torch.get_num_threads()} threads')
+
+    # Generated queries are reused for passages that are in the cache
+    cache = None
+    if args.cache_file is not None:
+        cache = query_cache.QueryCache(
+            args.cache_file,
+            dict(SAMPLING_ARGS, model=MODEL_NAME, backend=args.backend,
+                 qry_len=args.qry_len, num_queries=args.num_queries))
+        logger.info(f'Opened query cache {args.cache_file} with '
+                    f'{len(cache)} passages')
+
+    # Generate the queries for each output shard
+    manifest_path, manifest = read_manifest(args)
+    num_docs = doc_dataset.num_docs()
+    shards = shard_ranges(num_docs, args.shard_size, args.shard_index,
+                          args.num_shards)
+    logger.info(f'{len(shards)} output shards for {num_docs} documents')
+    num_passages = 0
+    num_tokens = 0
+    num_generated = 0
+    # --max-psg-in limits the passages of all shards together
+    remaining_passages = args.max_psg_in
+    timings = collections.Counter()
+    start_time = time.time()
+    for shard_num, start_line, end_line in shards:
+        shard_file = shard_file_name(args, shard_num)
+        shard_name = os.path.basename(shard_file)
+        if shard_name in manifest['shards'] and os.path.isfile(shard_file):
+            logger.info(f'Skipping completed shard {shard_name}')
+            if remaining_passages is not None:
+                remaining_passages -= manifest['shards'][shard_name][
+                    'passages']
+            continue
+        if remaining_passages is not None and remaining_passages <= 0:
+            logger.info(f'Reached --max-psg-in of {args.max_psg_in} '
+                        f'passages, skipping remaining shards')
+            break
+        doc_dataset.max_passages = remaining_passages
+        logger.info(f'Generating queries for documents {start_line + 1} to '
+                    f'{end_line} in {shard_name}')
+        # The dataset seeks to the shard's first document with the line index
+        doc_dataset.doc_range = (start_line, end_line)
+        with open(shard_file + '.tmp', 'wt',
+                  buffering=WRITE_BUFFER_SIZE) as ofile:
+            writer = QueryWriter(tokenizer, ofile, args.decode_queue_size,
+                                 cache)
+            writer.start()
+            try:
+                shard_passages, shard_tokens, shard_generated = generate_shard(
+                    args, doc_loader, model, inference_context, device,
+                    writer, cache, timings, logger)
+            finally:
+                writer.close()
+            timings['decode'] += writer.decode_time
+            timings['write'] += writer.write_time
+        os.replace(shard_file + '.tmp', shard_file)
+        manifest['shards'][shard_name] = {
+            'docs': [start_line, end_line],
+            'passages': shard_passages,
+            'queries': shard_passages * args.num_queries}
+        save_manifest(manifest_path, manifest)
+        num_passages += shard_passages
+        if remaining_passages is not None:
+            remaining_passages -= shard_passages
+        num_tokens += shard_tokens
+        num_generated += shard_generated
+
+    logger.info('Finished all batches')
+    elapsed = time.time() - start_time
+    if num_passages:
+        logger.info(f'Generated queries for {num_passages} passages in '
+                    f'{elapsed:.1f} seconds, {num_passages / elapsed:.2f} '
+                    f'passages per second')
+        logger.info(f'Average padded passage length: '
+                    f'{num_tokens / num_passages:.1f} tokens')
+        # Decoding and writing overlap with loading and generation
+        logger.info('Seconds per stage - ' + ', '.join(
+            f'{stage}: {timings[stage]:.1f}' for stage
+            in ['load', 'cache', 'generate', 'queue_wait', 'decode',
+                'write']))
+    if cache is not None:
+        logger.info(f'Query cache: {cache.hits} hits, {cache.misses} misses, '
+                    f'hit rate {cache.hit_rate():.1%}, {len(cache)} '
+                    f'passages stored')
+        if num_generated:
+            # Estimated from the average time to generate one passage
+            saved = cache.hits * timings['generate'] / num_generated
+            logger.info(f'Estimated generation time saved by the cache: '
+                        f'{saved:.1f} seconds')
+        cache.close()
+    doc_dataset.close()
+
+
+def generate_shard(args, doc_loader, model, inference_context, device,
+                   writer, cache, timings, logger):
+    """Generates queries for the passages from doc_loader.
+
+    The model runs in the context manager returned by
+    inference_context(). See backends.load_model(). The output token
+    IDs are passed to a QueryWriter, which decodes and writes them
+    while the next batch is generated. Seconds spent waiting for
+    batches from doc_loader ('load'), looking up passages in the cache
+    ('cache'), generating ('generate') and waiting for the writer
+    ('queue_wait') are added to timings.
+
+    If cache is a query_cache.QueryCache, passages whose queries are in
+    the cache are not run through the model, and their cached queries
+    are written instead.
+
+    Returns:
+        A tuple with the number of passages, the number of padded input
+        tokens that were processed, and the number of passages that
+        were run through the model.
+    """
+    num_passages = 0
+    num_tokens = 0
+    num_generated = 0
+    stage_start = time.perf_counter()
     for batch_num, batch in enumerate(doc_loader):
-        logger.info(f'Starting batch {batch_num + 1}')
+        generate_start = time.perf_counter()
+        timings['load'] += generate_start - stage_start
+        logger.info(f'Starting batch {batch_num + 1}, '
+                    f'padded length {batch[2].shape[1]}')
+        num_passages += len(batch[0])
+        num_tokens += batch[2].numel()
+        batch_doc_ids = batch[0]
+        batch_positions = batch[1].tolist()
+        input_ids = batch[2]
+        mask = batch[3]
+        cache_keys = None
+        if cache is not None:
+            lengths = mask.sum(dim=1).tolist()
+            keys = [cache.key(token_ids[:length]) for token_ids, length
+                    in zip(input_ids.tolist(), lengths)]
+            cached = cache.get_many(keys)
+            hits = [idx for idx, key in enumerate(keys) if key in cached]
+            if hits:
+                writer.put(
+                    expand_list([batch_doc_ids[idx] for idx in hits],
+                                args.num_queries),
+                    expand_list([batch_positions[idx] for idx in hits],
+                                args.num_queries),
+                    list(itertools.chain.from_iterable(
+                        cached[keys[idx]] for idx in hits)))
+            misses = [idx for idx, key in enumerate(keys)
+                      if key not in cached]
+            if not misses:
+                stage_start = time.perf_counter()
+                timings['cache'] += stage_start - generate_start
+                continue
+            batch_doc_ids = [batch_doc_ids[idx] for idx in misses]
+            batch_positions = [batch_positions[idx] for idx in misses]
+            cache_keys = [keys[idx] for idx in misses]
+            # Trim padding that only the cached passages needed
+            mask = mask[misses]
+            input_ids = input_ids[misses][:, :int(mask.sum(dim=1).max())]
+            mask = mask[:, :input_ids.shape[1]]
+            cache_time = time.perf_counter()
+            timings['cache'] += cache_time - generate_start
+            generate_start = cache_time
+        num_generated += len(batch_doc_ids)
+
         # Setup model inputs
-        doc_ids = expand_list(batch[0], args.num_queries)
-        positions = expand_list(batch[1], args.num_queries)
-        input_ids = batch[2].to(device)  # To GPU
-        mask = batch[3].to(device)       # To GPU
+        doc_ids = expand_list(batch_doc_ids, args.num_queries)
+        positions = expand_list(batch_positions, args.num_queries)
+        input_ids = input_ids.to(device)  # To GPU
+        mask = mask.to(device)            # To GPU
 
         # Run a batch through T5 model
-        with torch.no_grad():
+        with inference_context():
             outputs = model.generate(
                 input_ids = input_ids,
                 attention_mask = mask,
                 max_length=args.qry_len,
-                do_sample=True,
-                top_k=10,
-                num_return_sequences=args.num_queries)
-            
-        for idx, qry in enumerate(outputs):
-            qry_txt = tokenizer.decode(qry, skip_special_tokens=True)
-            line = f'{doc_ids[idx]}\t{positions[idx]}\t{qry_txt}\n'
-            ofile.write(line)
+                num_return_sequences=args.num_queries,
+                **SAMPLING_ARGS)
+        put_start = time.perf_counter()
+        timings['generate'] += put_start - generate_start
+        writer.put(doc_ids, positions, outputs.cpu(), cache_keys)
+        stage_start = time.perf_counter()
+        timings['queue_wait'] += stage_start - put_start
+    return num_passages, num_tokens, num_generated
 
-    logger.info('Finished all batches')
-    ofile.close()
-    doc_dataset.close()
 
 if __name__ == "__main__":
     desc = ('Uses the doc2query-T5 model to generate queries from '
             'source documents.')
     parser = argparse.ArgumentParser(description=desc)
-    parser.add_argument('path', help='Path to TSV file with MS Marco documents')
+    parser.add_argument('path', help='Path to TSV or Parquet file with '
+                                     'MS Marco documents')
     parser.add_argument('--output-file', required=True, help='Path to output file')
     parser.add_argument("--psg-max", type=int, default=128,
                         help='Maximum allowed length of source document passages')
@@ -156,8 +521,9 @@ if __name__ == "__main__":
     parser.add_argument('--num-queries', type=int, default=3,
                         help='The number of queries to generate for each passage')
     parser.add_argument('--max-psg-in', type=int,
-                        help='Stop after generating queries for this many passages.'
-                            ' Default is to use all passages in docs file')
+                        help='Stop after generating queries for this many passages,'
+                            ' in all shards and workers together. Default is'
+                            ' to use all passages in docs file')
     parser.add_argument('--qry-len', type=int, default=64,
                         help='Max length of generated queries')
     parser.add_argument('--t5-batch-size', type=int, default=32,
@@ -169,5 +535,54 @@ if __name__ == "__main__":
                         help='Number of documents to read from disk at one time')
     parser.add_argument('--fast-tokenizer', type=bool, default=True,
                         help='Uses a fast, compiled tokenizer from base T5 model')
+    parser.add_argument('--bucket-window', type=int, default=0,
+                        help='Sort passages by length within windows of this'
+                            ' many batches, e.g., 64. The default, 0, keeps'
+                            ' document order')
+    parser.add_argument('--fixed-padding', action='store_true',
+                        help='Pad every batch to --psg-max instead of the'
+                            ' longest passage in the batch')
+    parser.add_argument('--num-workers', type=int, default=0,
+                        help='Number of processes that split and tokenize'
+                            ' documents. Default of 0 uses the main process')
+    parser.add_argument('--prefetch-factor', type=int, default=2,
+                        help='Number of batches prepared in advance by each'
+                            ' worker process')
+    parser.add_argument('--shard-size', type=int,
+                        help='Write the queries for this many documents to'
+                            ' each output file')
+    parser.add_argument('--shard-index', type=int, default=0,
+                        help='Index of this machine when splitting the'
+                            ' documents across machines')
+    parser.add_argument('--num-shards', type=int, default=1,
+                        help='Number of machines that split the documents')
+    parser.add_argument('--backend', default='eager',
+                        choices=list(backends.BACKENDS),
+                        help='Inference backend, see backends.py')
+    parser.add_argument('--num-threads', type=int,
+                        help='Number of threads used within each PyTorch'
+                            ' operation on CPUs')
+    parser.add_argument('--interop-threads', type=int,
+                        help='Number of threads used to run independent'
+                            ' PyTorch operations in parallel on CPUs')
+    parser.add_argument('--decode-queue-size', type=int, default=4,
+                        help='Maximum number of generated batches waiting to'
+                            ' be decoded and written')
+    parser.add_argument('--cache-file',
+                        help='SQLite file in which generated queries are'
+                            ' cached and reused for repeated passages')
+    parser.add_argument('--sentence-cache', action='store_true',
+                        help='Read sentence boundaries from a sidecar file'
+                            ' next to the docs file, see util/splitter.py.'
+                            ' With --num-shards, build it first with'
+                            ' python -m util.splitter')
+    parser.add_argument('--sentence-workers', type=int, default=1,
+                        help='Number of processes that build the sentence'
+                            ' boundaries sidecar file')
+    parser.add_argument('--resume', action='store_true',
+                        help='Skip output shards that were completed by an'
+                            ' earlier run')
     args = parser.parse_args()
+    if not 0 <= args.shard_index < args.num_shards:
+        parser.error('--shard-index must be less than --num-shards')
     generate_queries(args)
\ No newline at end of file
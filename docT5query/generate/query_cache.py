@@ -0,0 +1,120 @@
+"""Persistent cache of generated queries for docT5query passages.
+
+MS MARCO and other web corpora contain many duplicate passages, such
+as navigation menus and copyright notices, and corpora are often
+re-processed after small changes. QueryCache stores the queries
+generated for every passage in an SQLite database, so that duplicate
+passages, and passages seen in an earlier run, are not run through T5
+again.
+
+Queries are stored under a hash of the passage's T5 token IDs and the
+generation parameters, such as the model name, backend, query length,
+number of queries and sampling settings. Changing any parameter
+therefore starts a new set of cache entries instead of returning
+queries generated with different settings.
+
+Typical Usage Example:
+cache = QueryCache('queries.sqlite', {'model': MODEL_NAME, 'qry_len': 64})
+keys = [cache.key(token_ids) for token_ids in passages]
+cached = cache.get_many(keys)
+cache.put_many({key: queries for key, queries in new_queries})
+"""
+
+import array
+import hashlib
+import json
+import sqlite3
+import threading
+
+
+class QueryCache():
+    """SQLite store of generated queries, keyed by passage and settings.
+
+    QueryCache can be used from more than one thread. Hits and misses
+    are counted by get_many().
+    """
+    def __init__(self, cache_path, params):
+        """Opens or creates the cache database.
+
+        Args:
+            cache_path: String, path to the SQLite database file.
+            params: Dictionary of generation parameters that affect
+                the generated queries. Its values must be JSON
+                serializable.
+        """
+        self.cache_path = cache_path
+        self.params = params
+        self._params_digest = hashlib.blake2b(
+            json.dumps(params, sort_keys=True).encode('utf-8'),
+            digest_size=16).digest()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(cache_path, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS queries '
+                           '(key BLOB PRIMARY KEY, queries TEXT NOT NULL)')
+        self._conn.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, token_ids):
+        """Gets the cache key for a passage.
+
+        Args:
+            token_ids: List of the passage's T5 token IDs, without
+                padding.
+
+        Returns: The key, a bytes object.
+        """
+        checksum = hashlib.blake2b(self._params_digest, digest_size=16)
+        checksum.update(array.array('q', token_ids).tobytes())
+        return checksum.digest()
+
+    def get_many(self, keys):
+        """Looks up the queries for several passages.
+
+        Returns: A dictionary with a list of queries for every key that
+        is in the cache.
+        """
+        found = {}
+        unique_keys = list(set(keys))
+        with self._lock:
+            # SQLite limits the number of parameters in a statement
+            for start in range(0, len(unique_keys), 500):
+                chunk = unique_keys[start:start + 500]
+                rows = self._conn.execute(
+                    'SELECT key, queries FROM queries WHERE key IN ({})'
+                    .format(','.join('?' * len(chunk))), chunk)
+                found.update((key, json.loads(queries))
+                             for key, queries in rows)
+            hits = sum(1 for key in keys if key in found)
+            self.hits += hits
+            self.misses += len(keys) - hits
+        return found
+
+    def put_many(self, key_queries):
+        """Stores the queries for several passages.
+
+        Args:
+            key_queries: Dictionary with a list of queries for each key.
+        """
+        with self._lock:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO queries VALUES (?, ?)',
+                [(key, json.dumps(queries, ensure_ascii=False))
+                 for key, queries in key_queries.items()])
+            self._conn.commit()
+
+    def hit_rate(self):
+        """Gets the fraction of looked up passages found in the cache."""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute(
+                'SELECT COUNT(*) FROM queries').fetchone()[0]
+
+    def close(self):
+        """Closes the database."""
+        with self._lock:
+            self._conn.close()
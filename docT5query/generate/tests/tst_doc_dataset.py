@@ -0,0 +1,217 @@
+import itertools
+import os
+import os.path
+import sys
+import types
+
+import nltk.tokenize
+import pytest
+
+torch = pytest.importorskip('torch')
+transformers = pytest.importorskip('transformers')
+
+# Run test from the repository folder
+sys.path.insert(0, os.path.abspath('.'))
+import docT5query.generate.doc_dataset as ds
+import docT5query.generate.genq as genq
+import util.testing as testing
+from util.testing import simple_nltk  # Applied to every test
+
+
+class StubTokenizer():
+    """Gives every word a fixed ID and ends every sentence with 1, like T5."""
+    def __call__(self, text):
+        if isinstance(text, str):
+            return {'input_ids': self._input_ids(text)}
+        return {'input_ids': [self._input_ids(sentence) for sentence in text]}
+
+    @staticmethod
+    def _input_ids(sentence):
+        return [2 + sum(map(ord, word)) % 500
+                for word in sentence.split()] + [1]
+
+
+@pytest.fixture(autouse=True)
+def stub_tokenizer(monkeypatch):
+    """Replaces the T5 tokenizers, so no model is downloaded."""
+    for tokenizer_class in [transformers.T5TokenizerFast,
+                            transformers.T5Tokenizer]:
+        monkeypatch.setattr(tokenizer_class, 'from_pretrained',
+                            lambda name: StubTokenizer())
+
+
+@pytest.fixture
+def worker(monkeypatch):
+    """Sets the DataLoader worker that the dataset appears to run in."""
+    info = {}
+    monkeypatch.setattr(torch.utils.data, 'get_worker_info',
+                        lambda: info.get('worker'))
+
+    def set_worker(worker_id, num_workers):
+        info['worker'] = types.SimpleNamespace(id=worker_id,
+                                               num_workers=num_workers)
+    return set_worker
+
+
+def _dataset(tmp_path, num_docs=103, **kwargs):
+    fpath = str(tmp_path / 'docs.tsv')
+    if not os.path.isfile(fpath):
+        testing.write_docs(fpath, num_docs, min_sentences=1,
+                           max_sentences=20, max_words=40)
+    kwargs = dict({'doc_batch_size': 10, 'max_len': 64, 'tgt_len': 32,
+                   'min_len': 16}, **kwargs)
+    return ds.DocDataset(fpath, **kwargs)
+
+
+def _passage_keys(passages):
+    return [(doc_id, position, input_ids.tolist())
+            for doc_id, position, input_ids, _ in passages]
+
+
+def _original_passages(dataset, doc_text):
+    """Tokenizes one sentence at a time, as DocDataset first did."""
+    passage = []
+    passages = []
+    for sentence in nltk.tokenize.sent_tokenize(doc_text):
+        sentence = dataset.tokenizer(sentence)['input_ids']
+        curr_len = len(passage) + len(sentence)
+        if curr_len <= dataset.tgt_len:
+            passage.extend(sentence)
+        elif curr_len <= dataset.max_len:
+            passage.extend(sentence)
+            passages.append(passage)
+            passage = []
+        else:
+            if len(passage) > dataset.min_len:
+                passages.append(passage)
+                passage = sentence
+            else:
+                sentence_break = dataset.max_len - len(passage)
+                passage.extend(sentence[:sentence_break])
+                passages.append(passage)
+                passage = sentence[sentence_break:]
+            while len(passage) > dataset.max_len:
+                passages.append(passage[:dataset.max_len])
+                passage = passage[dataset.max_len:]
+    if len(passage) > 0:
+        passages.append(passage)
+    return passages
+
+
+def test_collate_passages():
+    batch = [('D1', 0, torch.tensor([5, 6]), torch.tensor([1, 1])),
+             ('D2', 3, torch.tensor([7, 8, 9, 10]), torch.tensor([1] * 4)),
+             ('D3', 1, torch.tensor([4]), torch.tensor([1]))]
+    doc_ids, positions, input_ids, attention_mask = ds.collate_passages(batch)
+    assert doc_ids == ['D1', 'D2', 'D3']
+    assert positions.tolist() == [0, 3, 1]
+    assert input_ids.tolist() == [[5, 6, 0, 0], [7, 8, 9, 10], [4, 0, 0, 0]]
+    assert attention_mask.tolist() == [[1, 1, 0, 0], [1, 1, 1, 1],
+                                       [1, 0, 0, 0]]
+    _, _, input_ids, attention_mask = ds.collate_passages(batch, pad_len=6)
+    assert input_ids.shape == attention_mask.shape == (3, 6)
+    assert attention_mask.sum(dim=1).tolist() == [2, 4, 1]
+
+
+def test_split_docs_text(tmp_path):
+    dataset = _dataset(tmp_path)
+    docs = dataset.read_docs(0, dataset.num_docs())
+    doc_texts = [title + ' ' + text for _, title, text in docs]
+    expected = [_original_passages(dataset, doc_text)
+                for doc_text in doc_texts]
+    for docs_passages in [
+            dataset.split_docs_text(doc_texts),
+            [dataset.split_doc_text(doc_text) for doc_text in doc_texts]]:
+        assert [[passage['input_ids'] for passage in passages]
+                for passages in docs_passages] == expected
+        for passages in docs_passages:
+            assert [passage['position'] for passage in passages] == list(
+                range(len(passages)))
+            assert all(passage['attention_mask']
+                       == [1] * len(passage['input_ids'])
+                       for passage in passages)
+    assert dataset.split_docs_text([]) == []
+    cached = _dataset(tmp_path, sentence_cache=True)
+    assert _passage_keys(cached) == _passage_keys(dataset)
+
+
+def test_read_docs_extra_columns(tmp_path):
+    fpath = str(tmp_path / 'docs.tsv')
+    with open(fpath, 'wt') as tfile:
+        tfile.write('D1\thttp://1\tTitle 1\tText one.\textra\n'
+                    'D2\thttp://2\tTitle 2\tText two.\n')
+    dataset = ds.DocDataset(fpath)
+    assert dataset.read_docs(0, 2) == [('D1', 'Title 1', 'Text one.'),
+                                       ('D2', 'Title 2', 'Text two.')]
+
+
+def test_worker_lines(tmp_path, worker):
+    dataset = _dataset(tmp_path)
+    for doc_range, expected in [(None, range(103)), ((10, 57), range(10, 57)),
+                                ((90, 500), range(90, 103))]:
+        dataset.doc_range = doc_range
+        for num_workers in [1, 2, 3, 7]:
+            lines = []
+            for worker_id in range(num_workers):
+                worker(worker_id, num_workers)
+                lines.extend(range(*dataset.worker_lines()))
+            assert lines == list(expected)
+
+
+def test_worker_max_passages(tmp_path, worker):
+    dataset = _dataset(tmp_path, max_passages=10)
+    all_passages = []
+    for worker_id in range(3):
+        worker(worker_id, 3)
+        passages = _passage_keys(dataset)
+        assert len(passages) == dataset.worker_max_passages()
+        all_passages.extend(passages)
+    assert len(all_passages) == len(set(
+        (doc_id, position) for doc_id, position, _ in all_passages)) == 10
+
+
+def test_length_bucketed_dataset(tmp_path):
+    dataset = _dataset(tmp_path)
+    expected = _passage_keys(dataset)
+    bucketed = _passage_keys(ds.LengthBucketedDataset(dataset, 4, 2))
+    assert sorted(bucketed) == sorted(expected)
+    assert len(bucketed) == len(set(
+        (doc_id, position) for doc_id, position, _ in bucketed))
+    for start in range(0, len(bucketed), 8):  # Sorted within each window
+        lengths = [len(input_ids) for _, _, input_ids
+                   in bucketed[start:start + 8]]
+        assert lengths == sorted(lengths)
+
+
+def test_data_loader(tmp_path):
+    dataset = _dataset(tmp_path)
+    expected = _passage_keys(dataset)
+    loader = torch.utils.data.DataLoader(
+        dataset, batch_size=5, collate_fn=ds.collate_passages, num_workers=2)
+    passages = []
+    for doc_ids, positions, input_ids, attention_mask in loader:
+        for row, doc_id in enumerate(doc_ids):
+            passage_len = int(attention_mask[row].sum())
+            passages.append((doc_id, int(positions[row]),
+                             input_ids[row, :passage_len].tolist()))
+    assert sorted(passages) == sorted(expected)
+
+
+def test_shard_ranges():
+    for num_docs, shard_size, num_shards in itertools.product(
+            [0, 1, 10, 103], [None, 1, 7, 200], [1, 2, 5]):
+        shards = []
+        for shard_index in range(num_shards):
+            ranges = genq.shard_ranges(num_docs, shard_size, shard_index,
+                                       num_shards)
+            assert all(shard_num % num_shards == shard_index
+                       for shard_num, _, _ in ranges)
+            shards.extend(ranges)
+        shards.sort()
+        assert [shard_num for shard_num, _, _ in shards] == list(
+            range(len(shards)))
+        assert list(itertools.chain.from_iterable(
+            range(start, end) for _, start, end in shards)) == list(
+                range(num_docs))
+        if shard_size is None:
+            assert len(shards) <= num_shards
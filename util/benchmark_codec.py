@@ -0,0 +1,98 @@
+"""Compares the speed of the JSON backends in util.codec.
+
+Times decoding, encoding, and reading only the 'id' field of JSONL
+records, for every installed backend. By default the records are
+synthetic versions of the JSONL shapes used in this project: HDCT and
+DeepCT index records with repeated-term 'contents', and
+JsonVectorCollection records with a 'vector' dictionary. Pass --input
+to time the lines of a real JSONL file instead.
+
+Run from the repository root:
+python -m util.benchmark_codec
+python -m util.benchmark_codec --input hdct_weights/docs00.json
+"""
+
+import argparse
+import itertools
+import random
+import time
+
+import util.codec as codec
+
+
+def make_records(num_records, seed=0):
+    """Creates synthetic contents and vector records.
+
+    Returns: A dictionary with the record shape names for keys and lists
+    of JSON lines (bytes) for values.
+    """
+    rng = random.Random(seed)
+    json_codec = codec.get_codec('json')
+    contents_lines, vector_lines = [], []
+    for doc_num in range(num_records):
+        terms = rng.sample(range(50_000), 60)
+        weights = {'w{}'.format(term): rng.randint(1, 20) for term in terms}
+        contents = ''.join([(term + ' ') * weight
+                            for term, weight in weights.items()])[:-1]
+        doc_id = 'D{}'.format(doc_num)
+        contents_lines.append(json_codec.dumps(
+            {'id': doc_id, 'contents': contents}) + b'\n')
+        vector_lines.append(json_codec.dumps(
+            {'id': doc_id, 'vector': weights}) + b'\n')
+    return {'contents': contents_lines, 'vector': vector_lines}
+
+
+def time_backend(backend_codec, lines):
+    """Times one backend on a list of lines.
+
+    Returns: A tuple of seconds per million lines for loads, dumps,
+    reading the 'id' field with field_decoder(), and reading the 'id'
+    field by decoding the whole line.
+    """
+    def per_million(func, items):
+        start_time = time.perf_counter()
+        for item in items:
+            func(item)
+        return (time.perf_counter() - start_time) * 1e6 / len(items)
+
+    records = [backend_codec.loads(line) for line in lines]
+    get_id = codec.field_decoder('id', backend_codec)
+    return (per_million(backend_codec.loads, lines),
+            per_million(backend_codec.dumps, records),
+            per_million(get_id, lines),
+            per_million(lambda line: backend_codec.loads(line)['id'], lines))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--num-records', type=int, default=20_000)
+    parser.add_argument('--input',
+                        help='JSONL file to time instead of synthetic records.')
+    args = parser.parse_args()
+
+    if args.input is not None:
+        with open(args.input, 'rb') as jfile:
+            shapes = {args.input: list(itertools.islice(jfile,
+                                                        args.num_records))}
+    else:
+        shapes = make_records(args.num_records)
+
+    print('Default backend:', codec.codec.name)
+    print('Seconds per million lines.')
+    for shape, lines in shapes.items():
+        print('\n{} records, {:,} bytes per line on average'.format(
+            shape, sum(map(len, lines)) // len(lines)))
+        print('{:<10} {:>9} {:>9} {:>12} {:>12}'.format(
+            'Backend', 'loads', 'dumps', 'field_id', 'loads_id'))
+        for backend in codec.BACKENDS:
+            try:
+                backend_codec = codec.get_codec(backend)
+            except ImportError:
+                print('{:<10} not installed'.format(backend))
+                continue
+            print('{:<10} {:>9.1f} {:>9.1f} {:>12.1f} {:>12.1f}'.format(
+                backend, *time_backend(backend_codec, lines)))
+
+
+if __name__ == '__main__':
+    main()
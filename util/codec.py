@@ -0,0 +1,123 @@
+"""Fast JSON encoding and decoding for JSONL records.
+
+Uses the fastest JSON library that is installed, in this order:
+orjson, msgspec, ujson, and finally the standard library json module.
+All backends read bytes or str and write bytes, and all of them write
+the same compact, UTF-8 encoded JSON, so files written with different
+backends are interchangeable.
+
+Typical Usage Example:
+import util.codec as codec
+record = codec.loads(line)
+ofile.write(codec.dumps_line(record))
+
+To read a single field from a line without decoding the whole line,
+create a field decoder once and call it for every line:
+get_id = codec.field_decoder('id')
+doc_id = get_id(line)
+
+A specific backend can be selected with get_codec(), or by setting the
+JSON_CODEC environment variable to the backend's name before the
+module is imported.
+"""
+
+import collections
+import json
+import os
+import re
+
+BACKENDS = ('orjson', 'msgspec', 'ujson', 'json')
+
+# Raised by every backend for invalid JSON.
+DecodeError = ValueError
+
+Codec = collections.namedtuple('Codec', ['name', 'loads', 'dumps'])
+Codec.__doc__ = """JSON functions from one backend.
+
+Attributes:
+    name: Name of the backend module.
+    loads: Decodes a bytes or str JSON document.
+    dumps: Encodes an object as compact, UTF-8 encoded JSON bytes.
+"""
+
+
+def _stdlib_dumps(obj):
+    return json.dumps(obj, ensure_ascii=False,
+                      separators=(',', ':')).encode('utf-8')
+
+
+def get_codec(name=None):
+    """Gets the JSON functions for a backend.
+
+    Args:
+        name: One of BACKENDS, or None for the first installed backend.
+            Optional. Defaults to None.
+
+    Returns: A Codec. Raises ImportError if the requested backend is not
+    installed.
+    """
+    if name is None:
+        for backend in BACKENDS:
+            try:
+                return get_codec(backend)
+            except ImportError:
+                pass
+    if name == 'orjson':
+        import orjson
+        return Codec('orjson', orjson.loads, orjson.dumps)
+    if name == 'msgspec':
+        import msgspec
+        return Codec('msgspec', msgspec.json.decode, msgspec.json.encode)
+    if name == 'ujson':
+        import ujson
+        return Codec('ujson', ujson.loads,
+                     lambda obj: ujson.dumps(obj, ensure_ascii=False,
+                                             escape_forward_slashes=False)
+                     .encode('utf-8'))
+    if name == 'json':
+        return Codec('json', json.loads, _stdlib_dumps)
+    raise ValueError('JSON backend must be one of {}.'
+                     .format(', '.join(BACKENDS)))
+
+
+codec = get_codec(os.environ.get('JSON_CODEC'))
+loads = codec.loads
+dumps = codec.dumps
+
+
+def dumps_line(obj):
+    """Encodes an object as a line of JSONL, ending in a newline."""
+    return dumps(obj) + b'\n'
+
+
+def field_decoder(key, codec=codec):
+    """Creates a function that reads one field from a JSON line.
+
+    The returned function searches the line for the key and a string
+    value with a regular expression, which is much faster than decoding
+    the whole line when the key is near the start of the line. A match
+    is only used if the line's opening brace is the only brace before
+    it, so a key in a nested dictionary is never mistaken for the
+    field. Values that are not strings, values that contain escape
+    sequences, and lines with a brace before the key are read by
+    decoding the whole line with the codec's loads function.
+
+    Args:
+        key: The dictionary key of the field.
+        codec: Codec used when the whole line has to be decoded.
+            Optional. Defaults to the module's codec.
+
+    Returns: A function that takes a bytes line and returns the field's
+    value. It raises KeyError if the field is missing and DecodeError
+    if the line is not valid JSON.
+    """
+    json_key = re.escape(_stdlib_dumps(key))
+    search = re.compile(json_key + rb'\s*:\s*"([^"\\]*)"').search
+    codec_loads = codec.loads
+
+    def decode_field(line):
+        match = search(line)
+        if match is not None and line.count(b'{', 0, match.start()) == 1:
+            return match.group(1).decode('utf-8')
+        return codec_loads(line)[key]
+    return decode_field
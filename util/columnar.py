@@ -0,0 +1,499 @@
+"""Columnar (Parquet) storage for documents, passages, queries and weights.
+
+The msmarco TSV and HDCT JSONL files are re-parsed by every stage of
+the pipeline, and every lookup decodes the whole record even when only
+the URL and title are needed. convert() stores the records of one of
+these files in a Parquet file with one column per field, and
+ColumnarCorpus reads them back:
+* Only the requested columns are read from disk (column projection),
+  so reading URLs and titles does not read the document text.
+* Records are stored in row groups (see ROW_GROUP_SIZES), and each
+  row group stores the minimum and maximum key value. Key ranges are
+  read without reading the row groups outside the range (predicate
+  pushdown). Records are kept in the same order as the input file, so
+  this skips the most row groups when the input is sorted by key.
+* Fields are read as typed columns, without splitting text lines.
+
+Files with unique keys (every kind except 'queries') have a key index
+next to the Parquet file, named after it with '.bin-index' added to
+the end. It is a util.indexer binary index that maps every key, in
+sorted order, to its record number, so a key is found with a binary
+search of the memory-mapped index. The key index is written by
+convert(), and rebuilt from the key column when a ColumnarCorpus is
+opened if the Parquet file has changed.
+
+A lookup reads the selected columns of the key's whole row group, so
+document files use smaller row groups than the other kinds. Reading
+the text of a random document still decodes the text of every
+document in its row group, so IndexedFile is faster for random access
+to document text.
+
+The kind of file determines its columns, see SCHEMAS:
+* docs: msmarco-docs.tsv, or the TSV files from
+  docT5query/download/create_query_docs.py.
+* passages: TSV passage files from deepCT/doc_split/doc_to_psg.py.
+* queries: TSV query files from docT5query/generate/genq.py.
+* weights: HDCT and DeepCT JSONL files with a 'contents' field.
+* vectors: JsonVectorCollection JSONL files with a 'vector' field.
+  The weights must be integers, as written by TRESPI.weights.
+
+Typical Usage Example:
+import util.columnar as columnar
+columnar.convert('msmarco-docs.tsv', 'msmarco-docs.parquet')
+docs = columnar.ColumnarCorpus('msmarco-docs.parquet')
+url, title = docs.get_rows(['D3502052'], ['url', 'title'])[0]
+for doc_id, text in docs.iter_rows(['doc_id', 'text'],
+                                   key_range=('D1', 'D2')):
+    ...
+
+util.indexer.open_index() opens files ending in '.parquet' as a
+ColumnarCorpus, and util.indexer.get_rows() reads columns from either
+format.
+
+Convert a file from the command line:
+python -m util.columnar --kind docs msmarco-docs.tsv msmarco-docs.parquet
+"""
+
+import argparse
+import bisect
+import collections
+import itertools
+import os
+import os.path
+import time
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+try:
+    import util.codec as codec
+    import util.indexer as indexer
+except ImportError:  # Imported from the util folder, as in the tests
+    import codec
+    import indexer
+
+# Number of records in each row group. Reading one record reads the
+#   selected columns of its whole row group, so document files, which
+#   are read by key with their long text column, use smaller groups.
+#   Each row group adds about 300 bytes to the Parquet footer.
+ROW_GROUP_SIZE = 1000
+ROW_GROUP_SIZES = {'docs': 100}
+# Number of row groups read with each call in get_rows(). Reading
+#   several groups per call is faster, and the limit bounds the memory
+#   used by a lookup of many keys.
+_GROUPS_PER_READ = 64
+
+SCHEMAS = {
+    'docs': pa.schema([('doc_id', pa.string()), ('url', pa.string()),
+                       ('title', pa.string()), ('text', pa.string())]),
+    'passages': pa.schema([('psg_id', pa.string()), ('text', pa.string())]),
+    'queries': pa.schema([('doc_id', pa.string()), ('position', pa.int32()),
+                          ('query', pa.string())]),
+    'weights': pa.schema([('id', pa.string()), ('contents', pa.string())]),
+    'vectors': pa.schema([('id', pa.string()),
+                          ('vector', pa.map_(pa.string(), pa.int32()))]),
+}
+_JSON_KINDS = ('weights', 'vectors')
+# genq.py writes several queries per passage, so keys are not unique
+_NON_UNIQUE_KINDS = ('queries',)
+
+_KIND_KEY = b'columnar.kind'
+_UNIQUE_KEY = b'columnar.unique_keys'
+_MISSING_POLICIES = ('raise', 'skip', 'none')
+_KEY_INDEX_SUFFIX = '.bin-index'
+
+
+def _record_parser(schema, json_records):
+    """Gets a function that converts a text line to a list of values."""
+    names = schema.names
+    if json_records:
+        map_fields = [idx for idx, field in enumerate(schema)
+                      if pa.types.is_map(field.type)]
+        def parse_json(line):
+            record = codec.loads(line)
+            values = [record.get(name) for name in names]
+            for idx in map_fields:
+                if values[idx] is not None and not all(
+                        type(weight) is int
+                        for weight in values[idx].values()):
+                    raise ValueError('{} weights must be integers: {}'
+                                     .format(names[idx], line[:100]))
+            return values
+        return parse_json
+
+    int_fields = [idx for idx, field in enumerate(schema)
+                  if pa.types.is_integer(field.type)]
+    def parse_tsv(line):
+        values = line.rstrip('\n').split('\t')
+        if len(values) != len(names):
+            raise ValueError('Expected {} columns but found {}: {}'
+                             .format(len(names), len(values), line[:100]))
+        for idx in int_fields:
+            values[idx] = int(values[idx])
+        return values
+    return parse_tsv
+
+def _read_lines(input_path):
+    """Iterates over the lines of a file, or of every file in a folder."""
+    if os.path.isdir(input_path):
+        paths = sorted(os.path.join(input_path, name)
+                       for name in os.listdir(input_path)
+                       if not name.endswith(indexer.INDEX_SUFFIXES))
+    else:
+        paths = [input_path]
+    for path in paths:
+        with open(path, 'rt') as ifile:
+            yield from ifile
+
+def _write_key_index(path):
+    """Writes the key index of a Parquet file with unique keys.
+
+    Reads only the key column. If a key appears more than once, the
+    index points to its last record, as in indexer.IndexedFile.
+
+    Returns: The path of the key index.
+    """
+    pfile = pq.ParquetFile(path)
+    try:
+        keys = pfile.read(columns=[pfile.schema_arrow.names[0]]).column(0)
+        keys = keys.to_pylist()
+    finally:
+        pfile.close()
+    order = sorted(range(len(keys)), key=keys.__getitem__)  # Stable
+    entries = ((keys[row], row, row + 1, row, 0)
+               for pos, row in enumerate(order)
+               if pos + 1 == len(order) or keys[order[pos + 1]] != keys[row])
+    index_path = path + _KEY_INDEX_SUFFIX
+    indexer.write_sorted_index(index_path, entries,
+                                indexer.get_source_info(path, len(keys)))
+    return index_path
+
+def convert(input_path, output_path, kind='docs', row_group_size=None):
+    """Converts a TSV or JSONL file to a Parquet file.
+
+    Args:
+        input_path: Path to a TSV or JSONL file, or to a folder of
+            files of the same kind.
+        output_path: Path of the Parquet file. The file is written to
+            output_path + '.tmp' and renamed when it is complete. The
+            records are written in the same order as the input. For
+            kinds with unique keys, the key index is written next to
+            it.
+        kind: One of the SCHEMAS keys. Optional. Defaults to 'docs'.
+        row_group_size: Number of records in each row group. Optional.
+            Defaults to ROW_GROUP_SIZES[kind], or ROW_GROUP_SIZE for
+            kinds that are not in ROW_GROUP_SIZES.
+
+    Returns: The number of records written.
+    """
+    if kind not in SCHEMAS:
+        raise ValueError('kind must be one of {}.'
+                         .format(', '.join(SCHEMAS)))
+    if row_group_size is None:
+        row_group_size = ROW_GROUP_SIZES.get(kind, ROW_GROUP_SIZE)
+    start_time = time.time()
+    json_records = kind in _JSON_KINDS
+    unique_keys = kind not in _NON_UNIQUE_KINDS
+    schema = SCHEMAS[kind].with_metadata({
+        _KIND_KEY: kind.encode('utf-8'),
+        _UNIQUE_KEY: b'1' if unique_keys else b'0'})
+    parse = _record_parser(schema, json_records)
+    lines = _read_lines(input_path)
+
+    num_records = 0
+    tmp_path = output_path + '.tmp'
+    # Only the key column's statistics are used, for predicate pushdown
+    with pq.ParquetWriter(tmp_path, schema,
+                          write_statistics=[schema.names[0]]) as writer:
+        while True:
+            batch = [parse(line)
+                     for line in itertools.islice(lines, row_group_size)]
+            if not batch:
+                break
+            columns = [pa.array(values, type=field.type)
+                       for values, field in zip(zip(*batch), schema)]
+            writer.write_table(pa.Table.from_arrays(columns, schema=schema),
+                               row_group_size=row_group_size)
+            num_records += len(batch)
+    os.replace(tmp_path, output_path)
+    if unique_keys:
+        _write_key_index(output_path)
+    elapsed = time.time() - start_time
+    print('Converted {:,} records in {:.1f} seconds ({:,.0f} records/sec)'
+          .format(num_records, elapsed, num_records / max(elapsed, 1e-9)))
+    return num_records
+
+
+def _to_python(column):
+    """Converts a pyarrow column to a list of Python values."""
+    values = column.to_pylist()
+    if pa.types.is_map(column.type):
+        return [dict(value) if value is not None else None
+                for value in values]
+    return values
+
+
+class ColumnarCorpus():
+    """Reads records from a Parquet file created by convert().
+
+    Constructor arguments:
+        path: Path to the Parquet file.
+
+    The key column is the first column, e.g., doc_id for documents.
+    Records can be read in file order with iter_rows(), and records of
+    files with unique keys can be looked up by key with get_rows().
+
+    ColumnarCorpus supports the same `[]`, `len()`, `in`, and
+    `get_many()` operations as indexer.IndexedFile, and returns the
+    records as TSV or JSONL lines, so it can replace an IndexedFile in
+    code that parses the lines. get_rows() and iter_rows() are faster
+    because they return column values without creating or parsing
+    text lines.
+
+    Attributes:
+        column_names: Tuple with the names of the columns.
+        key_column: Name of the key column.
+        kind: The kind of records, one of the SCHEMAS keys.
+        unique_keys: True if every record has a different key value,
+            so records can be looked up by key.
+    """
+    def __init__(self, path):
+        """Opens the Parquet file and reads its metadata."""
+        if not os.path.isfile(path):
+            raise ValueError('Input file "{}" does not exist.'.format(path))
+        self.path = path
+        self.file = pq.ParquetFile(path, memory_map=True)
+        schema = self.file.schema_arrow
+        metadata = schema.metadata or {}
+        self.column_names = tuple(schema.names)
+        self.key_column = self.column_names[0]
+        self.kind = str(metadata.get(_KIND_KEY, b''), 'utf-8')
+        self.unique_keys = metadata.get(_UNIQUE_KEY) == b'1'
+        self._json_records = self.kind in _JSON_KINDS
+
+        file_metadata = self.file.metadata
+        group_lens = [file_metadata.row_group(group).num_rows
+                      for group in range(file_metadata.num_row_groups)]
+        self._group_starts = list(itertools.accumulate([0] + group_lens))
+        self._group_mins, self._group_maxs = [], []
+        for group in range(file_metadata.num_row_groups):
+            stats = file_metadata.row_group(group).column(0).statistics
+            if stats is None or not stats.has_min_max:
+                self._group_mins = self._group_maxs = None
+                break
+            self._group_mins.append(stats.min)
+            self._group_maxs.append(stats.max)
+        # Opened here, rather than by the first lookup, so that a stale
+        #   key index is rebuilt once before the corpus is used by
+        #   several worker processes.
+        self._key_index = None
+        if self.unique_keys:
+            self._key_index = self._open_key_index()
+
+    @property
+    def num_row_groups(self):
+        """Gets the number of row groups in the file."""
+        return len(self._group_starts) - 1
+
+    def _read_group(self, group, columns):
+        """Reads the selected columns of a row group as a pyarrow Table."""
+        return self.file.read_row_group(group, columns=list(columns))
+
+    def _open_key_index(self):
+        """Memory-maps the key index, rebuilding it if it is stale."""
+        index_path = self.path + _KEY_INDEX_SUFFIX
+        if os.path.isfile(index_path):
+            try:
+                key_index = indexer.BinaryIndex(index_path)
+            except ValueError:  # Unsupported format
+                key_index = None
+            stat = os.stat(self.path)
+            if key_index is not None and (
+                    key_index.source_info.size == stat.st_size
+                    and key_index.source_info.mtime_ns == stat.st_mtime_ns):
+                return key_index
+            if key_index is not None:
+                key_index.close()
+            print('Key index {} is out of date. Rebuilding index.'
+                  .format(index_path))
+        return indexer.BinaryIndex(_write_key_index(self.path))
+
+    def _locate(self, key):
+        """Finds the row group and row of a key value.
+
+        Returns: A (row group, row number within the row group) tuple,
+        or None if the key is not in the file.
+        """
+        if not self.unique_keys:
+            raise ValueError('{} does not have unique keys. Use '
+                             'iter_rows() to read it.'.format(self.path))
+        slot = self._key_index.find(key) if isinstance(key, str) else -1
+        if slot < 0:
+            return None
+        row = self._key_index.positions[slot]
+        group = bisect.bisect_right(self._group_starts, row) - 1
+        return group, row - self._group_starts[group]
+
+    def get_rows(self, keys, columns=None, missing='raise'):
+        """Gets selected columns of several records.
+
+        Each row group that contains a key is read once, and only the
+        selected columns are read. The row groups are read
+        _GROUPS_PER_READ at a time, and only the requested rows are
+        kept.
+
+        Args:
+            keys: List of key values.
+            columns: List of column names. Optional. Defaults to all
+                columns.
+            missing: 'raise', 'skip', or 'none'. Specifies whether keys
+                that are not in the file raise a KeyError, are left out
+                of the returned list, or are returned as None.
+
+        Returns: A list with a tuple of column values for each key, in
+        the same order as keys.
+        """
+        if missing not in _MISSING_POLICIES:
+            raise ValueError('missing must be one of {}.'
+                             .format(', '.join(_MISSING_POLICIES)))
+        columns = self.column_names if columns is None else columns
+        rows = [None] * len(keys)
+        group_rows = collections.defaultdict(list)
+        for pos, key in enumerate(keys):
+            location = self._locate(key)
+            if location is None:
+                if missing == 'raise':
+                    raise KeyError('Key {} does not exist in {}.'
+                                   .format(key, self.path))
+                continue
+            group, row = location
+            group_rows[group].append((row, pos))
+        groups = sorted(group_rows)
+        for chunk_start in range(0, len(groups), _GROUPS_PER_READ):
+            chunk = groups[chunk_start:chunk_start + _GROUPS_PER_READ]
+            row_nums, positions = [], []
+            group_offset = 0
+            for group in chunk:
+                for row, pos in group_rows[group]:
+                    row_nums.append(group_offset + row)
+                    positions.append(pos)
+                group_offset += (self._group_starts[group + 1]
+                                 - self._group_starts[group])
+            table = self.file.read_row_groups(chunk, columns=list(columns))
+            table = table.take(row_nums)
+            values = zip(*[_to_python(column) for column in table.columns])
+            for pos, row in zip(positions, values):
+                rows[pos] = row
+
+        if missing == 'skip':
+            return [row for row in rows if row is not None]
+        return rows
+
+    def iter_rows(self, columns=None, key_range=None, start=None,
+                  stop=None):
+        """Iterates over the records in file order.
+
+        Row groups outside of the start and stop record numbers, and
+        row groups whose smallest and largest keys are outside of
+        key_range, are not read.
+
+        Args:
+            columns: List of column names. Optional. Defaults to all
+                columns.
+            key_range: A (first key, end key) tuple. Only records with
+                first key <= key < end key are returned. Either key
+                may be None for an open range. Keys are compared as
+                strings, so 'D10' comes before 'D2'. Optional.
+            start: Number of the first record, starting at 0. Optional.
+            stop: Number of the record after the last record. Optional.
+
+        Yields: A tuple of column values for each record.
+        """
+        columns = list(self.column_names if columns is None else columns)
+        first_key, end_key = key_range if key_range else (None, None)
+        start = 0 if start is None else start
+        stop = len(self) if stop is None else min(stop, len(self))
+        read_columns = columns
+        if key_range and self.key_column not in columns:
+            read_columns = columns + [self.key_column]
+        for group in range(self.num_row_groups):
+            group_start = self._group_starts[group]
+            group_stop = self._group_starts[group + 1]
+            if group_stop <= start or group_start >= stop:
+                continue
+            if self._group_mins is not None and (
+                    (first_key is not None
+                     and self._group_maxs[group] < first_key)
+                    or (end_key is not None
+                        and self._group_mins[group] >= end_key)):
+                continue
+            table = self._read_group(group, read_columns)
+            if start > group_start or stop < group_stop:
+                offset = max(start - group_start, 0)
+                table = table.slice(offset,
+                                    min(stop, group_stop) - group_start
+                                    - offset)
+            if key_range:
+                key_values = table.column(self.key_column)
+                mask = pa.array([True] * len(table))
+                if first_key is not None:
+                    mask = pc.and_(mask, pc.greater_equal(key_values,
+                                                          first_key))
+                if end_key is not None:
+                    mask = pc.and_(mask, pc.less(key_values, end_key))
+                table = table.filter(mask)
+            yield from zip(*[_to_python(table.column(column))
+                             for column in columns])
+
+    def _format(self, row):
+        """Formats a row as a TSV or JSONL line."""
+        if self._json_records:
+            record = dict(zip(self.column_names, row))
+            return str(codec.dumps_line(record), 'utf-8')
+        return '\t'.join([str(value) for value in row]) + '\n'
+
+    def get_many(self, keys, missing='raise'):
+        """Gets several records as TSV or JSONL lines.
+
+        See IndexedFile.get_many(). Use get_rows() to read column values
+        without formatting them as lines.
+        """
+        return [self._format(row) if row is not None else None
+                for row in self.get_rows(keys, None, missing)]
+
+    def __getitem__(self, key):
+        """Gets a record as a TSV or JSONL line."""
+        return self.get_many([key])[0]
+
+    def __contains__(self, key):
+        return self._locate(key) is not None
+
+    def __len__(self):
+        """Gets number of records in the file."""
+        return self._group_starts[-1]
+
+    def close(self):
+        """Closes the Parquet file and the key index."""
+        self.file.close()
+        if self._key_index is not None:
+            self._key_index.close()
+            self._key_index = None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        'Converts a TSV or JSONL file to a Parquet file.')
+    parser.add_argument('--kind', default='docs', choices=list(SCHEMAS),
+                        help='Kind of records in the input file.')
+    parser.add_argument('--row-group-size', type=int, default=None,
+                        help='Number of records in each row group. '
+                             'Defaults to {} for docs and {} for the '
+                             'other kinds.'.format(ROW_GROUP_SIZES['docs'],
+                                                   ROW_GROUP_SIZE))
+    parser.add_argument('input_path',
+                        help='Path to input file, or folder of files.')
+    parser.add_argument('output_path', help='Path to Parquet file.')
+    args = parser.parse_args()
+    convert(args.input_path, args.output_path, args.kind,
+            args.row_group_size)
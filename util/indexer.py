@@ -3,9 +3,18 @@
 The IndexedFile builds an index for a JSONL, TSV, or other delimited
 file. Once the index is built, any record can be quickly accessed  with
 it's unique key value. The index is saved to disk after it is created.
-The indexes file name is the the source file name with 'pickled-index'
+The indexes file name is the the source file name with 'bin-index'
 added to the end.
 
+The index file is a flat binary file containing a sorted array of key
+values and parallel arrays of 64-bit byte offsets. The index file is
+memory-mapped when it is opened and key values are located with a
+binary search, so opening an index takes constant time regardless of
+the size of the source file and the index does not have to be read
+into memory. Index files created by earlier versions of this module
+(with file names ending in 'pickled-index') are converted to the binary
+format automatically the first time they are opened.
+
 IndexedFile assumes that there is a unique key value for every line in
 the file. For JSONL files, each line must be a dictionary object.
 
@@ -13,12 +22,544 @@ Typical Usage Example:
 import indexer
 doc_idx = indexer.IndexedFile('big_doc.tsv', 0)
 record = doc_idx['key-value']
+
+For heavy random access, the source file can also be memory-mapped.
+Records are then returned as zero-copy memoryview slices of the source
+file and are only decoded to text when the caller needs them:
+doc_idx = indexer.IndexedFile('big_doc.tsv', 0, use_mmap=True)
+raw_record = doc_idx.get_raw('key-value')
+record = str(raw_record, 'utf-8')
+
+An IndexedCollection provides the same access to records that are
+spread over a folder of shard files, such as the JSONL files generated
+by HDCT. One index, saved in the folder, maps every key value to its
+shard and position, so each lookup is a single binary search:
+doc_idx = indexer.IndexedCollection('hdct_weights', 'id', suffix='.json')
+record = doc_idx['key-value']
+
+The index file records the size, modification time, and a checksum of
+samples from the source file. If the source file changes after the
+index is built, the index is rebuilt when it is opened. If lines were
+only appended to the end of the source file, just the new lines are
+added to the existing index.
 """
 
-import json
+import array
+import bisect
+import collections
+import collections.abc
+import functools
+import hashlib
+import heapq
+import itertools
+import mmap
+import multiprocessing
 import os
 import os.path
 import pickle
+import struct
+import sys
+import time
+
+try:
+    import util.codec as codec
+except ImportError:  # Imported from the util folder, as in the tests
+    import codec
+
+# Binary index file layout. The header is followed by seven 8-byte
+#   aligned sections:
+#   1. key_offsets: int64[num_keys + 1], offsets into the key blob
+#   2. positions: int64[num_keys], byte position of each record
+#   3. ends: int64[num_keys], byte position just past each record
+#   4. line_nums: int64[num_keys], line number of each record
+#   5. line_positions: int64[num_lines], byte position of each line
+#   6. line_slots: int64[num_lines], key slot of each line, or -1
+#   7. shard_ids: int64[num_keys], shard number of each record
+#   followed by the key blob, which contains all UTF-8 encoded key
+#   values, sorted, concatenated together. Sections 5 and 6 are empty
+#   unless the index was built with line_idx=True. Section 7 is empty
+#   unless the index belongs to an IndexedCollection.
+_MAGIC = b'NIRINDEX'
+_VERSION = 2
+# magic, version, flags, keys, lines, blob length, followed by the
+#   source file's size, modification time, number of lines and checksum
+_HEADER = struct.Struct('<8sIIqqqqqq16s')
+_FLAG_LITTLE_ENDIAN = 1
+_FLAG_LINE_INDEX = 2
+_FLAG_SHARDS = 4
+_ITEM_SIZE = 8
+
+# IndexedFile.get_many() merges records that are closer together than
+#   this many bytes into a single read, but never reads more than
+#   _MAX_READ bytes at once.
+_MAX_GAP = 64 * 1024
+_MAX_READ = 16 * 1024 * 1024
+_MISSING_POLICIES = ('raise', 'skip', 'none')
+
+# File name extensions of files that are never shards of a collection
+INDEX_SUFFIXES = ('.bin-index', '.pickled-index', '.tmp')
+_COLLECTION_INDEX_NAME = 'collection.bin-index'
+# Columns of the msmarco document TSV files
+DOC_COLUMNS = ('doc_id', 'url', 'title', 'text')
+
+# The source file checksum covers this many evenly spaced samples of
+#   _SAMPLE_SIZE bytes each, instead of the entire file.
+_NUM_SAMPLES = 16
+_SAMPLE_SIZE = 4096
+
+SourceInfo = collections.namedtuple(
+    'SourceInfo', ['size', 'mtime_ns', 'num_lines', 'checksum'])
+
+
+def _sample_checksum(path, size):
+    """Calculates a checksum of the first size bytes of a file.
+
+    Reads evenly spaced samples, always including the beginning and
+    the end of the range, so the checksum is quick to calculate even
+    for very large files. The same checksum calculated over the
+    original size of a file that has since had lines appended to it
+    will not change.
+    """
+    checksum = hashlib.blake2b(size.to_bytes(8, 'little'), digest_size=16)
+    if size == 0:
+        return checksum.digest()
+    last_sample = max(size - _SAMPLE_SIZE, 0)
+    with open(path, 'rb') as dfile:
+        for sample_num in range(_NUM_SAMPLES):
+            dfile.seek(last_sample * sample_num // (_NUM_SAMPLES - 1))
+            checksum.update(dfile.read(min(_SAMPLE_SIZE, size)))
+    return checksum.digest()
+
+
+def get_source_info(path, num_lines=0):
+    """Gets the size, modification time, and checksum of a file."""
+    stat = os.stat(path)
+    return SourceInfo(stat.st_size, stat.st_mtime_ns, num_lines,
+                      _sample_checksum(path, stat.st_size))
+
+
+def _key_decoder(key_idx, delim):
+    """Creates a function that gets the unique key value from a line.
+
+    Args:
+        key_idx: Integer column number or string JSON key.
+        delim: bytes, column delimiter for delimited files.
+
+    Returns: A function that takes a bytes line from the source file and
+    returns its key value.
+    """
+    if isinstance(key_idx, str):
+        # Source file is JSONL. Only the key field is decoded.
+        return codec.field_decoder(key_idx)
+
+    # Source file is TSV, CSV, or similar and key is in key-th col
+    def decode_key(line):
+        return line.split(delim, key_idx + 1)[key_idx].decode('utf-8')
+    return decode_key
+
+
+def _scan_range(path, start, end, key_idx, delim):
+    """Finds the start position and key of every line in a byte range.
+
+    Args:
+        path: Path to the source file.
+        start: Byte position of the first line in the range.
+        end: Byte position just past the last line in the range. Both
+            start and end must be at the beginning of a line.
+        key_idx, delim: See IndexedFile.
+
+    Returns: A tuple containing an array of line start positions and a
+    list of the corresponding key values.
+    """
+    decode_key = _key_decoder(key_idx, delim.encode('utf-8'))
+    positions = array.array('q')
+    keys = []
+    with open(path, 'rb') as dfile:
+        dfile.seek(start)
+        byte_pos = start
+        while byte_pos < end:
+            line = dfile.readline()
+            if not line:
+                break
+            positions.append(byte_pos)
+            keys.append(decode_key(line))
+            byte_pos += len(line)
+    return positions, keys
+
+
+def _scan_range_star(args):
+    """Unpacks arguments for _scan_range in a worker process."""
+    return _scan_range(*args)
+
+
+def _split_ranges(path, num_ranges, file_size, start=0):
+    """Splits a file into byte ranges that start at line boundaries.
+
+    Args:
+        path: Path to the source file.
+        num_ranges: Number of ranges. Fewer ranges are returned if the
+            file has too few lines.
+        file_size: Byte position at which the last range ends.
+        start: Byte position at which the first range starts. Must be
+            at the beginning of a line.
+    """
+    boundaries = [start]
+    with open(path, 'rb') as dfile:
+        for range_num in range(1, num_ranges):
+            dfile.seek(max(start + (file_size - start) * range_num
+                           // num_ranges, boundaries[-1]))
+            dfile.readline()  # Skip to start of next line
+            boundaries.append(min(dfile.tell(), file_size))
+    boundaries.append(file_size)
+    return [(start, end) for start, end in zip(boundaries, boundaries[1:])
+            if start < end]
+
+
+def _write_index(index_path, docs, lines, source_info):
+    """Writes a binary index file.
+
+    Args:
+        index_path: Path of the index file that will be written.
+        docs: Dictionary mapping each key value to a tuple of
+            (byte position, end byte position, line number).
+        lines: List of (byte position, key) tuples, one per line in
+            the source file, or None if there is no line index.
+        source_info: SourceInfo tuple describing the source file at
+            the time it was indexed.
+    """
+    entries = ((key,) + docs[key] + (0,)
+               for key in sorted(docs))  # Code point order = UTF-8 order
+    write_sorted_index(index_path, entries, source_info, lines)
+
+
+def write_sorted_index(index_path, entries, source_info, lines=None,
+                       sharded=False):
+    """Writes a binary index file from entries that are sorted by key.
+
+    Args:
+        index_path: Path of the index file that will be written.
+        entries: Iterable of (key, byte position, end byte position,
+            line number, shard number) tuples, sorted by key, with no
+            duplicate keys.
+        source_info: SourceInfo tuple describing the source file(s).
+        lines: List of (byte position, key) tuples, one per line in
+            the source file, or None if there is no line index.
+        sharded: If True, shard numbers are saved in the index.
+    """
+    slots = {} if lines is not None else None
+    key_offsets = array.array('q', [0])
+    positions = array.array('q')
+    ends = array.array('q')
+    line_nums = array.array('q')
+    shard_ids = array.array('q')
+    blob = bytearray()
+    for key, byte_pos, end_pos, line_num, shard in entries:
+        if slots is not None:
+            slots[key] = len(positions)
+        blob.extend(key.encode('utf-8'))
+        key_offsets.append(len(blob))
+        positions.append(byte_pos)
+        ends.append(end_pos)
+        line_nums.append(line_num)
+        if sharded:
+            shard_ids.append(shard)
+    line_positions = array.array('q')
+    line_slots = array.array('q')
+    flags = _FLAG_LITTLE_ENDIAN if sys.byteorder == 'little' else 0
+    if sharded:
+        flags |= _FLAG_SHARDS
+    if lines is not None:
+        flags |= _FLAG_LINE_INDEX
+        for byte_pos, key in lines:
+            line_positions.append(byte_pos)
+            line_slots.append(slots.get(key, -1))
+
+    # Write to a temporary file first so an interrupted write never
+    #   leaves a partial index behind.
+    tmp_path = '{}.{}.tmp'.format(index_path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as ifile:
+            ifile.write(_HEADER.pack(_MAGIC, _VERSION, flags, len(positions),
+                                     len(line_positions), len(blob),
+                                     *source_info))
+            ifile.write(b'\0' * (-_HEADER.size % _ITEM_SIZE))
+            for section in [key_offsets, positions, ends, line_nums,
+                            line_positions, line_slots, shard_ids]:
+                section.tofile(ifile)
+            ifile.write(blob)
+        os.replace(tmp_path, index_path)
+    finally:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+
+
+def _merge_index(binary_index, index_path, docs, lines, source_info):
+    """Writes a binary index file that adds new records to an index.
+
+    The existing index is not decoded. Each new key's slot is found
+    with a binary search and the sections of the existing index are
+    copied around the new entries, so only the new records are held
+    in memory.
+
+    Args:
+        binary_index: The existing BinaryIndex. It must not be sharded.
+        index_path: Path of the index file that will be written. May be
+            the path of binary_index.
+        docs: Dictionary mapping each new key value to a tuple of
+            (byte position, end byte position, line number). Keys that
+            are already in binary_index replace the existing entry.
+        lines: List of (byte position, key) tuples for the new lines,
+            or None if there is no line index.
+        source_info: SourceInfo tuple describing the source file at
+            the time it was indexed.
+    """
+    # Old slots are copied in runs between the new entries. added
+    #   holds the old slot before which each key that is not in the
+    #   index is inserted, which gives the new slot of every old slot.
+    runs = []    # (first old slot, end old slot, new entry)
+    added = []
+    slots = {}   # New key value -> new slot
+    run_start = 0
+    blob_len = binary_index._blob_end - binary_index._blob_start
+    for key in sorted(docs):  # Code point order = UTF-8 order
+        key_bytes = key.encode('utf-8')
+        slot = binary_index.bisect(key_bytes)
+        slots[key] = slot + len(added)
+        runs.append((run_start, slot, (key_bytes,) + docs[key]))
+        if (slot < binary_index.num_keys
+                and binary_index.key_bytes_at(slot) == key_bytes):
+            run_start = slot + 1  # Replaces the existing entry
+        else:
+            run_start = slot
+            added.append(slot)
+            blob_len += len(key_bytes)
+    runs.append((run_start, binary_index.num_keys, None))
+    key_offsets = binary_index._key_offsets
+    blob_start = binary_index._blob_start
+    num_keys = binary_index.num_keys + len(added)
+    num_lines = binary_index.num_lines
+    flags = _FLAG_LITTLE_ENDIAN if sys.byteorder == 'little' else 0
+    if lines is not None:
+        flags |= _FLAG_LINE_INDEX
+        num_lines += len(lines)
+
+    def new_slot(slot):
+        return slot + bisect.bisect_right(added, slot) if slot >= 0 else -1
+
+    tmp_path = '{}.{}.tmp'.format(index_path, os.getpid())
+    try:
+        with open(tmp_path, 'wb') as ifile:
+            ifile.write(_HEADER.pack(_MAGIC, _VERSION, flags, num_keys,
+                                     num_lines, blob_len, *source_info))
+            ifile.write(b'\0' * (-_HEADER.size % _ITEM_SIZE))
+            # Key offsets, shifted by the length of the keys written before
+            offset = 0
+            ifile.write(array.array('q', [0]))
+            for start, end, entry in runs:
+                shift = offset - key_offsets[start]
+                old_offsets = key_offsets[start + 1:end + 1]
+                ifile.write(old_offsets if shift == 0 else array.array(
+                    'q', (key_offset + shift for key_offset in old_offsets)))
+                offset = key_offsets[end] + shift
+                if entry is not None:
+                    offset += len(entry[0])
+                    ifile.write(array.array('q', [offset]))
+            # Byte positions, end positions and line numbers
+            for field, section in enumerate([binary_index.positions,
+                                             binary_index.ends,
+                                             binary_index.line_nums], 1):
+                for start, end, entry in runs:
+                    ifile.write(section[start:end])
+                    if entry is not None:
+                        ifile.write(array.array('q', [entry[field]]))
+            if lines is not None:
+                ifile.write(binary_index.line_positions)
+                ifile.write(array.array('q', (byte_pos
+                                              for byte_pos, _ in lines)))
+                line_slots = binary_index.line_slots
+                if not added:  # Old slot numbers are unchanged
+                    ifile.write(line_slots)
+                for chunk_start in range(0, len(line_slots) if added else 0,
+                                         65_536):
+                    chunk = line_slots[chunk_start:chunk_start + 65_536]
+                    ifile.write(array.array('q', map(new_slot, chunk)))
+                ifile.write(array.array('q', (slots.get(key, -1)
+                                              for _, key in lines)))
+            # Key blob
+            for start, end, entry in runs:
+                ifile.write(binary_index._mm[blob_start + key_offsets[start]:
+                                             blob_start + key_offsets[end]])
+                if entry is not None:
+                    ifile.write(entry[0])
+        os.replace(tmp_path, index_path)
+    finally:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+
+
+def _read_records(spans, read, records, max_gap):
+    """Reads records in file order, merging reads of nearby records.
+
+    Args:
+        spans: List of (start, end, pos) tuples sorted by start. start
+            and end are the byte positions of a record in the source
+            file and pos is the position of the record in records.
+        read: Function that takes a start and end byte position and
+            returns the bytes in between, as bytes or a memoryview.
+        records: List in which the decoded records are stored.
+        max_gap: Records separated by no more than this many bytes
+            are read with a single call to read.
+    """
+    run_idx = 0
+    while run_idx < len(spans):
+        run_start, run_end, _ = spans[run_idx]
+        next_idx = run_idx + 1
+        while (next_idx < len(spans)
+               and spans[next_idx][0] - run_end <= max_gap
+               and spans[next_idx][1] - run_start <= _MAX_READ):
+            run_end = max(run_end, spans[next_idx][1])
+            next_idx += 1
+        data = read(run_start, run_end)
+        for start, end, pos in spans[run_idx:next_idx]:
+            records[pos] = str(data[start - run_start:end - run_start],
+                               'utf-8')
+        if isinstance(data, memoryview):
+            data.release()
+        run_idx = next_idx
+
+
+class BinaryIndex(collections.abc.Mapping):
+    """Read-only, memory-mapped view of a binary index file.
+
+    Behaves like the dictionary that earlier versions of IndexedFile
+    stored in the `docs` attribute: keys are the record key values and
+    values are (byte position, line number) tuples.
+    """
+    def __init__(self, index_path):
+        """Memory-maps the index file and validates the header."""
+        with open(index_path, 'rb') as ifile:
+            self._mm = mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, flags, num_keys, num_lines, blob_len = (
+            _HEADER.unpack_from(self._mm, 0)[:6])
+        byte_order = 'little' if flags & _FLAG_LITTLE_ENDIAN else 'big'
+        if (magic != _MAGIC or version != _VERSION
+                or byte_order != sys.byteorder):
+            self._mm.close()
+            raise ValueError('Index file "{}" has an unsupported format.'
+                             .format(index_path))
+        self.index_path = index_path
+        self.source_info = SourceInfo(*_HEADER.unpack_from(self._mm, 0)[6:])
+        self.num_keys = num_keys
+        self.num_lines = num_lines
+        self.has_lines = bool(flags & _FLAG_LINE_INDEX)
+        self.has_shards = bool(flags & _FLAG_SHARDS)
+
+        view = memoryview(self._mm)
+        offset = _HEADER.size + (-_HEADER.size % _ITEM_SIZE)
+        sections = []
+        for length in [num_keys + 1, num_keys, num_keys, num_keys,
+                       num_lines, num_lines,
+                       num_keys if self.has_shards else 0]:
+            end = offset + length * _ITEM_SIZE
+            sections.append(view[offset:end].cast('q'))
+            offset = end
+        (self._key_offsets, self.positions, self.ends, self.line_nums,
+         self.line_positions, self.line_slots, self.shard_ids) = sections
+        self._blob_start = offset
+        self._blob_end = offset + blob_len
+
+    def update_source_info(self, source_info):
+        """Rewrites the source file information in the index header."""
+        header = _HEADER.unpack_from(self._mm, 0)[:6] + tuple(source_info)
+        with open(self.index_path, 'r+b') as ifile:
+            ifile.write(_HEADER.pack(*header))
+        self.source_info = source_info
+
+    def key_at(self, slot):
+        """Returns the key value stored in a slot of the sorted array."""
+        return self.key_bytes_at(slot).decode('utf-8')
+
+    def key_bytes_at(self, slot):
+        """Returns the UTF-8 encoded key value stored in a slot."""
+        return self._mm[self._blob_start + self._key_offsets[slot]:
+                        self._blob_start + self._key_offsets[slot + 1]]
+
+    def bisect(self, key_bytes):
+        """Returns the first slot with a key value >= key_bytes."""
+        key_offsets = self._key_offsets
+        blob_start = self._blob_start
+        lo, hi = 0, self.num_keys
+        while lo < hi:  # Binary search over the sorted key array
+            mid = (lo + hi) // 2
+            mid_key = self._mm[blob_start + key_offsets[mid]:
+                               blob_start + key_offsets[mid + 1]]
+            if mid_key < key_bytes:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find(self, key):
+        """Returns the slot that contains key, or -1 if not found."""
+        key_bytes = key.encode('utf-8')
+        slot = self.bisect(key_bytes)
+        if slot < self.num_keys and self.key_bytes_at(slot) == key_bytes:
+            return slot
+        return -1
+
+    def __getitem__(self, key):
+        slot = self.find(key) if isinstance(key, str) else -1
+        if slot < 0:
+            raise KeyError(key)
+        return (self.positions[slot], self.line_nums[slot])
+
+    def __contains__(self, key):
+        return isinstance(key, str) and self.find(key) >= 0
+
+    def __iter__(self):
+        return (self.key_at(slot) for slot in range(self.num_keys))
+
+    def iter_key_bytes(self):
+        """Iterates over the UTF-8 encoded key values in sorted order."""
+        blob = self._mm[self._blob_start:self._blob_end]
+        key_offsets = self._key_offsets
+        return (blob[start:end]
+                for start, end in zip(key_offsets, key_offsets[1:]))
+
+    def __len__(self):
+        return self.num_keys
+
+    def close(self):
+        """Releases the memory-mapped index file."""
+        for section in [self._key_offsets, self.positions, self.ends,
+                        self.line_nums, self.line_positions, self.line_slots,
+                        self.shard_ids]:
+            section.release()
+        self._mm.close()
+
+
+class _LineIndex(collections.abc.Sequence):
+    """Read-only view of the line index within a binary index file.
+
+    Behaves like the list that earlier versions of IndexedFile stored
+    in the `lines` attribute: one (byte position, key) tuple per line.
+    """
+    def __init__(self, binary_index):
+        self._index = binary_index
+
+    def __getitem__(self, line_num):
+        if isinstance(line_num, slice):
+            return [self[idx] for idx in range(*line_num.indices(len(self)))]
+        if line_num < 0:
+            line_num += len(self)
+        if not 0 <= line_num < len(self):
+            raise IndexError('Line number out of range.')
+        slot = self._index.line_slots[line_num]
+        key = self._index.key_at(slot) if slot >= 0 else None
+        return (self._index.line_positions[line_num], key)
+
+    def __len__(self):
+        return self._index.num_lines
 
 class IndexedFile():
     """Represents an indexed JSONL, TSV, or other delimited file.
@@ -39,12 +580,38 @@ class IndexedFile():
             in addition to being retrieved by the key value. Defaults to
             False because indexing by lines as well as key values
             significantly increases the size of the index file.
+        use_mmap: If True, the source file is memory-mapped instead of
+            being read through a text file object. Records are sliced
+            directly from the mapped file, which avoids a seek and read
+            system call for every lookup. Optional, defaults to False.
+        workers: Number of processes used to build the index. The
+            source file is split into byte ranges that are indexed in
+            parallel. Optional, defaults to 1. Has no effect if the
+            index already exists.
+
+    If the source file has changed since the index was built, the index
+    is rebuilt when the IndexedFile is created. If lines were only
+    appended to the source file, only the appended lines are indexed.
 
     Attributes:
         close(): IndexedFile keeps the source file open for quick data
             access. This method will close the source file. No data will
             be accessible after calling close(). The file will also be
             closed if the IndexedFile object is deleted.
+        get_raw(key): Returns the record for a key value or line number
+            as raw UTF-8 bytes, including the line terminator. When
+            use_mmap is True, the record is a memoryview slice of the
+            memory-mapped source file, so no data is copied until the
+            record is decoded, e.g., with `str(record, 'utf-8')`.
+        get_many(keys, missing='raise'): Returns a list of records for
+            a list of key values or line numbers, in the same order as
+            the keys. The records are read in file order, and records
+            that are close together are read with a single read, which
+            is much faster than looking up keys one at a time when the
+            keys are in random order. The missing argument determines
+            what happens to keys that are not in the index: 'raise'
+            raises a KeyError, 'skip' leaves the record out of the
+            list, and 'none' returns None in place of the record.
 
     Examples:
     idx_file = indexer.IndexedFile('big_file.json', 'id')
@@ -55,7 +622,8 @@ class IndexedFile():
     # Done with IndexedFile
     idx_file.close()
     """
-    def __init__(self, input_file_path, key_idx, delim='\t', line_idx=False):
+    def __init__(self, input_file_path, key_idx, delim='\t', line_idx=False,
+                 use_mmap=False, workers=1):
         """Creates index or reads index from disk."""
         # Check arguments
         if not os.path.isfile(input_file_path):
@@ -71,75 +639,229 @@ class IndexedFile():
         self.key_idx = key_idx
         self.delim = delim
         self.line_idx = line_idx
+        self.use_mmap = use_mmap
+        self.workers = max(1, workers)
         self.lines = None
         self.docs = None
+        self.file = None
+        self.source = None
 
-        # Check if index already exists - if not, build index
-        self.index_path = self.input_file_path + '.pickled-index'
-        if not os.path.isfile(self.index_path):
+        # Check if index already exists - if not, build index. Convert
+        #   indexes saved by earlier versions to the binary format.
+        self.index_path = self.input_file_path + '.bin-index'
+        self.pickled_index_path = self.input_file_path + '.pickled-index'
+        if os.path.isfile(self.index_path):
+            self._read_index()
+        elif os.path.isfile(self.pickled_index_path):
+            self._migrate_pickled_index()
+        if self.docs is None:
             self._build_index()
             self._save_index()
-        else:
             self._read_index()
 
         # Open indexed document for access
         self.file = open(input_file_path, 'rt')
+        if self.use_mmap and os.fstat(self.file.fileno()).st_size > 0:
+            self.source = mmap.mmap(self.file.fileno(), 0,
+                                    access=mmap.ACCESS_READ)
         
     def _build_index(self):
-        """Builds a new index if index does not already exist."""
+        """Builds a new index if index does not already exist.
+
+        Key values in JSONL files are read with codec.field_decoder(),
+        which matches the key with a regular expression only when it is
+        a top-level key of the line's dictionary. Other lines, such as
+        lines with a nested dictionary before the key, are decoded with
+        the JSON parser.
+        """
         print('Starting to index', self.input_file_path)
+        start_time = time.time()
+        source_info = get_source_info(self.input_file_path)
+        ranges = _split_ranges(self.input_file_path, self.workers,
+                               source_info.size)
+        tasks = [(self.input_file_path, start, end, self.key_idx, self.delim)
+                 for start, end in ranges]
+        if self.workers > 1 and len(tasks) > 1:
+            print('Indexing {} byte ranges with {} processes'
+                  .format(len(tasks), self.workers))
+            pool = multiprocessing.Pool(self.workers)
+            results = pool.imap(_scan_range_star, tasks)
+        else:
+            pool = None
+            results = map(_scan_range_star, tasks)
+
+        # Merge partial indexes, in file order
         line_index = []
         doc_index = {}
-        with open(self.input_file_path, 'rt') as dfile:
-            byte_pos = 0
-            line_num = 0
-            line = dfile.readline()
-            while line != '':
-                key = self._get_key(line)
-                line_index.append((byte_pos, key))
-                if key is not None:
-                    doc_index[key] = (byte_pos, line_num)
-                byte_pos = dfile.tell()
-                line_num += 1
-                line = dfile.readline()
-                if line_num % 500_000 == 0:
-                    print(f'Lines Indexed: {line_num:>12,}')
-        
+        line_num = 0
+        try:
+            for (_, range_end), (positions, keys) in zip(ranges, results):
+                ends = itertools.chain(itertools.islice(positions, 1, None),
+                                       [range_end])
+                for byte_pos, end_pos, key in zip(positions, ends, keys):
+                    if self.line_idx:
+                        line_index.append((byte_pos, key))
+                    if key is not None:
+                        doc_index[key] = (byte_pos, end_pos, line_num)
+                    line_num += 1
+                print(f'Lines Indexed: {line_num:>12,}')
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        byte_pos = ranges[-1][1] if ranges else 0
+        elapsed = max(time.time() - start_time, 1e-9)
+
         print('\nIndexing Complete.')
-        print('Number of Lines:', line_num + 1)
+        print('Number of Lines:', line_num)
         print(f'Number of MB: {byte_pos/1_000_000:,}')
+        print(f'Lines per Second: {line_num/elapsed:,.0f}')
         
         if self.line_idx:
             self.lines = line_index
         self.docs = doc_index
-
-    def _get_key(self, line):
-        """Gets unique key value from line in text file."""
-        if isinstance(self.key_idx, int):
-            # Source file is TSV, CSV, or similar and key is in key-th col
-            return line.split(self.delim)[self.key_idx]
-        else:
-            # Source file is JSONL and key value has dictionary key = key_idx
-            return json.loads(line)[self.key_idx]
+        self.source_info = source_info._replace(num_lines=line_num)
 
     def _save_index(self):
-        """Saves index data structure to disk as a pickle file."""
-        with open(self.index_path, 'wb')as pfile:
-            pickle.dump((self.docs, self.lines), pfile)
+        """Saves index data structure to disk as a binary index file."""
+        _write_index(self.index_path, self.docs, self.lines, self.source_info)
 
     def _read_index(self):
-        """Reads index datastructure from disk."""
+        """Memory-maps the binary index file.
+
+        Leaves self.docs set to None if the index file cannot be used,
+        which will cause the index to be rebuilt.
+        """
         print('Reading index from ', self.index_path)
-        with open(self.index_path, 'rb') as pfile:
-            self.docs, self.lines = pickle.load(pfile)
+        try:
+            binary_index = BinaryIndex(self.index_path)
+        except ValueError as err:
+            print(err, 'Rebuilding index.')
+            return
+        if self.line_idx and not binary_index.has_lines:
+            print('Index does not contain line numbers. Rebuilding index.')
+            binary_index.close()
+            return
+        binary_index = self._check_source(binary_index)
+        if binary_index is None:
+            return
+        self.docs = binary_index
+        self.lines = _LineIndex(binary_index) if binary_index.has_lines else None
 
-    def __getitem__(self, key):
-        """Allows array-style line access, using key value or line #."""
+    def _check_source(self, binary_index):
+        """Checks if the source file has changed since it was indexed.
+
+        If the source file's size and modification time are unchanged,
+        the index is current. Otherwise, the checksum of the part of
+        the source file that was indexed is recalculated. If it has not
+        changed and the file is now longer, the appended lines are
+        added to the index.
+
+        Args:
+            binary_index: The BinaryIndex that was read from disk.
+
+        Returns: A BinaryIndex that matches the source file, or None
+        if the index must be rebuilt. binary_index is closed if it is
+        not returned.
+        """
+        indexed = binary_index.source_info
+        stat = os.stat(self.input_file_path)
+        if (stat.st_size == indexed.size
+                and stat.st_mtime_ns == indexed.mtime_ns):
+            return binary_index
+        if (stat.st_size < indexed.size or indexed.checksum !=
+                _sample_checksum(self.input_file_path, indexed.size)):
+            print('Source file has changed. Rebuilding index.')
+            binary_index.close()
+            return None
+        if stat.st_size == indexed.size:  # Modified time changed only
+            binary_index.update_source_info(
+                indexed._replace(mtime_ns=stat.st_mtime_ns))
+            return binary_index
+        with open(self.input_file_path, 'rb') as dfile:
+            dfile.seek(max(indexed.size - 1, 0))
+            if indexed.size > 0 and dfile.read(1) != b'\n':
+                print('Last indexed line has changed. Rebuilding index.')
+                binary_index.close()
+                return None
+        self._index_appended_lines(binary_index)
+        binary_index.close()
+        return BinaryIndex(self.index_path)
+
+    def _index_appended_lines(self, binary_index):
+        """Adds lines appended to the source file to the index file."""
+        indexed = binary_index.source_info
+        source_info = get_source_info(self.input_file_path)
+        print('Source file has grown by {:,} bytes. Indexing new lines.'
+              .format(source_info.size - indexed.size))
+        docs = {}
+        lines = [] if binary_index.has_lines else None
+        line_num = indexed.num_lines
+        for start, end in _split_ranges(self.input_file_path, 1,
+                                        source_info.size, indexed.size):
+            positions, keys = _scan_range(self.input_file_path, start, end,
+                                          self.key_idx, self.delim)
+            ends = itertools.chain(itertools.islice(positions, 1, None),
+                                   [end])
+            for byte_pos, end_pos, key in zip(positions, ends, keys):
+                if lines is not None:
+                    lines.append((byte_pos, key))
+                docs[key] = (byte_pos, end_pos, line_num)
+                line_num += 1
+        print('Number of Lines:', line_num)
+        _merge_index(binary_index, self.index_path, docs, lines,
+                     source_info._replace(num_lines=line_num))
+
+    def _migrate_pickled_index(self):
+        """Converts a pickled index from an earlier version to binary.
+
+        Pickled indexes did not store the end position of each record,
+        so the end positions are found by searching the source file for
+        the end of each line. The pickled index file is not deleted.
+        """
+        print('Converting pickled index', self.pickled_index_path)
+        with open(self.pickled_index_path, 'rb') as pfile:
+            docs, lines = pickle.load(pfile)
+        if self.line_idx and lines is None:
+            return
+        with open(self.input_file_path, 'rb') as dfile:
+            file_size = os.fstat(dfile.fileno()).st_size
+            if file_size == 0:
+                return
+            source = mmap.mmap(dfile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            migrated_docs = {}
+            for key, (byte_pos, line_num) in docs.items():
+                end_pos = source.find(b'\n', byte_pos) + 1
+                migrated_docs[key] = (byte_pos,
+                                      end_pos if end_pos else file_size,
+                                      line_num)
+        finally:
+            source.close()
+        # Pickled indexes have no record of the source file that was
+        #   indexed, so assume the current file matches the index. The
+        #   last line always has the highest line number in docs.
+        if lines is not None:
+            num_lines = len(lines)
+        else:
+            num_lines = max(line_num for _, line_num in docs.values()) + 1
+        source_info = get_source_info(self.input_file_path, num_lines)
+        _write_index(self.index_path, migrated_docs, lines, source_info)
+        self._read_index()
+
+    def _get_span(self, key):
+        """Gets the start and end byte positions of a record.
+
+        Args:
+            key: String key value or integer line number.
+
+        Returns: A (start, end) tuple. The end position is the start
+        position of the next line in the source file.
+        """
         if isinstance(key, str):
-            idx_record = self.docs.get(key, None)
-            if idx_record is not None:
-                self.file.seek(idx_record[0])
-                return self.file.readline()
+            slot = self.docs.find(key)
+            if slot >= 0:
+                return self.docs.positions[slot], self.docs.ends[slot]
             else:
                 error_msg = ('Key {} does not exist in index.'
                              .format(key))
@@ -149,21 +871,427 @@ class IndexedFile():
                 error_msg = 'Integer key provided but line index not available.'
                 raise KeyError(error_msg)
             elif key >= 0 and key < len(self.lines):
-                byte_pos = self.lines[key][0]
-                self.file.seek(byte_pos)
-                return self.file.readline()
+                start = self.docs.line_positions[key]
+                if key + 1 < len(self.lines):
+                    end = self.docs.line_positions[key + 1]
+                else:
+                    end = os.fstat(self.file.fileno()).st_size
+                return start, end
             else:
                 error_msg = ('Integer key {} out of range.'.format(key))
+                raise KeyError(error_msg)
         raise KeyError('Key must be an integer line number or string')
 
+    def _read(self, start, end):
+        """Reads the bytes between two positions in the source file.
+
+        Returns a memoryview slice of the source file if use_mmap is
+        True, otherwise a bytes object.
+        """
+        if self.source is not None:
+            return memoryview(self.source)[start:end]
+        return os.pread(self.file.fileno(), end - start, start)
+
+    def get_raw(self, key):
+        """Gets a record as raw bytes, using key value or line #.
+
+        Returns a memoryview slice of the source file if use_mmap is
+        True, otherwise a bytes object.
+        """
+        return self._read(*self._get_span(key))
+
+    def get_many(self, keys, missing='raise', max_gap=_MAX_GAP):
+        """Gets several records with sorted, coalesced reads.
+
+        Args:
+            keys: List of string key values or integer line numbers.
+            missing: 'raise', 'skip', or 'none'. Specifies whether keys
+                that are not in the index raise a KeyError, are left
+                out of the returned list, or are returned as None.
+            max_gap: Records separated by no more than this many bytes
+                are read from disk with a single read.
+
+        Returns: A list of record strings, in the same order as keys.
+        """
+        if missing not in _MISSING_POLICIES:
+            raise ValueError('missing must be one of {}.'
+                             .format(', '.join(_MISSING_POLICIES)))
+        records = [None] * len(keys)
+        spans = []
+        for pos, key in enumerate(keys):
+            try:
+                start, end = self._get_span(key)
+            except KeyError:
+                if missing == 'raise':
+                    raise
+                continue
+            spans.append((start, end, pos))
+        spans.sort()
+        _read_records(spans, self._read, records, max_gap)
+
+        if missing == 'skip':
+            return [record for record in records if record is not None]
+        return records
+
+    def __getitem__(self, key):
+        """Allows array-style line access, using key value or line #."""
+        if self.source is not None:
+            start, end = self._get_span(key)
+            return str(self.source[start:end], 'utf-8')
+        start, _ = self._get_span(key)
+        self.file.seek(start)
+        return self.file.readline()
+
     def __len__(self):
         """Gets number of records in index."""
         return len(self.docs)
+
+    def sorted_keys(self):
+        """Iterates over every key value in the file in sorted order.
+        Key values are returned as UTF-8 encoded bytes."""
+        return self.docs.iter_key_bytes()
     
     def close(self):
         """Close source text file if finished with data access."""
-        self.file.close()
+        if self.source is not None:
+            try:
+                self.source.close()
+            except BufferError:
+                pass  # Records still in use, mmap is closed when released
+            self.source = None
+        if self.file is not None:
+            self.file.close()
+        if isinstance(self.docs, BinaryIndex):
+            self.docs.close()
+            self.docs = None
+            self.lines = None
 
     def __del__(self):
         """Close source text file if IndexedFile object is deleted."""
-        self.file.close()
\ No newline at end of file
+        if hasattr(self, 'docs'):
+            self.close()
+
+
+class IndexedCollection():
+    """Represents a folder of indexed JSONL, TSV, or delimited shards.
+
+    Looking up a key in a list of IndexedFile objects requires trying
+    every file until the key is found. IndexedCollection builds one
+    index over all shard files that maps each key value to the shard
+    and byte position of its record, so a lookup is a single binary
+    search regardless of the number of shards. The collection index is
+    saved in the shard folder as 'collection.bin-index'. An IndexedFile
+    index is also created for each shard.
+
+    Shard files are opened the first time a record is read from them.
+    At most max_open_files shard files are kept open at once, the
+    least recently used shard is closed when the limit is reached.
+
+    If a key value appears in more than one shard, the record from
+    the shard whose file name comes first in sorted order is used.
+
+    Constructor arguments:
+        shards_path: Path to the folder that contains the shard files.
+        key_idx: Location of the key value within each line. See
+            IndexedFile.
+        delim: Column delimiter for delimited files. Optional,
+            defaults to '\t'.
+        suffix: Only files whose names end with suffix are included in
+            the collection, e.g., '.json'. Index files are always
+            excluded. Optional, defaults to all files.
+        use_mmap: If True, shard files are memory-mapped. Optional,
+            defaults to True.
+        workers: Number of processes used to build the index for each
+            shard. Optional, defaults to 1.
+        max_open_files: Maximum number of shard files that are open at
+            the same time. Optional, defaults to 64.
+
+    Attributes:
+        shard_paths: Sorted list of paths to the shard files.
+        shard_len(shard_num): Returns the number of records in a shard.
+        get_raw(key), get_many(keys, missing='raise'), close(): Same as
+            the IndexedFile methods, except that records can only be
+            retrieved by key value, not by line number.
+
+    Examples:
+    idx_coll = indexer.IndexedCollection('hdct_weights', 'id',
+                                         suffix='.json')
+    num_records = len(idx_coll)
+    line_txt = idx_coll['D3527']
+    idx_coll.close()
+    """
+    def __init__(self, shards_path, key_idx, delim='\t', suffix='',
+                 use_mmap=True, workers=1, max_open_files=64):
+        """Creates index or reads index from disk."""
+        if not os.path.isdir(shards_path):
+            raise ValueError('Shard folder "{}" does not exist.'
+                             .format(shards_path))
+        self.shards_path = shards_path
+        self.shard_paths = sorted(
+            os.path.join(shards_path, fname)
+            for fname in os.listdir(shards_path)
+            if fname.endswith(suffix) and not fname.endswith(INDEX_SUFFIXES)
+            and os.path.isfile(os.path.join(shards_path, fname)))
+        self.key_idx = key_idx
+        self.delim = delim
+        self.suffix = suffix
+        self.use_mmap = use_mmap
+        self.workers = workers
+        self.max_open_files = max(1, max_open_files)
+        self._open_shards = collections.OrderedDict()
+        self.docs = None
+
+        self.index_path = os.path.join(shards_path, _COLLECTION_INDEX_NAME)
+        source_info = self._get_source_info()
+        if os.path.isfile(self.index_path):
+            print('Reading collection index from', self.index_path)
+            try:
+                self.docs = BinaryIndex(self.index_path)
+            except ValueError as err:
+                print(err, 'Rebuilding index.')
+            else:
+                indexed = self.docs.source_info._replace(num_lines=0)
+                if indexed != source_info:
+                    print('Shard files have changed. Rebuilding index.')
+                    self.docs.close()
+                    self.docs = None
+        if self.docs is None:
+            self._build_index(source_info)
+            self.docs = BinaryIndex(self.index_path)
+
+    def _get_source_info(self):
+        """Gets a SourceInfo tuple that identifies the shard files.
+
+        The checksum is calculated from the name, size, and modified
+        time of every shard and the key settings, so adding, removing,
+        or changing a shard causes the collection index to be rebuilt.
+        """
+        checksum = hashlib.blake2b(digest_size=16)
+        checksum.update(repr((self.key_idx, self.delim, self.suffix))
+                        .encode('utf-8'))
+        total_size = 0
+        last_mtime = 0
+        for path in self.shard_paths:
+            stat = os.stat(path)
+            total_size += stat.st_size
+            last_mtime = max(last_mtime, stat.st_mtime_ns)
+            checksum.update(repr((os.path.basename(path), stat.st_size,
+                                  stat.st_mtime_ns)).encode('utf-8'))
+        return SourceInfo(total_size, last_mtime, 0, checksum.digest())
+
+    def _build_index(self, source_info):
+        """Merges the indexes of all shards into one index file."""
+        print('Indexing {} shards in {}'.format(len(self.shard_paths),
+                                               self.shards_path))
+        shard_indexes = []
+        try:
+            for path in self.shard_paths:
+                shard_file = IndexedFile(path, self.key_idx, self.delim,
+                                         workers=self.workers)
+                shard_file.close()
+                shard_indexes.append(BinaryIndex(shard_file.index_path))
+
+            # The shard indexes are already sorted, so merge them
+            #   without loading all keys into memory at once.
+            def shard_entries(shard_num, shard_index):
+                for slot in range(len(shard_index)):
+                    yield shard_index.key_at(slot), shard_num, slot
+
+            def merged_entries():
+                last_key = None
+                for key, shard_num, slot in heapq.merge(
+                        *[shard_entries(shard_num, shard_index)
+                          for shard_num, shard_index
+                          in enumerate(shard_indexes)]):
+                    if key == last_key:
+                        continue  # Keep record from first shard
+                    last_key = key
+                    shard_index = shard_indexes[shard_num]
+                    yield (key, shard_index.positions[slot],
+                           shard_index.ends[slot],
+                           shard_index.line_nums[slot], shard_num)
+
+            num_lines = sum(shard_index.source_info.num_lines
+                            for shard_index in shard_indexes)
+            write_sorted_index(self.index_path, merged_entries(),
+                                source_info._replace(num_lines=num_lines),
+                                sharded=True)
+        finally:
+            for shard_index in shard_indexes:
+                shard_index.close()
+        print('Collection Indexing Complete.')
+
+    def shard_len(self, shard_num):
+        """Gets number of records in a shard, without opening it."""
+        shard_index = BinaryIndex(self.shard_paths[shard_num] + '.bin-index')
+        try:
+            return len(shard_index)
+        finally:
+            shard_index.close()
+
+    def _get_span(self, key):
+        """Gets the shard number, start, and end position of a record."""
+        slot = self.docs.find(key) if isinstance(key, str) else -1
+        if slot < 0:
+            raise KeyError('Key {} does not exist in index.'.format(key))
+        return (self.docs.shard_ids[slot], self.docs.positions[slot],
+                self.docs.ends[slot])
+
+    def _get_shard(self, shard_num):
+        """Gets a shard's open file and mmap, opening it if needed."""
+        shard = self._open_shards.pop(shard_num, None)
+        if shard is None:
+            if len(self._open_shards) >= self.max_open_files:
+                _, lru_shard = self._open_shards.popitem(last=False)
+                self._close_shard(lru_shard)
+            sfile = open(self.shard_paths[shard_num], 'rb')
+            source = None
+            if self.use_mmap and os.fstat(sfile.fileno()).st_size > 0:
+                source = mmap.mmap(sfile.fileno(), 0, access=mmap.ACCESS_READ)
+            shard = (sfile, source)
+        self._open_shards[shard_num] = shard  # Most recently used is last
+        return shard
+
+    @staticmethod
+    def _close_shard(shard):
+        """Closes a shard's file and mmap."""
+        sfile, source = shard
+        if source is not None:
+            try:
+                source.close()
+            except BufferError:
+                pass  # Records still in use, mmap is closed when released
+        sfile.close()
+
+    def _read(self, shard_num, start, end):
+        """Reads the bytes between two positions in a shard file."""
+        sfile, source = self._get_shard(shard_num)
+        if source is not None:
+            return memoryview(source)[start:end]
+        return os.pread(sfile.fileno(), end - start, start)
+
+    def get_raw(self, key):
+        """Gets a record as raw bytes, using key value."""
+        return self._read(*self._get_span(key))
+
+    def get_many(self, keys, missing='raise', max_gap=_MAX_GAP):
+        """Gets several records with sorted, coalesced reads.
+
+        Records are grouped by shard and read in file order. See
+        IndexedFile.get_many() for a description of the arguments.
+
+        Returns: A list of record strings, in the same order as keys.
+        """
+        if missing not in _MISSING_POLICIES:
+            raise ValueError('missing must be one of {}.'
+                             .format(', '.join(_MISSING_POLICIES)))
+        records = [None] * len(keys)
+        spans = []
+        for pos, key in enumerate(keys):
+            try:
+                shard_num, start, end = self._get_span(key)
+            except KeyError:
+                if missing == 'raise':
+                    raise
+                continue
+            spans.append((shard_num, start, end, pos))
+        spans.sort()
+        for shard_num, shard_spans in itertools.groupby(spans,
+                                                        lambda x: x[0]):
+            _read_records([span[1:] for span in shard_spans],
+                          functools.partial(self._read, shard_num),
+                          records, max_gap)
+
+        if missing == 'skip':
+            return [record for record in records if record is not None]
+        return records
+
+    def __getitem__(self, key):
+        """Allows array-style record access, using key value."""
+        return str(self.get_raw(key), 'utf-8')
+
+    def __contains__(self, key):
+        return key in self.docs
+
+    def __len__(self):
+        """Gets number of records in index."""
+        return len(self.docs)
+
+    def sorted_keys(self):
+        """Iterates over every key value in the collection in sorted
+        order. Key values are returned as UTF-8 encoded bytes."""
+        return self.docs.iter_key_bytes()
+
+    def fingerprint(self):
+        """Returns a hex string that identifies the shard files.
+
+        The fingerprint changes if shards are added, removed, or
+        modified, or if the key settings change.
+        """
+        return self.docs.source_info.checksum.hex()
+
+    def close(self):
+        """Close all shard files if finished with data access."""
+        while self._open_shards:
+            _, shard = self._open_shards.popitem()
+            self._close_shard(shard)
+        if self.docs is not None:
+            self.docs.close()
+            self.docs = None
+
+    def __del__(self):
+        """Close shard files if IndexedCollection object is deleted."""
+        if hasattr(self, '_open_shards'):
+            self.close()
+
+
+def open_index(path, key_idx, **kwargs):
+    """Opens an IndexedCollection if path is a folder, else an IndexedFile.
+
+    Additional keyword arguments are passed to the constructor. Parquet
+    files (see columnar.py) are opened as a columnar.ColumnarCorpus,
+    which is keyed on its first column, so key_idx and the keyword
+    arguments are ignored.
+    """
+    if path.endswith('.parquet'):
+        try:
+            import util.columnar as columnar
+        except ImportError:  # Imported from the util folder
+            import columnar
+        return columnar.ColumnarCorpus(path)
+    if os.path.isdir(path):
+        return IndexedCollection(path, key_idx, **kwargs)
+    return IndexedFile(path, key_idx, **kwargs)
+
+
+def get_rows(index, keys, columns, missing='raise', column_names=DOC_COLUMNS):
+    """Gets selected columns of several records.
+
+    A columnar.ColumnarCorpus reads only the selected columns from
+    disk. The records of an IndexedFile or IndexedCollection are split
+    on the index's delimiter, so the same code can read either format.
+
+    Args:
+        index: IndexedFile, IndexedCollection or ColumnarCorpus.
+        keys: List of key values.
+        columns: List of column names to return.
+        missing: 'raise', 'skip', or 'none'. See IndexedFile.get_many().
+        column_names: Names of the columns of a delimited text file.
+            Optional. Defaults to the msmarco document columns,
+            DOC_COLUMNS. Ignored for a ColumnarCorpus.
+
+    Returns: A list with a tuple of column values for each key, in the
+    same order as keys. The line terminator is removed from the last
+    column.
+    """
+    if hasattr(index, 'get_rows'):
+        return index.get_rows(keys, columns, missing)
+    positions = [column_names.index(column) for column in columns]
+    rows = []
+    for record in index.get_many(keys, missing):
+        if record is None:
+            rows.append(None)
+            continue
+        fields = record.rstrip('\n').split(index.delim)
+        rows.append(tuple([fields[pos] for pos in positions]))
+    return rows
@@ -0,0 +1,361 @@
+"""Splits documents into passages at sentence boundaries.
+
+Passages are created for DeepCT and HDCT by
+deepCT/doc_split/doc_to_psg.py, with a target number of words per
+passage, and for docT5query by docT5query/generate/doc_dataset.py, with
+a target number of T5 tokens per passage. Both start by splitting every
+document into sentences with nltk, which takes most of the time. This
+module splits the documents of a file into sentences once and saves the
+sentence boundaries in a sidecar file, so passages can be created under
+either length policy without splitting the documents again.
+
+A document's text is its title and text separated by a space, which is
+the text that both programs split.
+
+SentenceIndex:
+The sidecar file is named after the document file, with '.sentences'
+added to the end. It stores the start and end position of every
+sentence in every document, in document file order. Positions are
+character offsets into the document's text, so sentences are sliced
+from the text without being decoded. The sidecar is rebuilt
+automatically if the document file changes.
+
+Length Policies:
+* word_passages(): Adds sentences to a passage until it has a target
+  number of words.
+* token_passages(): Combines tokenized sentences into passages with a
+  target, minimum and maximum number of tokens, splitting sentences
+  that are too long.
+
+Build the sidecar file once before running several programs, or several
+machines, on the same document file:
+python -m util.splitter --workers 8 msmarco-docs.tsv
+
+Typical Usage Example:
+import util.splitter as splitter
+sentence_idx = splitter.SentenceIndex('msmarco-docs.tsv', workers=8)
+for doc_num, (doc_id, title, text) in enumerate(
+        splitter.read_docs('msmarco-docs.tsv')):
+    sentences = sentence_idx.sentences(doc_num, title + ' ' + text)
+    passages = splitter.word_passages(sentences, 200, count_words)
+"""
+
+import argparse
+import array
+import itertools
+import mmap
+import multiprocessing
+import os
+import os.path
+import struct
+import sys
+import time
+
+import nltk.tokenize
+
+# Sidecar file layout: the header is followed by two sections
+#   1. spans: uint32[2 * num_spans], (start, end) of every sentence
+#   2. doc_starts: int64[num_docs + 1], the first span of each document
+_MAGIC = b'NIRSENTS'
+_VERSION = 1
+# magic, version, padding, source size, source mtime_ns, num_docs,
+#   num_spans
+_HEADER = struct.Struct('<8sIIqqqq')
+_SUFFIX = '.sentences'
+# Number of documents sent to a worker process at a time
+CHUNK_DOCS = 100
+
+
+def read_docs(doc_path):
+    """Iterates over the documents in a TSV or Parquet file.
+
+    The TSV file has four columns: doc_id, URL, title and text. Any
+    further columns are ignored, as in doc_dataset.py. Only the
+    doc_id, title and text columns of a Parquet file created by
+    util/columnar.py are read.
+
+    Yields: (doc_id, title, text) tuples.
+    """
+    if doc_path.endswith('.parquet'):
+        try:
+            import util.columnar as columnar
+        except ImportError:  # Imported from the util folder
+            import columnar
+        docs = columnar.ColumnarCorpus(doc_path)
+        yield from docs.iter_rows(['doc_id', 'title', 'text'])
+        docs.close()
+        return
+    with open(doc_path, 'rt') as dfile:
+        for line in dfile:
+            line = line[:-1] if line.endswith('\n') else line
+            split_line = line.split('\t')
+            yield split_line[0], split_line[2], split_line[3]
+
+
+def sentence_spans(text):
+    """Finds the start and end positions of the sentences in a text.
+
+    Returns: A list of (start, end) tuples, such that the sentences
+    returned by nltk.tokenize.sent_tokenize(text) are
+    [text[start:end] for start, end in spans].
+    """
+    spans = []
+    end = 0
+    for sentence in nltk.tokenize.sent_tokenize(text):
+        start = text.index(sentence, end)
+        end = start + len(sentence)
+        spans.append((start, end))
+    return spans
+
+def _chunk_spans(docs):
+    """Finds the sentence spans of a chunk of (doc_id, title, text)."""
+    return [sentence_spans(title + ' ' + text) for _, title, text in docs]
+
+
+class SentenceIndex():
+    """Sentence boundaries of every document in a document file.
+
+    Constructor arguments:
+        doc_path: Path to a TSV or Parquet document file. See
+            read_docs().
+        workers: Number of processes that split documents into
+            sentences when the sidecar file is built. Optional,
+            defaults to 1.
+        build: If False, a ValueError is raised instead of building
+            the sidecar file. Optional, defaults to True.
+
+    The sidecar file, doc_path + '.sentences', is built if it does not
+    exist or if the document file has changed since it was built. It
+    is written to a temporary file named with the process ID and then
+    renamed, so processes that build it at the same time do not write
+    to the same file.
+
+    Attributes:
+        spans(doc_num): Returns the (start, end) positions of the
+            sentences of a document, by its position in the file.
+        sentences(doc_num, text): Returns the sentences of a document.
+    """
+    def __init__(self, doc_path, workers=1, build=True):
+        """Builds the sidecar file if needed and memory-maps it."""
+        if not os.path.isfile(doc_path):
+            raise ValueError('Input file "{}" does not exist.'
+                             .format(doc_path))
+        self.doc_path = doc_path
+        self.index_path = doc_path + _SUFFIX
+        self.workers = max(1, workers)
+        self._mm = None
+        if not self._read_index():
+            if not build:
+                raise ValueError(
+                    'Sentence index {} does not exist or is out of date. '
+                    'Build it with: python -m util.splitter {}'
+                    .format(self.index_path, doc_path))
+            self._build_index()
+            self._read_index()
+
+    def _source_info(self):
+        """Gets the size and modification time of the document file."""
+        stat = os.stat(self.doc_path)
+        return stat.st_size, stat.st_mtime_ns
+
+    def _read_index(self):
+        """Memory-maps the sidecar file.
+
+        Returns: False if the sidecar file does not exist, has an
+        unsupported format, or was built from a different version of
+        the document file.
+        """
+        if not os.path.isfile(self.index_path):
+            return False
+        with open(self.index_path, 'rb') as ifile:
+            self._mm = mmap.mmap(ifile.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, _, size, mtime_ns, num_docs,
+         num_spans) = _HEADER.unpack_from(self._mm, 0)
+        if (magic != _MAGIC or version != _VERSION
+                or (size, mtime_ns) != self._source_info()):
+            print('Sentence index {} is out of date. Rebuilding index.'
+                  .format(self.index_path))
+            self.close()
+            return False
+        view = memoryview(self._mm)
+        spans_end = _HEADER.size + num_spans * 8
+        self._spans = view[_HEADER.size:spans_end].cast('I')
+        self._doc_starts = view[spans_end:
+                                spans_end + (num_docs + 1) * 8].cast('q')
+        return True
+
+    def _build_index(self):
+        """Splits every document into sentences and writes the sidecar."""
+        print('Splitting sentences in', self.doc_path)
+        start_time = time.time()
+        source_info = self._source_info()
+        docs = read_docs(self.doc_path)
+        chunks = iter(lambda: list(itertools.islice(docs, CHUNK_DOCS)), [])
+        pool = (multiprocessing.Pool(self.workers) if self.workers > 1
+                else None)
+        doc_starts = array.array('q', [0])
+        tmp_path = '{}.{}.tmp'.format(self.index_path, os.getpid())
+        try:
+            results = (pool.imap(_chunk_spans, chunks) if pool is not None
+                       else map(_chunk_spans, chunks))
+            with open(tmp_path, 'wb') as ifile:
+                ifile.write(bytes(_HEADER.size))
+                for chunk in results:
+                    spans = array.array('I')
+                    for doc_spans in chunk:
+                        for span in doc_spans:
+                            spans.extend(span)
+                        doc_starts.append(doc_starts[-1] + len(doc_spans))
+                    if sys.byteorder != 'little':
+                        spans.byteswap()
+                    spans.tofile(ifile)
+                if sys.byteorder != 'little':
+                    doc_starts.byteswap()
+                doc_starts.tofile(ifile)
+                if sys.byteorder != 'little':
+                    doc_starts.byteswap()
+                ifile.seek(0)
+                ifile.write(_HEADER.pack(_MAGIC, _VERSION, 0, *source_info,
+                                         len(doc_starts) - 1,
+                                         doc_starts[-1]))
+            os.replace(tmp_path, self.index_path)
+        finally:
+            if pool is not None:
+                pool.terminate()
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+        elapsed = time.time() - start_time
+        print('Split {:,} documents into {:,} sentences in {:.1f} seconds'
+              .format(len(doc_starts) - 1, doc_starts[-1], elapsed))
+
+    def spans(self, doc_num):
+        """Gets the (start, end) positions of a document's sentences."""
+        if not 0 <= doc_num < len(self):
+            raise IndexError('Document number {} out of range.'
+                             .format(doc_num))
+        flat = self._spans[2 * self._doc_starts[doc_num]:
+                           2 * self._doc_starts[doc_num + 1]]
+        return list(zip(flat[::2], flat[1::2]))
+
+    def sentences(self, doc_num, text):
+        """Gets a document's sentences.
+
+        Args:
+            doc_num: Position of the document in the document file,
+                starting at 0.
+            text: The document's title and text, separated by a space.
+
+        Returns: The same list of sentences as
+        nltk.tokenize.sent_tokenize(text).
+        """
+        return [text[start:end] for start, end in self.spans(doc_num)]
+
+    def __len__(self):
+        """Gets the number of documents."""
+        return len(self._doc_starts) - 1
+
+    def __getstate__(self):
+        """Excludes the memory-mapped file when sent to other processes."""
+        state = self.__dict__.copy()
+        for name in ['_mm', '_spans', '_doc_starts']:
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._mm = None
+        if not self._read_index():
+            raise ValueError('Sentence index {} is out of date.'
+                             .format(self.index_path))
+
+    def close(self):
+        """Closes the sidecar file."""
+        if self._mm is not None:
+            self._spans = self._doc_starts = None
+            try:
+                self._mm.close()
+            except BufferError:
+                pass  # Spans still in use, mmap is closed when released
+            self._mm = None
+
+
+def word_passages(sentences, psg_len, count_words):
+    """Combines sentences into passages with about psg_len words.
+
+    Sentences are added to a passage until the passage has psg_len or
+    more words, so most passages are slightly longer than psg_len.
+
+    Args:
+        sentences: List of sentence strings.
+        psg_len: The target length of each passage, in words.
+        count_words: Function that returns the number of words in a
+            sentence.
+
+    Returns: A list of passage strings, with the sentences of each
+    passage separated by spaces.
+    """
+    passages = []
+    passage = []
+    curr_len = 0
+    for sentence in sentences:
+        if curr_len >= psg_len:
+            passages.append(' '.join(passage))
+            passage = []
+            curr_len = 0
+        passage.append(sentence)
+        curr_len += count_words(sentence)
+    passages.append(' '.join(passage))
+    return passages
+
+def token_passages(tokenized_sentences, tgt_len, max_len, min_len):
+    """Combines tokenized sentences into passages.
+
+    Args:
+        tokenized_sentences: List with a list of token IDs for each
+            sentence.
+        tgt_len: Target passage length. Sentences are not added to a
+            passage once this length is reached.
+        max_len: Maximum passage length. Sentences are split if needed
+            to stay below this limit.
+        min_len: Minimum passage length. Sentences are split if needed
+            to stay above this limit.
+
+    Returns: A list of passages, each a list of token IDs.
+    """
+    passage = []
+    passages = []
+    for sentence in tokenized_sentences:
+        curr_len = len(passage) + len(sentence)
+        if curr_len <= tgt_len:    # Too short - add another sentence
+            passage.extend(sentence)
+        elif curr_len <= max_len:  # Just right, start another passage
+            passage.extend(sentence)
+            passages.append(passage)
+            passage = []
+        else:                      # Oh-oh, above max length
+            if len(passage) > min_len:  # Reached min length
+                passages.append(passage)     #   Start next passage
+                passage = sentence
+            else:            # Did not reach min len, break up sentence.
+                sentence_break = max_len - len(passage)
+                passage.extend(sentence[:sentence_break])
+                passages.append(passage)
+                passage = sentence[sentence_break:]
+            while len(passage) > max_len:  # Longer than max_len
+                passages.append(passage[:max_len])
+                passage = passage[max_len:]
+    if len(passage) > 0:  # Don't forget to append final passage.
+        passages.append(passage)
+    return passages
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        'Builds the sentence index sidecar file of a document file.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes that split documents '
+                             'into sentences.')
+    parser.add_argument('doc_path',
+                        help='Path to TSV or Parquet document file.')
+    args = parser.parse_args()
+    SentenceIndex(args.doc_path, args.workers).close()
@@ -0,0 +1,89 @@
+"""Shared helpers for the pytest tests of the passage splitters.
+
+The tests in util/tests, deepCT/doc_split/tests and
+docT5query/generate/tests write small random document files and split
+them into sentences with nltk. This module provides the document
+generator and a fixture that replaces nltk's tokenizers with regular
+expressions when the punkt models are not installed. Tests that must
+check the real nltk output call require_punkt() first, so they are
+skipped instead of silently using the regular expressions.
+
+Typical Usage Example (in a test file):
+import util.testing as testing
+from util.testing import simple_nltk  # Applied to every test
+
+def test_split(tmp_path):
+    testing.write_docs(str(tmp_path / 'docs.tsv'), 100)
+"""
+
+import random
+import re
+
+import nltk.tokenize
+import pytest
+
+# Words with periods and apostrophes, which sentence splitters treat
+#   differently from plain words.
+WORDS = ['alpha', 'beta', 'gamma', 'delta', "don't", 'U.S.', '3.5', 'x']
+
+# Kept before simple_nltk can replace it
+_nltk_sent_tokenize = nltk.tokenize.sent_tokenize
+
+
+def has_punkt():
+    """Checks whether nltk's punkt sentence tokenizer can be loaded."""
+    try:
+        _nltk_sent_tokenize('One. Two.')
+    except LookupError:
+        return False
+    return True
+
+def require_punkt():
+    """Skips the calling test if the punkt models are not installed."""
+    if not has_punkt():
+        pytest.skip('nltk punkt models are not installed')
+
+@pytest.fixture(autouse=True)
+def simple_nltk(monkeypatch):
+    """Uses regular expression tokenizers if punkt is missing."""
+    if has_punkt():
+        return
+    monkeypatch.setattr(
+        nltk.tokenize, 'sent_tokenize',
+        lambda text: [sentence for sentence
+                      in re.split(r'(?<=[.!?])\s+', text.strip())
+                      if sentence])
+    monkeypatch.setattr(nltk.tokenize, 'word_tokenize',
+                        lambda sentence: re.findall(r'\w+|[^\w\s]',
+                                                    sentence))
+
+
+def random_text(rng, num_sentences, max_words=12):
+    """Creates sentences of 1 to max_words random WORDS."""
+    return ' '.join(' '.join(rng.choice(WORDS)
+                             for _ in range(rng.randint(1, max_words))) + '.'
+                    for _ in range(num_sentences))
+
+def write_docs(fpath, num_docs, seed=3, min_sentences=0, max_sentences=15,
+               max_words=12, empty_every=None):
+    """Writes an msmarco style TSV document file with random text.
+
+    Args:
+        fpath: Path of the file.
+        num_docs: Number of documents, with IDs D0, D1, ...
+        seed: Seed of the random number generator. Optional.
+        min_sentences, max_sentences: Range of the number of sentences
+            in each document. Optional.
+        max_words: Maximum number of words in each sentence. Optional.
+        empty_every: If set, documents whose number is a multiple of
+            empty_every have a blank title and no text. Optional.
+    """
+    rng = random.Random(seed)
+    with open(fpath, 'wt') as tfile:
+        for idx in range(num_docs):
+            title = f'Title {idx}'
+            text = random_text(rng, rng.randint(min_sentences, max_sentences),
+                               max_words)
+            if empty_every and idx % empty_every == 0:
+                title, text = ' ', ''
+            tfile.write(f'D{idx}\thttp://{idx}\t{title}\t{text}\n')
@@ -1,9 +1,13 @@
 import json
 import os.path
+import pickle
 import sys
 
+import pytest
+
 # Run test from util directory
 sys.path.insert(0, os.path.abspath('.'))
+import codec
 import indexer
 
 def test_json():
@@ -29,3 +33,263 @@ def test_tsv():
     assert line_data[0] == id1
     assert line_data[1] == r'http://www.legal500.com/c/france'
     didx.close()
+
+def _write_tsv(fpath, num_lines):
+    with open(fpath, 'wt') as tfile:
+        for idx in range(num_lines):
+            tfile.write(f'D{idx}\thttp://doc{idx}.com\ttitle {idx}\ttext {idx}\n')
+
+def test_binary_index(tmp_path):
+    fpath = str(tmp_path / 'docs.tsv')
+    _write_tsv(fpath, 100)
+    didx = indexer.IndexedFile(fpath, 0, line_idx=True)
+    assert os.path.isfile(fpath + '.bin-index')
+    assert len(didx) == 100
+    assert didx['D42'].split('\t')[2] == 'title 42'
+    assert didx[42].split('\t')[0] == 'D42'
+    assert didx.lines[42][1] == 'D42'
+    assert 'D42' in didx.docs and 'D100' not in didx.docs
+    try:
+        didx['D100']
+        assert False
+    except KeyError:
+        pass
+    didx.close()
+
+    # Reopening reads the index from disk
+    didx = indexer.IndexedFile(fpath, 0, line_idx=True)
+    assert didx['D99'].split('\t')[0] == 'D99'
+    didx.close()
+
+def test_migrate_pickled_index(tmp_path):
+    fpath = str(tmp_path / 'docs.tsv')
+    _write_tsv(fpath, 10)
+    docs = {}
+    byte_pos = 0
+    with open(fpath, 'rb') as tfile:
+        for line_num, line in enumerate(tfile):
+            docs[line.split(b'\t')[0].decode()] = (byte_pos, line_num)
+            byte_pos += len(line)
+    with open(fpath + '.pickled-index', 'wb') as pfile:
+        pickle.dump((docs, None), pfile)
+    didx = indexer.IndexedFile(fpath, 0)
+    assert os.path.isfile(fpath + '.bin-index')
+    assert didx['D7'] == 'D7\thttp://doc7.com\ttitle 7\ttext 7\n'
+    didx.close()
+
+def test_mmap_access(tmp_path):
+    fpath = str(tmp_path / 'docs.tsv')
+    _write_tsv(fpath, 100)
+    didx = indexer.IndexedFile(fpath, 0, line_idx=True, use_mmap=True)
+    raw = didx.get_raw('D42')
+    assert isinstance(raw, memoryview)
+    assert bytes(raw) == b'D42\thttp://doc42.com\ttitle 42\ttext 42\n'
+    assert didx['D42'] == str(raw, 'utf-8')
+    assert didx[99] == 'D99\thttp://doc99.com\ttitle 99\ttext 99\n'
+    del raw
+    didx.close()
+
+    didx = indexer.IndexedFile(fpath, 0, line_idx=True)
+    assert didx.get_raw(99) == b'D99\thttp://doc99.com\ttitle 99\ttext 99\n'
+    didx.close()
+
+def test_get_many(tmp_path):
+    fpath = str(tmp_path / 'docs.tsv')
+    _write_tsv(fpath, 1000)
+    for use_mmap in [False, True]:
+        didx = indexer.IndexedFile(fpath, 0, use_mmap=use_mmap)
+        keys = ['D900', 'D3', 'D500', 'D3', 'D4']
+        records = didx.get_many(keys, max_gap=100)
+        assert records == [didx[key] for key in keys]
+        assert didx.get_many(['D1', 'X', 'D2'], missing='none') == \
+            [didx['D1'], None, didx['D2']]
+        assert didx.get_many(['D1', 'X', 'D2'], missing='skip') == \
+            [didx['D1'], didx['D2']]
+        try:
+            didx.get_many(['D1', 'X'])
+            assert False
+        except KeyError:
+            pass
+        didx.close()
+
+def test_parallel_build(tmp_path):
+    fpath = str(tmp_path / 'docs.json')
+    with open(fpath, 'wt') as jfile:
+        for idx in range(1000):
+            doc_id = f'D{idx}' if idx % 10 else f'D"{idx}'  # Escaped quote
+            jfile.write(json.dumps({'contents': 'x ' * (idx % 7),
+                                    'id': doc_id}) + '\n')
+    didx = indexer.IndexedFile(fpath, 'id', line_idx=True, workers=4)
+    assert len(didx) == 1000
+    for key in ['D"0', 'D1', 'D555', 'D999']:
+        assert json.loads(didx[key])['id'] == key
+    parallel_lines = list(didx.lines)
+    didx.close()
+    os.remove(fpath + '.bin-index')
+
+    didx = indexer.IndexedFile(fpath, 'id', line_idx=True, workers=1)
+    assert list(didx.lines) == parallel_lines
+    didx.close()
+
+def test_nested_json_key(tmp_path):
+    get_id = codec.field_decoder('id')
+    assert get_id(b'{"id": "D1", "meta": {"id": "X"}}') == 'D1'
+    assert get_id(b'{"meta": {"id": "X"}, "id": "D1"}') == 'D1'
+    assert get_id(b'{"title": "a {b}", "id": "D2"}') == 'D2'
+    with pytest.raises(KeyError):
+        get_id(b'{"meta": {"id": "X"}}')
+    fpath = str(tmp_path / 'docs.json')
+    with open(fpath, 'wt') as jfile:
+        for idx in range(10):
+            jfile.write(json.dumps({'meta': {'id': f'M{idx}'},
+                                    'id': f'D{idx}'}) + '\n')
+    didx = indexer.IndexedFile(fpath, 'id')
+    assert sorted(didx.docs) == [f'D{idx}' for idx in range(10)]
+    didx.close()
+
+def test_stale_index(tmp_path):
+    fpath = str(tmp_path / 'docs.tsv')
+    _write_tsv(fpath, 100)
+    indexer.IndexedFile(fpath, 0).close()
+
+    # Regenerated file with different contents is re-indexed
+    with open(fpath, 'wt') as tfile:
+        for idx in range(50):
+            tfile.write(f'X{idx}\tnew text\n')
+    didx = indexer.IndexedFile(fpath, 0)
+    assert len(didx) == 50
+    assert didx['X49'] == 'X49\tnew text\n'
+    didx.close()
+
+def test_appended_lines(tmp_path):
+    fpath = str(tmp_path / 'docs.tsv')
+    _write_tsv(fpath, 100)
+    indexer.IndexedFile(fpath, 0, line_idx=True).close()
+    with open(fpath, 'at') as tfile:
+        tfile.write('D100\tappended\nD5\treplaced\n')
+    didx = indexer.IndexedFile(fpath, 0, line_idx=True)
+    assert len(didx) == 101
+    assert didx['D100'] == 'D100\tappended\n'
+    assert didx['D5'] == 'D5\treplaced\n'
+    assert didx[101] == 'D5\treplaced\n'
+    assert didx.docs.source_info.num_lines == 102
+    assert didx.docs.source_info.size == os.path.getsize(fpath)
+    didx.close()
+
+def test_appended_lines_match_rebuild(tmp_path):
+    fpath = str(tmp_path / 'docs.tsv')
+    _write_tsv(fpath, 300)
+    indexer.IndexedFile(fpath, 0, line_idx=True).close()
+    with open(fpath, 'at') as tfile:  # New keys at every position
+        for key in ['A', 'D150', 'D2x', 'D0', 'Z', 'D299', 'D31', 'D2x']:
+            tfile.write(f'{key}\tappended\n')
+    appended = indexer.IndexedFile(fpath, 0, line_idx=True)
+    os.remove(appended.index_path)
+    rebuilt = indexer.IndexedFile(fpath, 0, line_idx=True)
+    assert list(appended.docs) == list(rebuilt.docs)
+    for section in ['positions', 'ends', 'line_nums', 'line_positions',
+                    'line_slots']:
+        assert (list(getattr(appended.docs, section))
+                == list(getattr(rebuilt.docs, section)))
+    assert appended.docs.source_info == rebuilt.docs.source_info
+    assert appended['D2x'] == rebuilt[307] == 'D2x\tappended\n'
+    appended.close()
+    rebuilt.close()
+
+def test_collection(tmp_path):
+    for shard in range(3):
+        with open(tmp_path / f'docs{shard}.json', 'wt') as jfile:
+            for idx in range(shard, 300, 3):
+                jfile.write(json.dumps({'id': f'D{idx}', 'shard': shard}) + '\n')
+    (tmp_path / 'notes.txt').write_text('not a shard\n')
+    coll = indexer.IndexedCollection(str(tmp_path), 'id', suffix='.json',
+                                     max_open_files=2)
+    assert len(coll.shard_paths) == 3
+    assert len(coll) == 300
+    assert coll.shard_len(1) == 100
+    assert json.loads(coll['D7'])['shard'] == 1
+    records = coll.get_many(['D5', 'D4', 'X', 'D3'], missing='none')
+    assert [json.loads(rec)['shard'] if rec else None
+            for rec in records] == [2, 1, None, 0]
+    coll.close()
+
+    # Adding a shard rebuilds the collection index
+    with open(tmp_path / 'docs3.json', 'wt') as jfile:
+        jfile.write(json.dumps({'id': 'D300', 'shard': 3}) + '\n')
+    coll = indexer.open_index(str(tmp_path), 'id', suffix='.json')
+    assert len(coll) == 301
+    assert json.loads(coll['D300'])['shard'] == 3
+    coll.close()
+
+def test_collection_sorted_keys(tmp_path):
+    with open(tmp_path / 'docs0.json', 'wt') as jfile:
+        for idx in [3, 1, 2]:
+            jfile.write(json.dumps({'id': f'D{idx}'}) + '\n')
+    coll = indexer.IndexedCollection(str(tmp_path), 'id', suffix='.json')
+    assert list(coll.sorted_keys()) == [b'D1', b'D2', b'D3']
+    fingerprint = coll.fingerprint()
+    coll.close()
+
+    with open(tmp_path / 'docs0.json', 'at') as jfile:
+        jfile.write(json.dumps({'id': 'D0'}) + '\n')
+    coll = indexer.IndexedCollection(str(tmp_path), 'id', suffix='.json')
+    assert list(coll.sorted_keys())[0] == b'D0'
+    assert coll.fingerprint() != fingerprint
+    coll.close()
+
+def test_columnar(tmp_path):
+    columnar = pytest.importorskip('columnar')
+    fpath = str(tmp_path / 'docs.tsv')
+    with open(fpath, 'wt') as tfile:
+        for idx in [5, 3, 9, 1, 7, 0, 2, 8, 6, 4]:
+            tfile.write(f'D{idx}\thttp://{idx}\ttitle {idx}\ttext {idx}\n')
+    ppath = str(tmp_path / 'docs.parquet')
+    assert columnar.convert(fpath, ppath, row_group_size=3) == 10
+    didx = indexer.IndexedFile(fpath, 0)
+    pidx = indexer.open_index(ppath, 0)
+    assert pidx.kind == 'docs' and pidx.unique_keys
+    assert len(pidx) == 10 and pidx.num_row_groups == 4
+    keys = ['D7', 'X', 'D0', 'D9']
+    assert pidx.get_many(keys, missing='none') == didx.get_many(keys, missing='none')
+    assert (indexer.get_rows(pidx, keys, ['title', 'text'], missing='skip')
+            == indexer.get_rows(didx, keys, ['title', 'text'], missing='skip')
+            == [('title 7', 'text 7'), ('title 0', 'text 0'),
+                ('title 9', 'text 9')])
+    # Records stay in file order, lookups use the sorted key index
+    assert [row[0] for row in pidx.iter_rows(['url'], key_range=('D2', 'D5'))
+            ] == ['http://3', 'http://2', 'http://4']
+    assert list(pidx.iter_rows(['doc_id'], start=2, stop=4)) == [('D9',), ('D1',)]
+    assert os.path.isfile(ppath + '.bin-index')
+    pidx.close()
+    didx.close()
+    os.remove(ppath + '.bin-index')
+    pidx = indexer.open_index(ppath, 0)  # Rebuilds the key index now
+    assert sorted(os.listdir(tmp_path)) == [
+        'docs.parquet', 'docs.parquet.bin-index', 'docs.tsv',
+        'docs.tsv.bin-index']
+    assert 'D8' in pidx and 'D10' not in pidx
+    assert pidx.get_rows(['D8'], ['url']) == [('http://8',)]
+    pidx.close()
+    columnar.convert(fpath, ppath)
+    pidx = indexer.open_index(ppath, 0)
+    assert pidx.num_row_groups == 1  # 100 documents per row group
+    pidx.close()
+
+
+def test_columnar_vectors(tmp_path):
+    columnar = pytest.importorskip('columnar')
+    fpath = str(tmp_path / 'vectors.json')
+    with open(fpath, 'wt') as jfile:
+        jfile.write('{"id": "D1", "vector": {"a": 3, "b": 1}}\n'
+                    '{"id": "D2", "vector": {"c": 2}}\n')
+    ppath = str(tmp_path / 'vectors.parquet')
+    assert columnar.convert(fpath, ppath, kind='vectors') == 2
+    pidx = indexer.open_index(ppath, 0)
+    assert pidx.get_rows(['D2', 'D1'], ['vector']) == [
+        ({'c': 2},), ({'a': 3, 'b': 1},)]
+    assert json.loads(pidx['D1']) == {'id': 'D1', 'vector': {'a': 3, 'b': 1}}
+    pidx.close()
+    with open(fpath, 'at') as jfile:
+        jfile.write('{"id": "D3", "vector": {"a": 0.5}}\n')
+    with pytest.raises(ValueError):
+        columnar.convert(fpath, ppath, kind='vectors')
@@ -0,0 +1,162 @@
+import os
+import os.path
+import pickle
+import random
+import sys
+
+import nltk.tokenize
+import pytest
+
+# Run test from util directory
+sys.path.insert(0, os.path.abspath('.'))
+sys.path.insert(0, os.path.abspath('..'))
+import splitter
+import util.testing as testing
+from util.testing import simple_nltk  # Applied to every test
+
+
+def _original_word_passages(sentences, psg_len, count_words):
+    """Passage assembly of doc_to_psg.py before the running count."""
+    sent_lengths = [count_words(sentence) for sentence in sentences]
+    passages = []
+    passage = []
+    start_idx = 0
+    for idx, sentence in enumerate(sentences):
+        end_idx = start_idx + len(passage)
+        curr_len = sum(sent_lengths[start_idx:end_idx])
+        if curr_len < psg_len:
+            passage.append(sentence)
+        else:
+            passages.append(' '.join(passage))
+            passage = [sentence]
+            start_idx = idx
+    passages.append(' '.join(passage))
+    return passages
+
+
+def _original_token_passages(tokenized_sentences, tgt_len, max_len,
+                             min_len):
+    """Passage assembly of DocDataset.split_doc_text, without padding."""
+    passage = []
+    passages = []
+    for sentence in tokenized_sentences:
+        curr_len = len(passage) + len(sentence)
+        if curr_len <= tgt_len:
+            passage.extend(sentence)
+        elif curr_len <= max_len:
+            passage.extend(sentence)
+            passages.append(passage)
+            passage = []
+        else:
+            if len(passage) > min_len:
+                passages.append(passage)
+                passage = sentence
+            else:
+                sentence_break = max_len - len(passage)
+                passage.extend(sentence[:sentence_break])
+                passages.append(passage)
+                passage = sentence[sentence_break:]
+            while len(passage) > max_len:
+                passages.append(passage[:max_len])
+                passage = passage[max_len:]
+    if len(passage) > 0:
+        passages.append(passage)
+    return passages
+
+
+def test_word_passages():
+    rng = random.Random(5)
+    count_words = lambda sentence: len(sentence.split())
+    for _ in range(300):
+        sentences = [' '.join(['w'] * rng.randint(1, 30))
+                     for _ in range(rng.randint(0, 20))]
+        psg_len = rng.choice([1, 5, 20, 50, 200])
+        assert (splitter.word_passages(sentences, psg_len, count_words)
+                == _original_word_passages(sentences, psg_len, count_words))
+
+
+def test_token_passages():
+    rng = random.Random(6)
+    for _ in range(500):
+        min_len = rng.randint(1, 20)
+        tgt_len = rng.randint(min_len, 40)
+        max_len = rng.randint(tgt_len, 60)
+        sentences = [[rng.randrange(100) for _ in range(rng.randint(1, 90))]
+                     for _ in range(rng.randint(0, 12))]
+        expected = _original_token_passages(
+            [list(sentence) for sentence in sentences], tgt_len, max_len,
+            min_len)
+        assert splitter.token_passages(sentences, tgt_len, max_len,
+                                       min_len) == expected
+
+
+def test_sentence_spans_nltk():
+    """Checks the span recovery against the real punkt tokenizer."""
+    testing.require_punkt()
+    texts = [
+        'Dr. Smith went to Washington D.C. on Jan. 5. He met the U.S. '
+        'president.  Then he left...   "Was it worth it?" he asked. Yes.',
+        'Same sentence. Same sentence. Same sentence.',
+        'No final period\nNew line. \t Tabs and  spaces.   ',
+        'Caf\u00e9 au lait co\u00fbte 3.5 \u20ac. C\u2019est cher! '
+        'Vraiment?',
+        '',
+        '   ',
+    ]
+    rng = random.Random(7)
+    texts.extend(testing.random_text(rng, rng.randint(0, 15))
+                 for _ in range(200))
+    for text in texts:
+        spans = splitter.sentence_spans(text)
+        assert ([text[start:end] for start, end in spans]
+                == nltk.tokenize.sent_tokenize(text))
+        assert all(end <= start for (_, end), (start, _)
+                   in zip(spans, spans[1:]))
+
+
+def test_sentence_index(tmp_path):
+    fpath = str(tmp_path / 'docs.tsv')
+    testing.write_docs(fpath, 250)
+    docs = list(splitter.read_docs(fpath))
+    sentence_idx = splitter.SentenceIndex(fpath)
+    assert len(sentence_idx) == 250
+    assert sorted(os.listdir(tmp_path)) == ['docs.tsv', 'docs.tsv.sentences']
+    for doc_num, (_, title, text) in enumerate(docs):
+        doc_text = title + ' ' + text
+        assert (sentence_idx.spans(doc_num)
+                == splitter.sentence_spans(doc_text))
+        assert (sentence_idx.sentences(doc_num, doc_text)
+                == nltk.tokenize.sent_tokenize(doc_text))
+    with pytest.raises(IndexError):
+        sentence_idx.spans(250)
+
+    # Survives pickling, e.g., when sent to DataLoader worker processes
+    unpickled = pickle.loads(pickle.dumps(sentence_idx))
+    assert [unpickled.spans(doc_num) for doc_num in range(250)] == [
+        sentence_idx.spans(doc_num) for doc_num in range(250)]
+    unpickled.close()
+    sentence_idx.close()
+
+    # Built with several processes, the sidecar file is identical
+    with open(fpath + '.sentences', 'rb') as sfile:
+        sidecar = sfile.read()
+    os.remove(fpath + '.sentences')
+    splitter.SentenceIndex(fpath, workers=3).close()
+    with open(fpath + '.sentences', 'rb') as sfile:
+        assert sfile.read() == sidecar
+
+
+def test_sentence_index_rebuild(tmp_path):
+    fpath = str(tmp_path / 'docs.tsv')
+    testing.write_docs(fpath, 20)
+    splitter.SentenceIndex(fpath).close()
+    testing.write_docs(fpath, 30, seed=4)
+    with pytest.raises(ValueError):
+        splitter.SentenceIndex(fpath, build=False)
+    sentence_idx = splitter.SentenceIndex(fpath)
+    assert len(sentence_idx) == 30
+    for doc_num, (_, title, text) in enumerate(splitter.read_docs(fpath)):
+        assert (sentence_idx.spans(doc_num)
+                == splitter.sentence_spans(title + ' ' + text))
+    sentence_idx.close()
+    assert sorted(os.listdir(tmp_path)) == ['docs.tsv', 'docs.tsv.sentences']